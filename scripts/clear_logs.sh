@@ -1,8 +1,26 @@
 > ~/cardstorm_logs/card_stderr.log
 > ~/cardstorm_logs/card_stdout.log
 
+> ~/cardstorm_logs/image_stderr.log
+> ~/cardstorm_logs/image_stdout.log
+
 > ~/cardstorm_logs/deck_stderr.log
 > ~/cardstorm_logs/deck_stdout.log
 
 > ~/cardstorm_logs/model_stderr.log
 > ~/cardstorm_logs/model_stdout.log
+
+> ~/cardstorm_logs/archetypes_stderr.log
+> ~/cardstorm_logs/archetypes_stdout.log
+
+> ~/cardstorm_logs/cooccurrence_stderr.log
+> ~/cardstorm_logs/cooccurrence_stdout.log
+
+> ~/cardstorm_logs/migrations_stderr.log
+> ~/cardstorm_logs/migrations_stdout.log
+
+> ~/cardstorm_logs/pipeline_stderr.log
+> ~/cardstorm_logs/pipeline_stdout.log
+
+> ~/cardstorm_logs/reload_stderr.log
+> ~/cardstorm_logs/reload_stdout.log
@@ -0,0 +1,6 @@
+#!/bin/bash
+# hold-out evaluation sweep over ALS parameters. each worker starts its own
+# local spark session, so this runs under plain python rather than spark-submit
+export PYSPARK_PYTHON=/home/ubuntu/anaconda3/bin/python
+
+/home/ubuntu/anaconda3/bin/python /home/ubuntu/cardstorm/src/evaluation.py "$@" 1>/home/ubuntu/cardstorm_logs/evaluation_stdout.log 2>/home/ubuntu/cardstorm_logs/evaluation_stderr.log
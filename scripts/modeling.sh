@@ -10,5 +10,5 @@ export PYSPARK_DRIVER_PYTHON_OPTS=
 --conf spark.sql.warehouse.dir="file:///tmp/spark-warehouse" \
 --packages com.databricks:spark-csv_2.11:1.5.0 \
 --packages com.amazonaws:aws-java-sdk-pom:1.10.34 \
---packages org.apache.hadoop:hadoop-aws:2.7.3 \
+--packages org.apache.hadoop:hadoop-aws:2.7.3,org.postgresql:postgresql:42.7.4 \
 /home/ubuntu/cardstorm/src/modeling.py 1>/home/ubuntu/cardstorm_logs/model_stdout.log 2>/home/ubuntu/cardstorm_logs/model_stderr.log
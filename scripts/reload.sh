@@ -0,0 +1,30 @@
+# rolls the production server over to the model runs just promoted. A HUP
+# isn't enough: with preload_app the new workers would fork from the old
+# master, which still holds the old models. USR2 starts a new master that
+# loads the promoted runs, and once it is up the old one stops gracefully.
+PIDFILE=${CARDSTORM_PIDFILE:-/tmp/cardstorm_gunicorn.pid}
+TIMEOUT=${CARDSTORM_RELOAD_TIMEOUT:-300}
+
+if [ ! -s "$PIDFILE" ]; then
+    echo "no gunicorn master in $PIDFILE, nothing to reload"
+    exit 0
+fi
+
+OLD_PID=$(cat "$PIDFILE")
+kill -USR2 "$OLD_PID" || exit 1
+
+# the new master writes its pid to $PIDFILE.2 once it has loaded the models,
+# and moves it to $PIDFILE when the old master is gone
+for i in $(seq 1 "$TIMEOUT"); do
+    sleep 1
+    if [ -s "$PIDFILE.2" ]; then
+        NEW_PID=$(cat "$PIDFILE.2")
+        kill -QUIT "$OLD_PID"
+        echo "gunicorn master $NEW_PID is serving the new runs, stopping $OLD_PID"
+        exit 0
+    fi
+done
+
+# the new master failed to load, the old one keeps serving the old runs
+echo "no new gunicorn master after ${TIMEOUT}s, $OLD_PID still serves the old runs" >&2
+exit 1
@@ -0,0 +1,4 @@
+# production server: preloaded model shared copy-on-write by forked gunicorn workers.
+# worker/thread counts are set in src/gunicorn.conf.py (CARDSTORM_WORKERS, CARDSTORM_THREADS)
+# scripts/reload.sh restarts it on newly promoted model runs
+/home/ubuntu/anaconda3/bin/gunicorn --config /home/ubuntu/cardstorm/src/gunicorn.conf.py wsgi:application 1>>/home/ubuntu/cardstorm_logs/web_stdout.log 2>>/home/ubuntu/cardstorm_logs/web_stderr.log
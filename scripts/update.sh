@@ -1,11 +1,4 @@
 # runs daily in crontab. gets new cards from scryfall, and new decks from mtgtop8.com
-# and creates a new model
-
-# get new cards from scryfall
-/home/ubuntu/anaconda3/bin/python3 /home/ubuntu/cardstorm/src/card_scraping.py 1>/home/ubuntu/cardstorm_logs/card_stdout.log 2>/home/ubuntu/cardstorm_logs/card_stderr.log
-
-# get new decks from mtgtop8.com
-/home/ubuntu/anaconda3/bin/python3 /home/ubuntu/cardstorm/src/deck_scraping.py 1>/home/ubuntu/cardstorm_logs/deck_stdout.log 2>/home/ubuntu/cardstorm_logs/deck_stderr.log
-
-# creates a new model
-bash /home/ubuntu/cardstorm/scripts/modeling.sh
+# and creates a new model. see src/pipeline.py for the stages and their order.
+# a failed run is picked up where it stopped with: pipeline.py run --resume
+/home/ubuntu/anaconda3/bin/python3 /home/ubuntu/cardstorm/src/pipeline.py run 1>>/home/ubuntu/cardstorm_logs/pipeline_stdout.log 2>>/home/ubuntu/cardstorm_logs/pipeline_stderr.log
@@ -1,2 +0,0 @@
-# gets new images from scryfall
-/home/ubuntu/anaconda3/bin/python3 /home/ubuntu/cardstorm/src/image_scraping.py 1>/home/ubuntu/cardstorm_logs/image_stdout.log 2>/home/ubuntu/cardstorm_logs/image_stderr.log
@@ -0,0 +1,279 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import numpy as np
+import db
+import migrations
+from catalog import get_formats
+
+def deck_factors(decks, feature_matrix):
+    '''
+    Folds every deck into the factor space with one sparse matrix product:
+    u solves V'V u = V'd for each deck, like a request does. The rows are
+    scaled to unit length so decks cluster by what they play, not by size.
+
+    INPUT:
+        - decks: scipy.sparse csr_matrix (n_decks x n_cards) of card counts
+        - feature_matrix: numpy array (n_cards x rank)
+
+    OUTPUT:
+        - factors: numpy array (n_decks x rank), unit length rows
+    '''
+
+    feature_matrix = feature_matrix.astype(np.float64)
+    gram = np.dot(feature_matrix.T, feature_matrix)
+    factors = np.linalg.solve(gram, np.asarray(decks.dot(feature_matrix)).T).T
+
+    return normalize_rows(factors)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return matrix / norms
+
+def minibatch_kmeans(points, n_clusters, batch_size=1024, n_iter=200, seed=0):
+    '''
+    Spherical mini-batch k-means: every step assigns a random batch of points
+    to the most similar centroid and moves those centroids toward them with
+    a per-centroid learning rate. Centroids stay unit length.
+
+    INPUT:
+        - points: numpy array (n x rank), unit length rows
+        - n_clusters: int
+        - batch_size: int, points per step
+        - n_iter: int, number of steps
+        - seed: int, seed for the initialization and the batches
+
+    OUTPUT:
+        - centroids: numpy array (n_clusters x rank), unit length rows
+        - inertia: float, sum of 1 - cosine similarity of every point to its centroid
+    '''
+
+    random_state = np.random.RandomState(seed)
+
+    # k-means++ seeding on a sample of the points
+    sample = points[random_state.choice(len(points), min(len(points), 20 * n_clusters),
+                                        replace=False)]
+    centroids = [sample[random_state.randint(len(sample))]]
+    distances = 1 - sample.dot(centroids[0])
+    for _ in range(1, n_clusters):
+        weights = np.maximum(distances, 0)
+        if weights.sum() == 0:
+            weights = np.ones(len(sample))
+        centroids.append(sample[random_state.choice(len(sample), p=weights / weights.sum())])
+        distances = np.minimum(distances, 1 - sample.dot(centroids[-1]))
+    centroids = np.array(centroids)
+
+    counts = np.zeros(n_clusters)
+    for _ in range(n_iter):
+        batch = points[random_state.randint(len(points), size=min(batch_size, len(points)))]
+        labels = np.argmax(batch.dot(centroids.T), axis=1)
+        for cluster in np.unique(labels):
+            members = batch[labels == cluster]
+            counts[cluster] += len(members)
+            rate = len(members) / counts[cluster]
+            centroids[cluster] = (1 - rate) * centroids[cluster] + rate * members.mean(axis=0)
+        centroids = normalize_rows(centroids)
+
+    _, similarities = assign(points, centroids)
+
+    return centroids, float((1 - similarities).sum())
+
+def assign(points, centroids, chunk_size=65536):
+    '''
+    OUTPUT:
+        - labels: numpy array (n,), index of the most similar centroid
+        - similarities: numpy array (n,), cosine similarity to that centroid
+    '''
+
+    labels = np.empty(len(points), dtype=int)
+    similarities = np.empty(len(points))
+    for start in range(0, len(points), chunk_size):
+        scores = points[start:start + chunk_size].dot(centroids.T)
+        labels[start:start + chunk_size] = np.argmax(scores, axis=1)
+        similarities[start:start + chunk_size] = scores.max(axis=1)
+
+    return labels, similarities
+
+def _init_worker(points, n_clusters, batch_size, n_iter):
+    global _points, _n_clusters, _batch_size, _n_iter
+    _points = points
+    _n_clusters = n_clusters
+    _batch_size = batch_size
+    _n_iter = n_iter
+
+def _cluster(seed):
+    return minibatch_kmeans(_points, _n_clusters, batch_size=_batch_size,
+                            n_iter=_n_iter, seed=seed)
+
+def fit_archetypes(points, n_clusters=40, n_init=8, batch_size=1024, n_iter=200,
+                   workers=None, seed=0):
+    '''
+    Runs n_init independent mini-batch k-means restarts in a process pool and
+    keeps the one with the lowest inertia.
+
+    INPUT:
+        - points: numpy array (n_decks x rank), output of deck_factors
+        - workers: int, processes to run the restarts in, defaults to the cores
+
+    OUTPUT:
+        - centroids: numpy array (n_clusters x rank), unit length rows
+        - labels: numpy array (n_decks,), archetype of every deck
+    '''
+
+    n_clusters = min(n_clusters, len(points))
+    workers = min(workers or multiprocessing.cpu_count(), n_init)
+    seeds = [seed + i for i in range(n_init)]
+
+    if workers > 1:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, initializer=_init_worker,
+                          initargs=(points, n_clusters, batch_size, n_iter)) as pool:
+            restarts = pool.map(_cluster, seeds)
+    else:
+        restarts = [minibatch_kmeans(points, n_clusters, batch_size=batch_size,
+                                     n_iter=n_iter, seed=seed) for seed in seeds]
+
+    centroids, inertia = min(restarts, key=lambda restart: restart[1])
+    labels, _ = assign(points, centroids)
+
+    return centroids, labels
+
+def candidate_lists(feature_matrix, centroids, n_candidates=1000):
+    '''
+    Ranks the cards for every archetype. Recreating a deck is linear in u, so
+    scoring the centroid ranks cards by the average score over its decks.
+
+    OUTPUT:
+        - candidates: numpy array (n_clusters x n_candidates) of card columns,
+                      best first
+    '''
+
+    scores = np.dot(feature_matrix, centroids.T).T
+    n_candidates = min(n_candidates, feature_matrix.shape[0])
+    candidates = np.argpartition(-scores, n_candidates - 1, axis=1)[:, :n_candidates]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+
+    return np.take_along_axis(candidates, order, axis=1)
+
+def store_archetypes(cursor, run_id, centroids, labels, candidates, all_cardstorm_ids):
+    '''
+    Replaces the archetypes of run_id.
+
+    INPUT:
+        - candidates: numpy array, output of candidate_lists
+        - all_cardstorm_ids: numpy array, cardstorm_id of every card column
+    '''
+
+    cursor.execute('DELETE FROM archetypes WHERE run_id = %s', [run_id])
+
+    counts = np.bincount(labels, minlength=len(centroids))
+    current_date = datetime.date.today()
+    for archetype_id, centroid in enumerate(centroids):
+        cursor.execute('''INSERT INTO archetypes (run_id, archetype_id, date, n_decks,
+                                                  centroid, candidates)
+                          VALUES (%s, %s, %s, %s, %s, %s)''',
+                       [run_id, archetype_id, current_date, int(counts[archetype_id]),
+                        centroid.tolist(), all_cardstorm_ids[candidates[archetype_id]].tolist()])
+
+def load_archetypes(cursor, run_id, all_cardstorm_ids):
+    '''
+    Reads the archetypes of a run for serving.
+
+    INPUT:
+        - cursor: psycopg2 cursor object
+        - run_id: int
+        - all_cardstorm_ids: sorted numpy array, the card columns of the recommender
+
+    OUTPUT:
+        - centroids: numpy array (n_clusters x rank), None if the run has no archetypes
+        - candidates: list of numpy arrays of card columns, best first
+    '''
+
+    db.execute_prepared(cursor, 'archetypes',
+                        '''SELECT centroid, candidates
+                           FROM archetypes
+                           WHERE run_id = $1
+                           ORDER BY archetype_id''', [run_id])
+    rows = cursor.fetchall()
+    if not rows:
+        return None, []
+
+    centroids = np.array([centroid for centroid, _ in rows], dtype=np.float32)
+    candidates = []
+    for _, cardstorm_ids in rows:
+        cardstorm_ids = np.array(cardstorm_ids)
+        # cards added since the run was trained aren't in every catalog
+        columns = np.searchsorted(all_cardstorm_ids, cardstorm_ids)
+        columns = np.minimum(columns, len(all_cardstorm_ids) - 1)
+        candidates.append(columns[all_cardstorm_ids[columns] == cardstorm_ids])
+
+    return centroids, candidates
+
+def main():
+    parser = argparse.ArgumentParser(description='cluster decks into archetypes for the promoted model')
+    parser.add_argument('--clusters', type=int, default=int(os.environ.get('CARDSTORM_ARCHETYPE_CLUSTERS', 40)))
+    parser.add_argument('--candidates', type=int, default=1000,
+                        help='length of the ranked candidate list stored per archetype')
+    parser.add_argument('--restarts', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    print('#####################################################')
+    print('BEGIN ARCHETYPE CLUSTERING: {}'.format(datetime.datetime.today()))
+
+    for format in get_formats():
+        cluster_format(format, args)
+    db.close_pool()
+
+def cluster_format(format, args):
+    '''
+    Clusters the decks of a format into archetypes for its promoted run.
+    '''
+
+    from ratings import load_ratings, ratings_matrix
+    from model_runs import get_current_run_id
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        run_id = get_current_run_id(cursor, format=format)
+        if run_id is None:
+            print('no promoted {} model run, nothing to cluster'.format(format))
+            return
+
+        cursor.execute('''SELECT cardstorm_id, features
+                          FROM product_matrices
+                          WHERE run_id = %s
+                          ORDER BY cardstorm_id ASC''', [run_id])
+        rows = cursor.fetchall()
+        all_cardstorm_ids = np.array([cardstorm_id for cardstorm_id, _ in rows])
+        feature_matrix = np.array([features for _, features in rows])
+
+        ratings = load_ratings(cursor, format=format)
+
+    # filler rows for unused cards have deck_id -1 and aren't decks
+    deck_ids, cardstorm_ids, card_counts = ratings
+    keep = (deck_ids >= 0) & np.isin(cardstorm_ids, all_cardstorm_ids)
+    decks, _ = ratings_matrix((deck_ids[keep], cardstorm_ids[keep], card_counts[keep]),
+                              all_cardstorm_ids)
+
+    points = deck_factors(decks, feature_matrix)
+    centroids, labels = fit_archetypes(points, n_clusters=args.clusters, n_init=args.restarts,
+                                       workers=args.workers)
+    candidates = candidate_lists(feature_matrix, centroids, n_candidates=args.candidates)
+
+    with db.transaction() as cursor:
+        migrations.migrate(cursor)
+        store_archetypes(cursor, run_id, centroids, labels, candidates, all_cardstorm_ids)
+        # archetypes of pruned runs can never be served again
+        cursor.execute('''DELETE FROM archetypes
+                          WHERE run_id IN (SELECT run_id FROM model_runs
+                                           WHERE pruned_at IS NOT NULL)''')
+
+    print('{} run {}: {} archetypes over {} decks, largest {} decks'.format(
+          format, run_id, len(centroids), decks.shape[0], np.bincount(labels).max()))
+
+if __name__ == '__main__':
+    main()
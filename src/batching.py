@@ -0,0 +1,151 @@
+import copy
+import os
+import queue
+import threading
+import time
+import numpy as np
+import metrics
+
+BATCH_SIZE = metrics.Histogram('cardstorm_batch_size',
+                               'Number of requests solved together in one batch.',
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+QUEUE_WAIT_SECONDS = metrics.Histogram('cardstorm_batch_queue_wait_seconds',
+                                       'Time a request waited for its batch to be solved.')
+
+_coalescers = []
+
+QUEUE_DEPTH = metrics.Gauge('cardstorm_batch_queue_depth',
+                            'Requests waiting for the request coalescer.',
+                            function=lambda: sum(c.queue_depth() for c in _coalescers))
+
+class _PendingRequest():
+
+    def __init__(self, deck_vector):
+        self.deck_vector = deck_vector
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class RequestCoalescer():
+    '''
+    Collects deck vectors submitted by concurrent requests and solves them
+    together. The first request to arrive opens a window; everything that
+    arrives before it closes (or until max_batch requests are waiting) is
+    stacked into one matrix and handed to score_batch, which does the least
+    squares solve and the scoring as matrix-matrix products.
+    '''
+
+    def __init__(self, score_batch, window=0.003, max_batch=64):
+        '''
+        INPUT:
+            - score_batch: callable, takes a (b x n) matrix of deck vectors and
+                           returns the (b x n) matrix of recreated deck vectors
+            - window: float, seconds to wait for more requests after the first
+            - max_batch: int, largest number of requests solved together
+        '''
+        self.score_batch = score_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        _coalescers.append(self)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, deck_vector):
+        '''
+        Queues one deck vector and blocks until its batch is solved.
+
+        OUTPUT:
+            - d_vector: numpy array, the recreated deck vector
+        '''
+
+        self._ensure_thread()
+        pending = _PendingRequest(deck_vector)
+        self._queue.put(pending)
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+        return pending.result
+
+    def _ensure_thread(self):
+        # threads don't survive a fork, each worker process starts its own
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='cardstorm-coalescer',
+                                                daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            BATCH_SIZE.observe(len(batch))
+
+            try:
+                results = self.score_batch(np.vstack([pending.deck_vector for pending in batch]))
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as error:
+                for pending in batch:
+                    pending.error = error
+
+            solved_at = time.perf_counter()
+            for pending in batch:
+                QUEUE_WAIT_SECONDS.observe(solved_at - pending.enqueued_at)
+                pending.done.set()
+
+def coalescing_factory(make_recommender, window, max_batch):
+    '''
+    Makes a recommender factory for the web app that shares one recommender,
+    and one coalescer, per format between all requests. The recommender is
+    loaded on the first request for its format and each request gets a
+    shallow copy of it, so per-request state stays separate while the
+    matrices are shared.
+
+    INPUT:
+        - make_recommender: callable taking a format and returning a CardRecommender
+        - window: float, coalescing window in seconds
+        - max_batch: int, largest batch
+
+    OUTPUT:
+        - factory: callable taking a format and returning a CardRecommender
+    '''
+
+    shared = {}
+    lock = threading.Lock()
+
+    def factory(format):
+        with lock:
+            if format not in shared:
+                recommender = make_recommender(format)
+                recommender.coalescer = RequestCoalescer(recommender.score_batch,
+                                                         window=window, max_batch=max_batch)
+                shared[format] = recommender
+
+        return copy.copy(shared[format])
+
+    return factory
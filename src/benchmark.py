@@ -0,0 +1,766 @@
+import argparse
+import contextlib
+import copy
+import datetime
+import io
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from batching import coalescing_factory
+from catalog import ReflexiveDict
+from predictions import CardRecommender
+
+# modules a serving process must never import, they belong to the batch jobs
+SERVING_FORBIDDEN_MODULES = ['requests', 'bs4', 'boto3', 'pyspark', 'deck_scraping',
+                             'card_scraping', 'image_scraping', 'modeling']
+SERVING_MODULES = ['predictions', 'cardstorm_webapp']
+
+DEFAULT_CARD_COUNTS = [5000, 11348, 50000]
+DEFAULT_RANKS = [10, 30, 160, 360]
+
+def synthetic_card_name(cardstorm_id):
+    '''
+    Makes a digit-free card name for a cardstorm_id. parse_card_string treats
+    digits as the card count, so ids are spelled out in letters.
+
+    INPUT:
+        - cardstorm_id: int
+
+    OUTPUT:
+        - name: string, i.e. 'synthetic bcd'
+    '''
+
+    letters = []
+    while True:
+        cardstorm_id, remainder = divmod(cardstorm_id, 26)
+        letters.append(chr(ord('a') + remainder))
+        if not cardstorm_id:
+            break
+
+    return 'synthetic ' + ''.join(reversed(letters))
+
+def make_catalog(n_cards, fixture_cards=()):
+    '''
+    Builds a card catalog of at least n_cards cards. Fixture cards are kept with
+    their real cardstorm_ids and synthetic cards fill the remaining ids.
+
+    INPUT:
+        - n_cards: int, number of cards in the catalog
+        - fixture_cards: list of (name, cardstorm_id) tuples
+
+    OUTPUT:
+        - cards: list of (name, cardstorm_id) tuples
+    '''
+
+    cards = [(name, int(cardstorm_id)) for name, cardstorm_id in fixture_cards]
+    used_ids = {cardstorm_id for _, cardstorm_id in cards}
+
+    cardstorm_id = 1
+    while len(cards) < n_cards:
+        if cardstorm_id not in used_ids:
+            cards.append((synthetic_card_name(cardstorm_id), cardstorm_id))
+        cardstorm_id += 1
+
+    return cards
+
+def make_feature_matrix(n_cards, rank, seed=0):
+    '''
+    Makes a random item factor matrix shaped like the one read from product_matrices.
+
+    OUTPUT:
+        - feature_matrix: numpy array of shape (n_cards x rank)
+    '''
+
+    random_state = np.random.RandomState(seed)
+
+    return random_state.normal(scale=0.1, size=(n_cards, rank))
+
+def make_deck_lists(cards, n_decks, seed=0, n_archetypes=0):
+    '''
+    Makes plaintext deck lists of 15-25 distinct cards drawn from the catalog.
+    With n_archetypes, like a metagame, all but three cards of every deck come
+    from one of n_archetypes fixed pools of 40 cards.
+
+    OUTPUT:
+        - deck_lists: list of strings, formatted like user submissions
+    '''
+
+    # the pools don't depend on the seed, so decks made with any seed share them
+    pool_state = np.random.RandomState(len(cards))
+    pools = [pool_state.choice(len(cards), size=40, replace=False) for _ in range(n_archetypes)]
+
+    random_state = np.random.RandomState(seed)
+    deck_lists = []
+    for _ in range(n_decks):
+        n_distinct = random_state.randint(15, 26)
+        if pools:
+            pool = pools[random_state.randint(len(pools))]
+            picks = np.unique(np.r_[random_state.choice(pool, size=n_distinct - 3, replace=False),
+                                    random_state.choice(len(cards), size=3, replace=False)])
+        else:
+            picks = random_state.choice(len(cards), size=n_distinct, replace=False)
+        rows = ['{} {}'.format(random_state.randint(1, 5), cards[i][0]) for i in picks]
+        deck_lists.append('\n'.join(rows))
+
+    return deck_lists
+
+def summarize(latencies, wall_time):
+    latencies = np.array(latencies)
+
+    return {'n_requests': len(latencies),
+            'mean_ms': float(latencies.mean() * 1000),
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p95_ms': float(np.percentile(latencies, 95) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'throughput_rps': len(latencies) / wall_time}
+
+def replay_recommender(recommender, deck_lists):
+    latencies = []
+    start_time = time.perf_counter()
+    for deck_list in deck_lists:
+        request_start = time.perf_counter()
+        recommender.recommend(deck_list)
+        latencies.append(time.perf_counter() - request_start)
+
+    return summarize(latencies, time.perf_counter() - start_time)
+
+def replay_app(recommender, deck_lists, threads=1, batch_window_ms=0):
+    from cardstorm_webapp import app
+
+    if batch_window_ms > 0:
+        app.config['RECOMMENDER_FACTORY'] = coalescing_factory(lambda format: recommender,
+                                                               batch_window_ms / 1000, max_batch=64)
+    else:
+        # shallow copies share the matrices but not the per-request deck vectors
+        app.config['RECOMMENDER_FACTORY'] = lambda format: copy.copy(recommender)
+    client = app.test_client()
+    filters = {'land': False, 'white': False, 'blue': False, 'black': False,
+               'red': False, 'green': False, 'colorless': False}
+
+    def post(deck_list):
+        request_start = time.perf_counter()
+        response = client.post('/recommendations', json={'deckList': deck_list, 'filters': filters})
+        assert response.status_code == 200, response.status_code
+        return time.perf_counter() - request_start
+
+    start_time = time.perf_counter()
+    # the route prints every submission, keep that out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        if threads > 1:
+            with multiprocessing.pool.ThreadPool(threads) as pool:
+                latencies = pool.map(post, deck_lists)
+        else:
+            latencies = [post(deck_list) for deck_list in deck_lists]
+
+    return summarize(latencies, time.perf_counter() - start_time)
+
+def run_case(case):
+    '''
+    Runs a single benchmark case. Called in a fresh process so that peak RSS
+    belongs to this case alone.
+
+    INPUT:
+        - case: dictionary, n_cards, rank, target, n_requests, threads, seed,
+                fixture_cards and fixture_decks
+
+    OUTPUT:
+        - result: dictionary, case parameters plus latency, throughput and memory
+    '''
+
+    setup_start = time.perf_counter()
+    cards = make_catalog(case['n_cards'], case['fixture_cards'])
+    card_dict = ReflexiveDict(cards=cards)
+    feature_matrix = make_feature_matrix(len(cards), case['rank'], seed=case['seed'])
+    recommender = CardRecommender(feature_matrix=feature_matrix, card_dict=card_dict,
+                                  quantize=case['quantize'])
+    setup_seconds = time.perf_counter() - setup_start
+
+    deck_lists = list(case['fixture_decks']) or make_deck_lists(cards, case['n_requests'], seed=case['seed'])
+    # cycle the corpus so every case replays the same number of requests
+    deck_lists = [deck_lists[i % len(deck_lists)] for i in range(case['n_requests'])]
+
+    if case['target'] == 'app':
+        result = replay_app(recommender, deck_lists, threads=case['threads'],
+                            batch_window_ms=case['batch_window_ms'])
+    else:
+        result = replay_recommender(recommender, deck_lists)
+
+    result.update({'n_cards': len(cards), 'rank': case['rank'], 'target': case['target'],
+                   'threads': case['threads'], 'batch_window_ms': case['batch_window_ms'],
+                   'quantize': case['quantize'],
+                   'setup_seconds': setup_seconds,
+                   # ru_maxrss is in kilobytes on linux
+                   'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    fixture_cards = []
+    fixture_decks = []
+    if args.cards:
+        with open(args.cards) as f:
+            fixture_cards = json.load(f)
+    if args.decks:
+        with open(args.decks) as f:
+            fixture_decks = json.load(f)
+
+    cases = [{'n_cards': n_cards, 'rank': rank, 'target': target,
+              'n_requests': args.requests, 'threads': args.threads, 'seed': args.seed,
+              'batch_window_ms': args.batch_window_ms, 'quantize': args.quantize,
+              'fixture_cards': fixture_cards, 'fixture_decks': fixture_decks}
+             for n_cards in args.n_cards for rank in args.ranks for target in args.targets]
+
+    results = []
+    # one fresh process per case, spawned so no memory is inherited
+    context = multiprocessing.get_context('spawn')
+    for case in cases:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (case,))
+        print('{target:>9} cards={n_cards:<6} rank={rank:<4} p50={p50_ms:8.2f}ms '
+              'p95={p95_ms:8.2f}ms p99={p99_ms:8.2f}ms {throughput_rps:8.1f} req/s '
+              'rss={peak_rss_mb:.0f}MB'.format(**result))
+        results.append(result)
+
+    report = {'commit': git_commit(),
+              'date': str(datetime.datetime.today()),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.machine(),
+              'cpu_count': multiprocessing.cpu_count(),
+              'corpus': args.decks or 'synthetic',
+              'results': results}
+
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results saved to {}'.format(args.out))
+
+    if args.compare:
+        compare(args.compare, args.out)
+
+def compare(baseline_path, current_path):
+    '''
+    Prints the change in p50/p99 latency and throughput between two result files.
+    '''
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    def key(result):
+        return (result['target'], result['n_cards'], result['rank'], result['threads'],
+                result.get('batch_window_ms', 0), result.get('quantize'))
+
+    baseline_results = {key(result): result for result in baseline['results']}
+    print('comparing {} -> {}'.format(baseline['commit'], current['commit']))
+    for result in current['results']:
+        old = baseline_results.get(key(result))
+        if old is None:
+            continue
+        print('{:>9} cards={:<6} rank={:<4} p50 {:+7.1%} p99 {:+7.1%} throughput {:+7.1%}'.format(
+              result['target'], result['n_cards'], result['rank'],
+              result['p50_ms'] / old['p50_ms'] - 1, result['p99_ms'] / old['p99_ms'] - 1,
+              result['throughput_rps'] / old['throughput_rps'] - 1))
+
+def load_test(args):
+    '''
+    Replays real deck lists against a running server with concurrent clients,
+    i.e. to compare gunicorn worker/thread settings on the serving box.
+    '''
+
+    import urllib.request
+
+    with open(args.decks) as f:
+        deck_lists = json.load(f)
+    deck_lists = [deck_lists[i % len(deck_lists)] for i in range(args.requests)]
+    filters = {'land': False, 'white': False, 'blue': False, 'black': False,
+               'red': False, 'green': False, 'colorless': False}
+
+    def post(deck_list):
+        body = json.dumps({'deckList': deck_list, 'filters': filters}).encode()
+        http_request = urllib.request.Request(args.url.rstrip('/') + '/recommendations', data=body,
+                                              headers={'Content-Type': 'application/json'})
+        request_start = time.perf_counter()
+        with urllib.request.urlopen(http_request) as response:
+            response.read()
+        return time.perf_counter() - request_start
+
+    start_time = time.perf_counter()
+    with multiprocessing.pool.ThreadPool(args.concurrency) as pool:
+        latencies = pool.map(post, deck_lists)
+    result = summarize(latencies, time.perf_counter() - start_time)
+    result.update({'url': args.url, 'concurrency': args.concurrency, 'label': args.label})
+
+    print('{label} concurrency={concurrency} p50={p50_ms:.2f}ms p95={p95_ms:.2f}ms '
+          'p99={p99_ms:.2f}ms {throughput_rps:.1f} req/s'.format(**result))
+
+    report = {'commit': git_commit(), 'date': str(datetime.datetime.today()),
+              'cpu_count': multiprocessing.cpu_count(), 'results': [result]}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+def top10_overlap(expected, found):
+    '''
+    OUTPUT:
+        - overlap: float, mean fraction of each expected top 10 also in the
+                   found top 10
+    '''
+
+    return np.mean([len(set(a) & set(b)) / 10 for a, b in zip(expected, found)])
+
+def measure_import(module_name):
+    '''
+    Imports a module in a fresh interpreter with -X importtime.
+
+    OUTPUT:
+        - import_ms: float, cumulative import time of the module
+        - modules: set of strings, every module imported along the way
+    '''
+
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module_name],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stderr=subprocess.PIPE, check=True).stderr.decode()
+
+    import_ms = None
+    modules = set()
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        modules.add(name)
+        if name == module_name:
+            import_ms = int(cumulative) / 1000
+
+    return import_ms, modules
+
+def check_imports(args):
+    '''
+    Fails if a serving module takes longer than the budget to import, or
+    pulls in any of the scraping/training dependencies.
+    '''
+
+    failures = []
+    for module_name in SERVING_MODULES:
+        import_ms, modules = measure_import(module_name)
+        forbidden = sorted(name for name in modules
+                           if name.split('.')[0] in SERVING_FORBIDDEN_MODULES)
+        print('{}: {:.0f}ms, {} modules'.format(module_name, import_ms, len(modules)))
+
+        if import_ms > args.budget_ms:
+            failures.append('{} took {:.0f}ms to import, budget is {:.0f}ms'.format(
+                            module_name, import_ms, args.budget_ms))
+        if forbidden:
+            failures.append('{} imports {}'.format(module_name, ', '.join(forbidden)))
+
+    for failure in failures:
+        print('FAIL: {}'.format(failure))
+    if failures:
+        sys.exit(1)
+
+def check_quantization(args):
+    '''
+    Compares the top 10 recommendations of the quantized scoring paths to the
+    exact path on the same decks, and fails if the mean overlap is below the
+    threshold. Also reports the factor memory and latency of every path.
+    '''
+
+    fixture_cards = []
+    fixture_decks = []
+    if args.cards:
+        with open(args.cards) as f:
+            fixture_cards = json.load(f)
+    if args.decks:
+        with open(args.decks) as f:
+            fixture_decks = json.load(f)
+
+    failures = []
+    for n_cards in args.n_cards:
+        for rank in args.ranks:
+            cards = make_catalog(n_cards, fixture_cards)
+            card_dict = ReflexiveDict(cards=cards)
+            feature_matrix = make_feature_matrix(len(cards), rank, seed=args.seed)
+            deck_lists = (fixture_decks or make_deck_lists(cards, args.requests, seed=args.seed))[:args.requests]
+
+            exact = CardRecommender(feature_matrix=feature_matrix, card_dict=card_dict)
+            exact_start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                expected = [exact.recommend(deck_list)[:10] for deck_list in deck_lists]
+            exact_ms = (time.perf_counter() - exact_start) / len(deck_lists) * 1000
+            print('{:>8} cards={:<6} rank={:<4} {:8.2f}ms/deck factors={:.1f}MB'.format(
+                  'exact', len(cards), rank, exact_ms, feature_matrix.nbytes / 2**20))
+
+            for quantize in args.quantize:
+                recommender = CardRecommender(feature_matrix=feature_matrix, card_dict=card_dict,
+                                              quantize=quantize, rerank=args.rerank)
+                start_time = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    found = [recommender.recommend(deck_list)[:10] for deck_list in deck_lists]
+                quantized_ms = (time.perf_counter() - start_time) / len(deck_lists) * 1000
+
+                overlap = top10_overlap(expected, found)
+                factors_mb = (recommender.quantized_factors.nbytes + recommender.factor_scales.nbytes
+                              + recommender.feature_matrix.nbytes) / 2**20
+                print('{:>8} cards={:<6} rank={:<4} {:8.2f}ms/deck factors={:.1f}MB '
+                      'top-10 overlap={:.3f}'.format(quantize, len(cards), rank, quantized_ms,
+                                                     factors_mb, overlap))
+
+                if overlap < args.min_overlap:
+                    failures.append('{} cards={} rank={} top-10 overlap {:.3f} < {}'.format(
+                                    quantize, len(cards), rank, overlap, args.min_overlap))
+
+    for failure in failures:
+        print('FAIL: {}'.format(failure))
+    if failures:
+        sys.exit(1)
+
+def make_archetype_recommender(exact, train_decks, n_clusters, n_candidates, min_similarity,
+                               workers=None, seed=0):
+    '''
+    Clusters deck lists into archetypes like the nightly archetypes job.
+
+    INPUT:
+        - exact: CardRecommender, scores every card
+        - train_decks: list of strings, the deck lists clustered
+
+    OUTPUT:
+        - recommender: CardRecommender with the same factors, scoring decks
+                       against the candidate cards of their archetype
+    '''
+
+    import archetypes
+    from scipy import sparse
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        decks = sparse.csr_matrix(np.array([exact._vectorize_deck(exact._deck_to_dict(deck_list))
+                                            for deck_list in train_decks], dtype=np.float32))
+    points = archetypes.deck_factors(decks, exact.feature_matrix)
+    centroids, labels = archetypes.fit_archetypes(points, n_clusters=n_clusters, workers=workers,
+                                                  seed=seed)
+    candidates = archetypes.candidate_lists(exact.feature_matrix, centroids, n_candidates=n_candidates)
+
+    recommender = CardRecommender(feature_matrix=exact.feature_matrix, card_dict=exact.card_dict,
+                                  min_similarity=min_similarity)
+    recommender.use_archetypes(centroids, candidates)
+
+    return recommender
+
+def check_archetypes(args):
+    '''
+    Clusters one set of decks into archetypes, then replays other decks and
+    compares their top 10 recommendations from the archetype candidate pools
+    to the exact path. Fails if the mean overlap is below the threshold.
+    '''
+
+    fixture_cards = []
+    fixture_decks = []
+    if args.cards:
+        with open(args.cards) as f:
+            fixture_cards = json.load(f)
+    if args.decks:
+        with open(args.decks) as f:
+            fixture_decks = json.load(f)
+
+    cards = make_catalog(args.n_cards, fixture_cards)
+    card_dict = ReflexiveDict(cards=cards)
+    feature_matrix = make_feature_matrix(len(cards), args.rank, seed=args.seed)
+    exact = CardRecommender(feature_matrix=feature_matrix, card_dict=card_dict)
+
+    if fixture_decks:
+        # cluster the older decks and replay the most recent ones
+        train_decks, test_decks = fixture_decks[:-args.requests], fixture_decks[-args.requests:]
+    else:
+        train_decks = make_deck_lists(cards, args.train_decks, seed=args.seed + 1,
+                                      n_archetypes=args.synthetic_archetypes)
+        test_decks = make_deck_lists(cards, args.requests, seed=args.seed,
+                                     n_archetypes=args.synthetic_archetypes)
+
+    start_time = time.perf_counter()
+    recommender = make_archetype_recommender(exact, train_decks, n_clusters=args.clusters,
+                                             n_candidates=args.candidates,
+                                             min_similarity=args.min_similarity,
+                                             workers=args.workers, seed=args.seed)
+    print('clustered {} decks into {} archetypes in {:.1f}s'.format(
+          len(train_decks), len(recommender.archetype_centroids), time.perf_counter() - start_time))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        exact_start = time.perf_counter()
+        expected = [exact.recommend(deck_list)[:10] for deck_list in test_decks]
+        exact_ms = (time.perf_counter() - exact_start) / len(test_decks) * 1000
+
+        found = []
+        n_fallbacks = 0
+        start_time = time.perf_counter()
+        for deck_list in test_decks:
+            found.append(recommender.recommend(deck_list)[:10])
+            n_fallbacks += recommender.archetype is None
+        archetype_ms = (time.perf_counter() - start_time) / len(test_decks) * 1000
+
+    overlap = top10_overlap(expected, found)
+    print('exact {:.2f}ms/deck, archetypes {:.2f}ms/deck, fallback rate {:.1%}, '
+          'top-10 overlap={:.3f}'.format(exact_ms, archetype_ms, n_fallbacks / len(test_decks),
+                                         overlap))
+
+    if overlap < args.min_overlap:
+        print('FAIL: top-10 overlap {:.3f} < {}'.format(overlap, args.min_overlap))
+        sys.exit(1)
+
+def make_stale_run_database(n_cards, rank, seed=0, format='modern'):
+    '''
+    Fills a new embedded database with a catalog of n_cards cards, decks and
+    a promoted model run of the format trained on them, then adds one card
+    the run doesn't know, as the nightly card scrape does before training.
+
+    OUTPUT:
+        - cards: list of (name, cardstorm_id) tuples, the new card last
+    '''
+
+    import db
+    import migrations
+    import model_runs
+
+    cards = make_catalog(n_cards + 1)
+    trained_cards, new_card = cards[:-1], cards[-1]
+    random_state = np.random.RandomState(seed)
+
+    def card_row(name, cardstorm_id):
+        # every fifth card isn't legal in the format
+        legalities = ['legacy'] if cardstorm_id % 5 == 0 else [format, 'legacy']
+        return (cardstorm_id, name, 1, 'Creature', '{R}', ['R'], ['R'], legalities, 'normal')
+
+    insert_card = '''INSERT INTO cards (cardstorm_id, name, cmc, type_line, mana_cost, colors,
+                                         color_identity, legalities, layout)
+                     VALUES %s'''
+    with db.transaction() as cursor:
+        migrations.migrate(cursor)
+        for card in trained_cards:
+            cursor.execute(insert_card, [card_row(*card)])
+
+        deck_rows = []
+        for deck_id, deck_list in enumerate(make_deck_lists(trained_cards, 50, seed=seed)):
+            for row in deck_list.split('\n'):
+                card_count, name = row.split(' ', 1)
+                deck_rows.append((1, deck_id, dict(trained_cards)[name], int(card_count), format))
+        # the illegal cards are the most played, the format's recommendations must skip them
+        deck_rows.extend((1, 1000, cardstorm_id, 100, format)
+                         for _, cardstorm_id in trained_cards if cardstorm_id % 5 == 0)
+        cursor.execute('''INSERT INTO decks (event_id, deck_id, cardstorm_id, card_count, format)
+                          VALUES {}'''.format(', '.join(['%s'] * len(deck_rows))), deck_rows)
+
+        run_id = model_runs.start_run(cursor, rank=rank, format=format)
+        factors = make_feature_matrix(len(trained_cards), rank, seed=seed)
+        for (_, cardstorm_id), features in zip(trained_cards, factors):
+            cursor.execute('''INSERT INTO product_matrices (cardstorm_id, features, date, run_id)
+                              VALUES (%s, %s, %s, %s)''',
+                           [cardstorm_id, list(features), datetime.date.today(), run_id])
+        model_runs.mark_ready(cursor, run_id)
+        model_runs.promote_run(cursor, run_id)
+
+    with db.transaction() as cursor:
+        cursor.execute(insert_card, [card_row(*new_card)])
+
+    return cards
+
+def check_stale_run(args):
+    '''
+    Serves a promoted model run older than the card catalog from a new
+    embedded database, and fails if recommending with the card added since
+    the run errors, if a deck or an empty deck list is recommended a card
+    that isn't legal in the format, or if /readyz doesn't tell an aligned
+    factor matrix from a misaligned one.
+    '''
+
+    import db
+    import embedded
+
+    if not db.embedded() or os.path.exists(embedded.database_path()):
+        print('FAIL: run with CARDSTORM_DB_BACKEND=duckdb and CARDSTORM_DB_PATH naming a new file')
+        sys.exit(1)
+
+    cards = make_stale_run_database(args.n_cards, args.rank, seed=args.seed, format=args.format)
+    new_name, new_id = cards[-1]
+
+    failures = []
+    recommender = CardRecommender(format=args.format)
+    if recommender.feature_matrix.shape[0] != len(recommender.all_cardstorm_ids):
+        failures.append('{} factor rows for {} cards'.format(recommender.feature_matrix.shape[0],
+                                                             len(recommender.all_cardstorm_ids)))
+
+    deck_list = '\n'.join(['4 {}'.format(new_name)]
+                          + ['2 {}'.format(name) for name, _ in cards[1:20]])
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            recommendations = recommender.recommend(deck_list)
+        except Exception as error:
+            failures.append('recommend with the new card failed: {!r}'.format(error))
+            recommendations = []
+    illegal = [int(cardstorm_id) for cardstorm_id in recommendations[:10] if cardstorm_id % 5 == 0]
+    if illegal:
+        failures.append('recommended cards not legal in {}: {}'.format(args.format, illegal))
+
+    # an empty deck gets the format's most played cards, the illegal ones are played most
+    with contextlib.redirect_stdout(io.StringIO()):
+        popular = recommender.recommend('')
+    illegal = [int(cardstorm_id) for cardstorm_id in popular[:10] if cardstorm_id % 5 == 0]
+    if len(popular) < 10 or illegal:
+        failures.append('empty deck got {} recommendations, not legal in {}: {}'.format(
+                        len(popular), args.format, illegal))
+    print('served a run trained on {} cards with {} cards in the catalog, top 10 {}'.format(
+          len(cards) - 1, len(cards), [int(_) for _ in recommendations[:10]]))
+
+    from cardstorm_webapp import create_app
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = create_app(recommender=recommender).test_client().get('/readyz')
+    if response.status_code != 200:
+        failures.append('/readyz answered {} serving the aligned run'.format(response.status_code))
+
+    # a matrix one row short of the catalog must not be reported ready
+    recommender.feature_matrix = recommender.feature_matrix[:-1]
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = create_app(recommender=recommender).test_client().get('/readyz')
+    if response.status_code != 503:
+        failures.append('/readyz answered {} with a factor row missing'.format(response.status_code))
+
+    for failure in failures:
+        print('FAIL: {}'.format(failure))
+    if failures:
+        sys.exit(1)
+
+def export_fixtures(args):
+    '''
+    Writes the card catalog and the most recent real deck lists from the db to
+    json fixture files, so benchmarks can replay real decks without the db.
+    '''
+
+    import db
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT name, cardstorm_id FROM cards ORDER BY cardstorm_id')
+        cards = cursor.fetchall()
+
+        cursor.execute('''SELECT decks.deck_id, decks.card_count, cards.name
+                          FROM decks
+                          JOIN cards ON cards.cardstorm_id = decks.cardstorm_id
+                          WHERE decks.deck_id IN (SELECT DISTINCT deck_id FROM decks
+                                                  ORDER BY deck_id DESC LIMIT %s)
+                          ORDER BY decks.deck_id''', [args.n_decks])
+        deck_rows = {}
+        for deck_id, card_count, name in cursor.fetchall():
+            deck_rows.setdefault(deck_id, []).append('{} {}'.format(card_count, name))
+
+    with open(args.cards, 'w') as f:
+        json.dump(cards, f)
+    with open(args.decks, 'w') as f:
+        json.dump(['\n'.join(rows) for rows in deck_rows.values()], f)
+
+    print('exported {} cards and {} decks'.format(len(cards), len(deck_rows)))
+
+def main():
+    parser = argparse.ArgumentParser(description='cardstorm serving benchmarks')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run the latency/throughput benchmarks')
+    run_parser.add_argument('--n-cards', type=int, nargs='+', default=DEFAULT_CARD_COUNTS)
+    run_parser.add_argument('--ranks', type=int, nargs='+', default=DEFAULT_RANKS)
+    run_parser.add_argument('--targets', nargs='+', choices=['recommend', 'app'],
+                            default=['recommend', 'app'])
+    run_parser.add_argument('--requests', type=int, default=100)
+    run_parser.add_argument('--threads', type=int, default=1,
+                            help='concurrent clients for the app target')
+    run_parser.add_argument('--batch-window-ms', type=float, default=0,
+                            help='coalesce concurrent app requests within this window')
+    run_parser.add_argument('--quantize', choices=['float16', 'int8'],
+                            help='score with quantized item factors')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--cards', help='json fixture of [name, cardstorm_id] pairs')
+    run_parser.add_argument('--decks', help='json fixture of plaintext deck lists to replay')
+    run_parser.add_argument('--out', default='bench_results.json')
+    run_parser.add_argument('--compare', help='earlier results file to compare against')
+    run_parser.set_defaults(function=run)
+
+    load_parser = subparsers.add_parser('load', help='load test a running server')
+    load_parser.add_argument('--url', default='http://localhost:8000')
+    load_parser.add_argument('--decks', required=True, help='json fixture of deck lists')
+    load_parser.add_argument('--requests', type=int, default=2000)
+    load_parser.add_argument('--concurrency', type=int, default=32)
+    load_parser.add_argument('--label', default='', help='i.e. the worker/thread setting tested')
+    load_parser.add_argument('--out', default='bench_load.json')
+    load_parser.set_defaults(function=load_test)
+
+    imports_parser = subparsers.add_parser('imports', help='check the serving import budget')
+    imports_parser.add_argument('--budget-ms', type=float, default=500)
+    imports_parser.set_defaults(function=check_imports)
+
+    quantization_parser = subparsers.add_parser('quantization',
+                                                help='check quantized top-10 overlap with the exact path')
+    quantization_parser.add_argument('--n-cards', type=int, nargs='+', default=[11348])
+    quantization_parser.add_argument('--ranks', type=int, nargs='+', default=DEFAULT_RANKS)
+    quantization_parser.add_argument('--quantize', nargs='+', choices=['float16', 'int8'],
+                                     default=['float16', 'int8'])
+    quantization_parser.add_argument('--rerank', type=int, default=300)
+    quantization_parser.add_argument('--requests', type=int, default=100)
+    quantization_parser.add_argument('--min-overlap', type=float, default=0.95)
+    quantization_parser.add_argument('--seed', type=int, default=0)
+    quantization_parser.add_argument('--cards', help='json fixture of [name, cardstorm_id] pairs')
+    quantization_parser.add_argument('--decks', help='json fixture of plaintext deck lists to replay')
+    quantization_parser.set_defaults(function=check_quantization)
+
+    archetypes_parser = subparsers.add_parser('archetypes',
+                                              help='check archetype top-10 overlap with the exact path')
+    archetypes_parser.add_argument('--n-cards', type=int, default=11348)
+    archetypes_parser.add_argument('--rank', type=int, default=30)
+    archetypes_parser.add_argument('--clusters', type=int, default=40)
+    archetypes_parser.add_argument('--candidates', type=int, default=1000)
+    archetypes_parser.add_argument('--min-similarity', type=float, default=0.5)
+    archetypes_parser.add_argument('--workers', type=int, default=None)
+    archetypes_parser.add_argument('--train-decks', type=int, default=5000,
+                                   help='synthetic decks to cluster')
+    archetypes_parser.add_argument('--synthetic-archetypes', type=int, default=40,
+                                   help='card pools the synthetic decks are drawn from')
+    archetypes_parser.add_argument('--requests', type=int, default=200)
+    archetypes_parser.add_argument('--min-overlap', type=float, default=0.9)
+    archetypes_parser.add_argument('--seed', type=int, default=0)
+    archetypes_parser.add_argument('--cards', help='json fixture of [name, cardstorm_id] pairs')
+    archetypes_parser.add_argument('--decks', help='json fixture of plaintext deck lists, '
+                                                   'the last --requests are replayed')
+    archetypes_parser.set_defaults(function=check_archetypes)
+
+    stale_parser = subparsers.add_parser('stale-run', help='check serving a run older than the '
+                                         'card catalog, on a new embedded database')
+    stale_parser.add_argument('--n-cards', type=int, default=500)
+    stale_parser.add_argument('--rank', type=int, default=10)
+    stale_parser.add_argument('--format', default='modern')
+    stale_parser.add_argument('--seed', type=int, default=0)
+    stale_parser.set_defaults(function=check_stale_run)
+
+    export_parser = subparsers.add_parser('export', help='export real cards and decks from the db')
+    export_parser.add_argument('--n-decks', type=int, default=500)
+    export_parser.add_argument('--cards', default='bench_cards.json')
+    export_parser.add_argument('--decks', default='bench_decks.json')
+    export_parser.set_defaults(function=export_fixtures)
+
+    args = parser.parse_args()
+    args.function(args)
+
+if __name__ == '__main__':
+    main()
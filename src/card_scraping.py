@@ -1,8 +1,12 @@
-import requests
 import json
 import psycopg2
-import os
+import checkpoint
+import db
+import http_cache
+import job_metrics
 import datetime
+import urllib.parse
+from catalog import FORMATS
 
 def format_card(card):
     '''
@@ -173,54 +177,76 @@ def upload_card(card, cursor, verbose=False):
 
     template = ', '.join(['%s'] * len(card))
 
+    # a known card keeps its cardstorm_id, but cards get banned and unbanned
     query = '''INSERT INTO cards (name, cmc, type_line, oracle_text, mana_cost, power, toughness, colors,
                               color_identity, legalities, set_id, set_name, collector_number, scryfall_id, layout)
-           VALUES ({})'''.format(template)
+           VALUES ({})
+           ON CONFLICT (name) DO UPDATE SET legalities = EXCLUDED.legalities'''.format(template)
 
     try:
         cursor.execute(query, card)
         return True
 
     except psycopg2.IntegrityError:
-        if verbose: print('duplicate card detected')
+        if verbose: print('card rejected')
         return False
 
-def scrape_modern_cards(verbose=False):
+def scrape_cards(formats=FORMATS, verbose=False):
+    '''
+    Adds every card legal in any of the formats to the one shared cards
+    table. Each card's legalities say which formats it can be recommended in.
+    '''
     if verbose:
         print('#####################################################')
         print('SCRAPING CARDS: {}'.format(datetime.datetime.today()))
-    hostname = os.environ['CARDSTORM_DB_HOST']
-    dbname = os.environ['CARDSTORM_DB_DBNAME']
-    username = os.environ['CARDSTORM_DB_USERNAME']
-    password = os.environ['CARDSTORM_DB_PASSWORD']
-
-    conn = psycopg2.connect('dbname={} host={} user={} password={}'.format(dbname, hostname, username, password))
-    cursor = conn.cursor()
-
-    url = 'https://api.scryfall.com/cards/search?q=format:modern'
-
-    while True:
-        if verbose: print('requsting scryfall api')
-        response = requests.get(url)
-        json_response = json.loads(response.text)
-
-        if verbose: print('processing cards')
-        for i, raw_card in enumerate(json_response['data']):
-            if verbose: print('{}, "{}"'.format(i, raw_card['name']))
-            card = format_card(raw_card)
-            status = upload_card(card, cursor, verbose=verbose)
-
-            if status:
-                conn.commit()
-            else:
-                conn.rollback()
-                cursor = conn.cursor()
-        if not json_response['has_more']:
-            if verbose: print('all done!')
-            break
-
-        if verbose: print('getting new url')
-        url = json_response['next_page']
+    job_metrics.start('card_scraping')
+    search = ' or '.join('format:{}'.format(format) for format in formats)
+    url = 'https://api.scryfall.com/cards/search?q={}'.format(urllib.parse.quote('({})'.format(search)))
+    # the page an earlier attempt of this pipeline run stopped at
+    url = checkpoint.load('cards', {}).get('next_page', url)
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+
+        while True:
+            if verbose: print('requsting scryfall api')
+            response = http_cache.get(url)
+            if response.status_code != 200 or not response.content:
+                # i.e. a page missing from the cache when offline: no more cards,
+                # and the checkpoint keeps the page this run stopped at
+                print('scryfall answered {} for {}, stopping'.format(response.status_code, url))
+                job_metrics.count('http_failures')
+                break
+            with job_metrics.timed('parse'):
+                json_response = json.loads(response.text)
+
+            if verbose: print('processing cards')
+            for i, raw_card in enumerate(json_response['data']):
+                if verbose: print('{}, "{}"'.format(i, raw_card['name']))
+                with job_metrics.timed('parse'):
+                    card = format_card(raw_card)
+                with job_metrics.timed('db'):
+                    status = upload_card(card, cursor, verbose=verbose)
+
+                    if status:
+                        conn.commit()
+                    else:
+                        conn.rollback()
+                        cursor = conn.cursor()
+                job_metrics.count('rows_upserted' if status else 'rejected_cards')
+            if not json_response['has_more']:
+                if verbose: print('all done! http cache: {}'.format(http_cache.STATS))
+                checkpoint.clear('cards')
+                break
+
+            if verbose: print('getting new url')
+            url = json_response['next_page']
+            checkpoint.save('cards', {'next_page': url})
+
+    report_path = job_metrics.write()
+    if verbose: print('run report: {}'.format(report_path))
+    evicted = http_cache.evict()
+    if verbose: print('http cache: evicted {} pages'.format(evicted))
 
 if __name__ == '__main__':
-    scrape_modern_cards(True)
+    scrape_cards(verbose=True)
@@ -1,14 +1,255 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Blueprint, Flask, render_template, request, jsonify, Response, g, current_app
 from predictions import CardRecommender
+from batching import coalescing_factory
+from catalog import DEFAULT_FORMAT, CardColumns, ReflexiveDict, get_formats
+from model_runs import get_current_run_id
+import copy
+import db
+import functools
+import hmac
+import metrics
+import os
 import time
+from profiling import PROFILER
 
-app = Flask(__name__)
+# set CARDSTORM_SERVER_TIMING=1 to attach per-stage timings to every response
+SERVER_TIMING = os.environ.get('CARDSTORM_SERVER_TIMING', '0') == '1'
 
-@app.route('/')
+# set CARDSTORM_BATCH_WINDOW_MS (i.e. 3) to solve concurrent requests together
+BATCH_WINDOW_MS = float(os.environ.get('CARDSTORM_BATCH_WINDOW_MS', 0))
+BATCH_MAX_SIZE = int(os.environ.get('CARDSTORM_BATCH_MAX_SIZE', 64))
+
+# set CARDSTORM_QUANTIZE to float16 or int8 to score with quantized item factors,
+# the best CARDSTORM_RERANK candidates are re-scored with the exact factors
+QUANTIZE = os.environ.get('CARDSTORM_QUANTIZE') or None
+RERANK = int(os.environ.get('CARDSTORM_RERANK', 300))
+
+# set CARDSTORM_ARCHETYPES=1 to score decks against their archetype's candidate
+# cards, decks less similar than CARDSTORM_ARCHETYPE_MIN_SIMILARITY score every card
+ARCHETYPES = os.environ.get('CARDSTORM_ARCHETYPES', '0') == '1'
+ARCHETYPE_MIN_SIMILARITY = float(os.environ.get('CARDSTORM_ARCHETYPE_MIN_SIMILARITY', 0.5))
+
+# set CARDSTORM_EXPLANATIONS=1 to load the card partners, requests with
+# "explain": true then get "often played with" reasons for every card
+EXPLANATIONS = os.environ.get('CARDSTORM_EXPLANATIONS', '0') == '1'
+
+# set CARDSTORM_ADMIN_TOKEN to serve the /admin endpoints, requests must send
+# it as "Authorization: Bearer <token>"
+ADMIN_TOKEN = os.environ.get('CARDSTORM_ADMIN_TOKEN') or None
+
+cardstorm = Blueprint('cardstorm', __name__)
+
+def create_app(recommender=None, preload=False):
+    '''
+    Makes the cardstorm Flask app.
+
+    INPUT:
+        - recommender: CardRecommender, loaded recommender shared by all requests
+                       for its format
+        - preload: bool, if True and no recommender is given, the promoted model
+                   of every format in CARDSTORM_FORMATS and the card catalog are
+                   loaded now. Otherwise they are loaded from the db on every request.
+
+    OUTPUT:
+        - app: Flask app
+    '''
+
+    app = Flask(__name__)
+    app.register_blueprint(cardstorm)
+
+    load_recommender = functools.partial(CardRecommender, quantize=QUANTIZE, rerank=RERANK,
+                                         archetypes=ARCHETYPES,
+                                         min_similarity=ARCHETYPE_MIN_SIMILARITY,
+                                         partners=EXPLANATIONS)
+
+    recommenders = {}
+    if recommender is not None:
+        recommenders[recommender.format] = recommender
+    elif preload:
+        # one catalog shared by every format's recommender
+        card_dict = ReflexiveDict()
+        card_columns = CardColumns()
+        for format in get_formats():
+            try:
+                recommenders[format] = load_recommender(format=format, card_dict=card_dict,
+                                                        card_columns=card_columns)
+            except ValueError as error:
+                print('not serving {}: {}'.format(format, error))
+        if not recommenders:
+            raise ValueError('no promoted model run for any of {}'.format(get_formats()))
+
+    if recommenders:
+        # shallow copies share the matrices but not the per-request deck vectors
+        make_recommender = lambda format: recommenders[format]
+        factory = lambda format: copy.copy(recommenders[format])
+    else:
+        make_recommender = factory = lambda format: load_recommender(format=format)
+
+    if BATCH_WINDOW_MS > 0:
+        if QUANTIZE is not None:
+            print('CARDSTORM_BATCH_WINDOW_MS has no effect with CARDSTORM_QUANTIZE, '
+                  'quantized requests are scored one at a time')
+        factory = coalescing_factory(make_recommender, BATCH_WINDOW_MS / 1000, BATCH_MAX_SIZE)
+
+    # empty when models are loaded per request
+    app.config['RECOMMENDERS'] = recommenders
+    # called with the format once per request, swapped out by the benchmarks
+    app.config['RECOMMENDER_FACTORY'] = factory
+
+    return app
+
+def get_request_recommender(user_submission):
+    '''
+    Makes the recommender for the format a request asks for, the default
+    format if it doesn't say.
+
+    OUTPUT:
+        - recommender: CardRecommender, None if the format isn't served
+    '''
+
+    format = user_submission.get('format', DEFAULT_FORMAT)
+    recommenders = current_app.config['RECOMMENDERS']
+    if format not in get_formats() or (recommenders and format not in recommenders):
+        return None
+
+    try:
+        return current_app.config['RECOMMENDER_FACTORY'](format)
+    except ValueError as error:
+        # loaded per request: the format has no promoted run yet
+        print('not serving {}: {}'.format(format, error))
+        return None
+
+@cardstorm.before_app_request
+def start_request_trace():
+    g.start_time = time.perf_counter()
+    g.profiled = PROFILER.start_request()
+    metrics.start_trace()
+
+@cardstorm.after_app_request
+def finish_request_trace(response):
+    spans = metrics.finish_trace()
+    elapsed = time.perf_counter() - g.start_time
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint)
+    metrics.publish()
+
+    if SERVER_TIMING:
+        spans.append(('total', elapsed))
+        response.headers['Server-Timing'] = metrics.server_timing_header(spans)
+
+    return response
+
+@cardstorm.teardown_app_request
+def finish_request_profile(error):
+    if g.get('profiled'):
+        PROFILER.finish_request()
+
+def admin_only(view):
+    '''
+    Serves the view only to requests bearing CARDSTORM_ADMIN_TOKEN. Without a
+    token configured the admin endpoints don't exist.
+    '''
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if ADMIN_TOKEN is None:
+            return jsonify({'error': 'not found'}), 404
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), 'Bearer {}'.format(ADMIN_TOKEN).encode()):
+            return jsonify({'error': 'unauthorized'}), 401
+        return view(*args, **kwargs)
+
+    return wrapper
+
+@cardstorm.route('/admin/profile', methods=['GET', 'POST'])
+@admin_only
+def profile():
+    '''
+    GET reports the profiler of every worker. POST turns it on or off in every
+    worker and sets the fraction of requests sampled, i.e. {"enabled": true,
+    "rate": 0.05}, and {"reset": true} drops the samples collected so far.
+    '''
+
+    # another worker may have changed the settings since this one last looked
+    PROFILER.sync(force=True)
+    if request.method == 'POST':
+        settings = request.get_json(silent=True) or {}
+        if settings.get('reset'):
+            PROFILER.reset()
+        if 'enabled' in settings:
+            if settings['enabled']:
+                PROFILER.enable(rate=float(settings['rate']) if 'rate' in settings else None,
+                                interval=(float(settings['interval_ms']) / 1000
+                                          if 'interval_ms' in settings else None))
+            else:
+                PROFILER.disable()
+        elif 'rate' in settings:
+            PROFILER.set_rate(float(settings['rate']))
+
+    return jsonify(PROFILER.status())
+
+@cardstorm.route('/admin/profile/folded')
+@admin_only
+def profile_folded():
+    '''
+    The collected stacks in folded form, i.e. for flamegraph.pl or speedscope.
+    '''
+
+    return Response(PROFILER.folded(), mimetype='text/plain')
+
+@cardstorm.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/recommendations', methods = ['POST'])
+@cardstorm.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@cardstorm.route('/healthz')
+def liveness():
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@cardstorm.route('/readyz')
+def readiness():
+    '''
+    Ready once a model can be served. Reports the run_id served for every
+    format: the preloaded ones, or the promoted ones when models are loaded
+    per request. Not ready if a preloaded model has a factor row count other
+    than the number of cards in the catalog.
+    '''
+
+    recommenders = current_app.config['RECOMMENDERS']
+    if recommenders:
+        # every request fails if the factor rows don't line up with the catalog
+        misaligned = [format for format, recommender in recommenders.items()
+                      if recommender.feature_matrix.shape[0] != len(recommender.all_cardstorm_ids)]
+        if misaligned:
+            return jsonify({'status': 'unavailable',
+                            'error': 'factor rows do not match the card catalog for {}'.format(
+                                     ', '.join(misaligned))}), 503
+
+        formats = {format: {'run_id': recommender.run_id,
+                            'n_cards': len(recommender.all_cardstorm_ids),
+                            'rank': recommender.feature_matrix.shape[1],
+                            'archetypes': (0 if recommender.archetype_centroids is None
+                                           else len(recommender.archetype_centroids))}
+                   for format, recommender in recommenders.items()}
+        return jsonify({'status': 'ready', 'preloaded': True, 'formats': formats})
+
+    try:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            formats = {format: {'run_id': get_current_run_id(cursor, format=format)}
+                       for format in get_formats()}
+    except Exception as error:
+        return jsonify({'status': 'unavailable', 'error': str(error)}), 503
+
+    formats = {format: run for format, run in formats.items() if run['run_id'] is not None}
+    if not formats:
+        return jsonify({'status': 'unavailable', 'error': 'no promoted model run'}), 503
+
+    return jsonify({'status': 'ready', 'preloaded': False, 'formats': formats})
+
+@cardstorm.route('/recommendations', methods = ['POST'])
 def get_recommendations():
     start_time = time.time()
     user_submission = request.json
@@ -18,7 +259,9 @@ def get_recommendations():
 
     print('\t{}'.format(raw_deck_list))
     print('\t{}'.format(filters))
-    card_recommender = CardRecommender()
+    card_recommender = get_request_recommender(user_submission)
+    if card_recommender is None:
+        return jsonify({'error': 'format {} is not served'.format(user_submission.get('format'))}), 404
     recommendations = card_recommender.recommend(raw_deck_list, land_filter=filters['land'],
                         white_filter=filters['white'], blue_filter=filters['blue'],
                         black_filter=filters['black'], red_filter=filters['red'],
@@ -26,11 +269,35 @@ def get_recommendations():
 
     card_images = [f'http://mtg-capstone.s3-website-us-west-2.amazonaws.com/card_images/jpg/{cardstorm_id}.jpg' for cardstorm_id in recommendations[:10]]
 
+    if user_submission.get('explain'):
+        reasons = card_recommender.explain(recommendations[:10])
+        card_images = [{'cardstorm_id': int(cardstorm_id), 'image': image, 'reasons': card_reasons}
+                       for cardstorm_id, image, card_reasons
+                       in zip(recommendations[:10], card_images, reasons)]
+
     end_time = time.time()
 
     print('\t\telapsed time: {}'.format(end_time - start_time))
+    if user_submission.get('stats'):
+        return jsonify({'recommendations': card_images, 'stats': card_recommender.deck_stats()})
+
     return jsonify(card_images)
 
+@cardstorm.route('/deck/stats', methods = ['POST'])
+def get_deck_stats():
+    '''
+    Mana curve, colors, land count and card types of a deck list, without
+    making recommendations.
+    '''
+
+    card_recommender = get_request_recommender(request.json)
+    if card_recommender is None:
+        return jsonify({'error': 'format {} is not served'.format(request.json.get('format'))}), 404
+
+    return jsonify(card_recommender.deck_stats(request.json['deckList']))
+
+# development app, loads the model from the db on every request
+app = create_app()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', threaded=True)
@@ -0,0 +1,268 @@
+"""
+Card catalog and deck list parsing shared by the web app and the scrapers.
+Kept free of scraping dependencies so serving processes import only what
+they need.
+"""
+import os
+import re
+import numpy as np
+import db
+
+# formats with their own decks and model, the first one is served by default
+FORMATS = ('modern', 'standard', 'pioneer', 'legacy')
+DEFAULT_FORMAT = FORMATS[0]
+
+def get_formats():
+    '''
+    Gets the formats to scrape, train and serve, CARDSTORM_FORMATS=modern,legacy
+    picks a subset.
+
+    OUTPUT:
+        - formats: list of strings
+    '''
+
+    formats = [format.strip() for format in
+               os.environ.get('CARDSTORM_FORMATS', ','.join(FORMATS)).split(',') if format.strip()]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError('unknown formats {}, expected some of {}'.format(sorted(unknown), FORMATS))
+
+    return formats
+
+class ReflexiveDict():
+
+    def __init__(self, cards=None):
+        '''
+        INPUT:
+            - cards: iterable of (name, cardstorm_id) tuples. If None, all cards
+                     are read from the cards table.
+        '''
+        self._dict = {}
+        if cards is None:
+            self._get_cards()
+        else:
+            for name, cardstorm_id in cards:
+                self[name] = cardstorm_id
+
+    def __setitem__(self, key, val):
+        self._dict[key] = val
+        self._dict[val] = key
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def keys(self):
+        return self._dict.keys()
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def _get_cards(self):
+        query = '''SELECT name, cardstorm_id
+                   FROM cards'''
+
+        with db.connection() as conn_:
+            cursor_ = conn_.cursor()
+            try:
+                db.execute_prepared(cursor_, 'card_names', query)
+
+                for name, cardstorm_id in cursor_.fetchall():
+                    self[name] = cardstorm_id
+            except:
+                return False
+
+        return True
+
+    def __len__(self):
+        return len(self._dict)
+
+    def get_cardstorm_ids(self):
+        all_cardstorm_ids = [key for key in self.keys() if isinstance(key, int)]
+
+        return np.array(sorted(all_cardstorm_ids))
+
+
+COLORS = 'WUBRG'
+CARD_TYPES = ('Land', 'Creature', 'Instant', 'Sorcery', 'Artifact', 'Enchantment',
+              'Planeswalker')
+# mana values of 7 and up share the last bucket of the curve
+MAX_CURVE_CMC = 7
+
+class CardColumns():
+    '''
+    Columnar copy of the card attributes deck statistics need, one NumPy
+    array per attribute, rows ordered by cardstorm_id. Colors and card types
+    are bit flags, so a deck's statistics are a handful of array operations.
+    '''
+
+    def __init__(self, cards=None):
+        '''
+        INPUT:
+            - cards: iterable of (cardstorm_id, cmc, type_line, mana_cost, colors,
+                     layout, legalities) tuples. If None, they are read from the
+                     cards table. legalities may be left out.
+        '''
+        if cards is None:
+            cards = self._get_cards()
+        cards = sorted(cards, key=lambda card: card[0])
+
+        self.cardstorm_ids = np.array([card[0] for card in cards], dtype=np.int64)
+        self.cmc = np.array([card[1] or 0 for card in cards], dtype=np.float32)
+        self.color_bits = np.array([_color_bits(card[4]) for card in cards], dtype=np.uint8)
+        self.type_bits = np.array([_type_bits(card[2]) for card in cards], dtype=np.uint16)
+        # colored mana symbols per card, one column per color in COLORS
+        self.pips = np.array([_pips(card[3]) for card in cards], dtype=np.int16).reshape(-1, len(COLORS))
+        self.legal_bits = np.array([_legal_bits(card[6] if len(card) > 6 else None)
+                                    for card in cards], dtype=np.uint8)
+        self.layouts = sorted({card[5] or 'normal' for card in cards})
+        self.layout_codes = np.array([self.layouts.index(card[5] or 'normal') for card in cards],
+                                     dtype=np.int8)
+
+    def _get_cards(self):
+        query = '''SELECT cardstorm_id, cmc, type_line, mana_cost, colors, layout, legalities
+                   FROM cards'''
+
+        with db.connection() as conn_:
+            cursor_ = conn_.cursor()
+            db.execute_prepared(cursor_, 'card_columns', query)
+
+            return cursor_.fetchall()
+
+    def __len__(self):
+        return len(self.cardstorm_ids)
+
+    def is_type(self, card_type):
+        '''
+        OUTPUT:
+            - mask: boolean numpy array, True for the cards of card_type
+        '''
+        return (self.type_bits & (1 << CARD_TYPES.index(card_type))) > 0
+
+    def legal_mask(self, format, cardstorm_ids):
+        '''
+        INPUT:
+            - format: string, one of FORMATS
+            - cardstorm_ids: sorted numpy array, i.e. all_cardstorm_ids
+
+        OUTPUT:
+            - mask: boolean numpy array aligned with cardstorm_ids, True for the
+                    cards legal in format. None if no legalities were loaded.
+        '''
+
+        if not self.legal_bits.any():
+            return None
+
+        rows = np.minimum(np.searchsorted(self.cardstorm_ids, cardstorm_ids), len(self) - 1)
+        found = self.cardstorm_ids[rows] == cardstorm_ids
+
+        return found & ((self.legal_bits[rows] & (1 << FORMATS.index(format))) > 0)
+
+    def deck_stats(self, deck_dict):
+        '''
+        Computes the statistics of a parsed deck.
+
+        INPUT:
+            - deck_dict: dictionary, cardstorm ids as keys and card counts as values
+
+        OUTPUT:
+            - stats: dictionary with
+                - n_cards: int, cards in the deck
+                - n_lands: int, land cards in the deck
+                - average_cmc: float, average mana value of the nonland cards
+                - curve: list of ints, nonland cards per mana value 0 to 7+
+                - colors: dictionary, color -> number of cards of that color
+                - pips: dictionary, color -> colored mana symbols of that color
+                - types: dictionary, card type -> number of cards of that type
+                - layouts: dictionary, layout -> number of cards with that layout
+        '''
+
+        cardstorm_ids = np.fromiter(deck_dict.keys(), dtype=np.int64, count=len(deck_dict))
+        counts = np.fromiter(deck_dict.values(), dtype=np.int64, count=len(deck_dict))
+
+        rows = np.minimum(np.searchsorted(self.cardstorm_ids, cardstorm_ids), len(self) - 1)
+        # cards missing from the catalog count towards nothing
+        counts = np.where(self.cardstorm_ids[rows] == cardstorm_ids, counts, 0)
+
+        type_matrix = (self.type_bits[rows, None] >> np.arange(len(CARD_TYPES))) & 1
+        color_matrix = (self.color_bits[rows, None] >> np.arange(len(COLORS))) & 1
+        type_counts = counts.dot(type_matrix)
+        nonland = counts * (1 - type_matrix[:, CARD_TYPES.index('Land')])
+
+        curve = np.bincount(np.minimum(self.cmc[rows], MAX_CURVE_CMC).astype(int),
+                            weights=nonland, minlength=MAX_CURVE_CMC + 1)
+        layout_counts = np.bincount(self.layout_codes[rows], weights=counts,
+                                    minlength=len(self.layouts))
+
+        return {'n_cards': int(counts.sum()),
+                'n_lands': int(type_counts[CARD_TYPES.index('Land')]),
+                'average_cmc': float(nonland.dot(self.cmc[rows]) / nonland.sum()) if nonland.sum() else 0.0,
+                'curve': curve.astype(int).tolist(),
+                'colors': dict(zip(COLORS, counts.dot(color_matrix).tolist())),
+                'pips': dict(zip(COLORS, counts.dot(self.pips[rows]).tolist())),
+                'types': dict(zip(CARD_TYPES, type_counts.tolist())),
+                'layouts': {layout: int(count) for layout, count
+                            in zip(self.layouts, layout_counts) if count}}
+
+def _color_bits(colors):
+    return sum(1 << COLORS.index(color) for color in set(colors or []) if color in COLORS)
+
+def _legal_bits(legalities):
+    return sum(1 << i for i, format in enumerate(FORMATS) if format in (legalities or []))
+
+def _type_bits(type_line):
+    # the front face decides, i.e. a creature that transforms into a land is a creature
+    front = (type_line or '').split(' // ')[0]
+
+    return sum(1 << i for i, card_type in enumerate(CARD_TYPES) if card_type in front)
+
+def _pips(mana_cost):
+    symbols = re.findall(r'\{([^}]*)\}', mana_cost or '')
+
+    return [sum(color in symbol for symbol in symbols) for color in COLORS]
+
+
+def format_deck(raw_deck_list):
+    """
+    Takes a raw deck list and returns a nicely formatted deck list.
+
+    INPUT:
+        - raw_deck_list: String, unformatted deck list read directly from a file
+
+    OUTPUT:
+        - deck_list: list of strings, a formatted deck list ready for processing
+    """
+    if not raw_deck_list: # deck list is empty, return []
+        return []
+    deck_list = []
+    for row in raw_deck_list.split('\r\n'):
+        if row.startswith('S') or not row:
+            break
+        deck_list.append(row)
+
+    return deck_list
+
+def parse_card_string(card_string):
+    """
+    Parses a single row of a deck list.
+
+    INPUT:
+        - card_string: a string of a row of the deck list
+
+    OUTPUT:
+        - card_name: a string of the name of the card
+        - card_count: an int of the number of this card in the deck
+    """
+    if card_string:
+        count_search = re.search('(\d+)', card_string)
+        if count_search: # card_count found
+            card_count = count_search.group(1)
+        else:
+            card_count = 1
+
+        card_name = re.search('(\D+)', card_string).group(1).strip()
+
+        if ' / ' in card_name: # split cards. mtgtop8 formats these weirdly
+            card_name = card_name.replace(' / ', ' // ')
+        return True, card_name, card_count
+
+    return False, None, None
@@ -0,0 +1,48 @@
+'''
+Progress checkpoints for the long jobs. The pipeline runner points
+CARDSTORM_CHECKPOINT_DIR at the directory of its run, so rerunning a failed
+run picks a job up where it stopped. Run on their own, jobs don't checkpoint.
+'''
+import json
+import os
+
+def _path(name):
+    directory = os.environ.get('CARDSTORM_CHECKPOINT_DIR')
+    if not directory:
+        return None
+
+    return os.path.join(directory, 'checkpoint_{}.json'.format(name))
+
+def load(name, default=None):
+    '''
+    OUTPUT:
+        - state: the last state saved under name, default if there is none
+    '''
+
+    path = _path(name)
+    if path is None or not os.path.exists(path):
+        return default
+
+    with open(path) as f:
+        return json.load(f)
+
+def save(name, state):
+    '''
+    Saves a JSON-serializable state under name. The file is replaced whole,
+    so a job killed while saving leaves the previous state.
+    '''
+
+    path = _path(name)
+    if path is None:
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary, path)
+
+def clear(name):
+    path = _path(name)
+    if path is not None and os.path.exists(path):
+        os.remove(path)
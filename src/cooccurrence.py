@@ -0,0 +1,145 @@
+import argparse
+import datetime
+import numpy as np
+import db
+import migrations
+from catalog import DEFAULT_FORMAT, get_formats
+
+def build_partners(decks, n_partners=20, min_decks=5, block_size=2048):
+    '''
+    Finds the cards each card is played with more often than chance. With B
+    the binary deck x card incidence matrix, B'B counts the decks every pair
+    of cards shares, and lift = shared * n_decks / (decks_i * decks_j).
+
+    B'B is computed a block of cards at a time and pruned right away, so only
+    one block of the full card x card matrix is ever in memory.
+
+    INPUT:
+        - decks: scipy.sparse csr_matrix (n_decks x n_cards) of card counts
+        - n_partners: int, partners kept per card
+        - min_decks: int, pairs shared by fewer decks are ignored as noise
+
+    OUTPUT:
+        - partners: list of (column, n_decks, partner_columns, lifts) tuples,
+                    one per card played in any deck. Partners are best first.
+    '''
+
+    incidence = (decks > 0).astype(np.float32).tocsc()
+    n_decks = incidence.shape[0]
+    card_decks = np.asarray(incidence.sum(axis=0)).ravel()
+    incidence_t = incidence.T.tocsr()
+
+    partners = []
+    for start in range(0, incidence.shape[1], block_size):
+        shared = incidence_t[start:start + block_size].dot(incidence).tocsr()
+        for row in range(shared.shape[0]):
+            column = start + row
+            if card_decks[column] == 0:
+                continue
+
+            begin, end = shared.indptr[row], shared.indptr[row + 1]
+            others = shared.indices[begin:end]
+            counts = shared.data[begin:end]
+            keep = (others != column) & (counts >= min_decks)
+            others, counts = others[keep], counts[keep]
+
+            lifts = counts * n_decks / (card_decks[column] * card_decks[others])
+            best = np.argsort(-lifts, kind='stable')[:n_partners]
+            partners.append((column, int(card_decks[column]), others[best], lifts[best]))
+
+    return partners
+
+def store_partners(cursor, partners, all_cardstorm_ids, format=DEFAULT_FORMAT):
+    '''
+    Replaces the rows of card_partners for a format.
+
+    INPUT:
+        - partners: list, output of build_partners
+        - all_cardstorm_ids: numpy array, cardstorm_id of every card column
+    '''
+
+    cursor.execute('DELETE FROM card_partners WHERE format = %s', [format])
+
+    current_date = datetime.date.today()
+    for column, n_decks, partner_columns, lifts in partners:
+        cursor.execute('''INSERT INTO card_partners (format, cardstorm_id, date, n_decks,
+                                                     partners, lifts)
+                          VALUES (%s, %s, %s, %s, %s, %s)''',
+                       [format, int(all_cardstorm_ids[column]), current_date, n_decks,
+                        all_cardstorm_ids[partner_columns].tolist(), lifts.tolist()])
+
+def load_partners(cursor, format=DEFAULT_FORMAT):
+    '''
+    Reads the card_partners of a format for serving.
+
+    OUTPUT:
+        - partners: dictionary, cardstorm_id -> {partner cardstorm_id: lift}
+    '''
+
+    db.execute_prepared(cursor, 'card_partners',
+                        'SELECT cardstorm_id, partners, lifts FROM card_partners WHERE format = $1',
+                        [format])
+
+    return {cardstorm_id: dict(zip(partner_ids, lifts))
+            for cardstorm_id, partner_ids, lifts in cursor.fetchall()}
+
+def explain(partners, recommendations, deck_ids, n_reasons=3):
+    '''
+    Finds the cards in the deck each recommendation is most often played
+    with. Costs one dictionary lookup per card in the deck.
+
+    INPUT:
+        - partners: dictionary, output of load_partners
+        - recommendations: iterable of cardstorm_ids
+        - deck_ids: iterable of cardstorm_ids in the submitted deck
+        - n_reasons: int, most partners returned per recommendation
+
+    OUTPUT:
+        - reasons: list of lists of cardstorm_ids, best partner first
+    '''
+
+    deck_ids = list(deck_ids)
+    reasons = []
+    for cardstorm_id in recommendations:
+        card_partners = partners.get(cardstorm_id, {})
+        in_deck = [(card_partners[deck_id], deck_id) for deck_id in deck_ids
+                   if deck_id in card_partners]
+        reasons.append([deck_id for _, deck_id in sorted(in_deck, reverse=True)[:n_reasons]])
+
+    return reasons
+
+def main():
+    parser = argparse.ArgumentParser(description='find the cards every card is played with')
+    parser.add_argument('--partners', type=int, default=20, help='partners kept per card')
+    parser.add_argument('--min-decks', type=int, default=5,
+                        help='least number of decks a pair has to share')
+    args = parser.parse_args()
+
+    from ratings import get_all_cardstorm_ids, load_ratings, ratings_matrix
+
+    print('#####################################################')
+    print('BEGIN CARD PARTNERS: {}'.format(datetime.datetime.today()))
+
+    for format in get_formats():
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            ratings = load_ratings(cursor, format=format)
+            all_cardstorm_ids = get_all_cardstorm_ids(cursor)
+
+        # filler rows for unused cards have deck_id -1 and aren't decks
+        deck_ids, cardstorm_ids, card_counts = ratings
+        keep = (deck_ids >= 0) & np.isin(cardstorm_ids, all_cardstorm_ids)
+        decks, _ = ratings_matrix((deck_ids[keep], cardstorm_ids[keep], card_counts[keep]),
+                                  all_cardstorm_ids)
+
+        partners = build_partners(decks, n_partners=args.partners, min_decks=args.min_decks)
+
+        with db.transaction() as cursor:
+            migrations.migrate(cursor)
+            store_partners(cursor, partners, all_cardstorm_ids, format=format)
+
+        print('{}: partners for {} cards over {} decks'.format(format, len(partners), decks.shape[0]))
+    db.close_pool()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import os
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from metrics import span
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_lock = threading.Lock()
+
+# set CARDSTORM_DB_BACKEND=duckdb to keep everything in the embedded database
+# file CARDSTORM_DB_PATH instead of PostgreSQL, see embedded.py
+BACKEND = os.environ.get('CARDSTORM_DB_BACKEND', 'postgres')
+
+def embedded():
+    return BACKEND == 'duckdb'
+
+class PreparingConnection(psycopg2.extensions.connection):
+    '''
+    psycopg2 connection that remembers which statements were prepared on it.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def connection_string():
+    '''
+    Builds the connection string from the CARDSTORM_DB_* environment variables.
+    '''
+
+    return 'dbname={} host={} user={} password={}'.format(os.environ['CARDSTORM_DB_DBNAME'],
+                                                          os.environ['CARDSTORM_DB_HOST'],
+                                                          os.environ['CARDSTORM_DB_USERNAME'],
+                                                          os.environ['CARDSTORM_DB_PASSWORD'])
+
+def jdbc_url():
+    '''
+    Builds the JDBC url Spark executors write to from the CARDSTORM_DB_* environment variables.
+    '''
+
+    return 'jdbc:postgresql://{}/{}'.format(os.environ['CARDSTORM_DB_HOST'],
+                                            os.environ['CARDSTORM_DB_DBNAME'])
+
+def jdbc_properties():
+    return {'user': os.environ['CARDSTORM_DB_USERNAME'],
+            'password': os.environ['CARDSTORM_DB_PASSWORD'],
+            'driver': 'org.postgresql.Driver'}
+
+def get_pool():
+    '''
+    Gets the process-wide connection pool, creating it on first use. Sized by
+    CARDSTORM_DB_POOL_MIN and CARDSTORM_DB_POOL_MAX. A forked child never
+    reuses its parent's sockets, it gets a pool of its own.
+
+    OUTPUT:
+        - pool: psycopg2 ThreadedConnectionPool
+    '''
+
+    global _pool, _pool_pid, _pool_slots
+
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            minconn = int(os.environ.get('CARDSTORM_DB_POOL_MIN', 1))
+            maxconn = int(os.environ.get('CARDSTORM_DB_POOL_MAX', 8))
+            _pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, connection_string(),
+                                                         connection_factory=PreparingConnection)
+            _pool_pid = os.getpid()
+            # the pool raises instead of waiting when it is exhausted, so
+            # callers queue on this semaphore for a free connection
+            _pool_slots = threading.BoundedSemaphore(maxconn)
+
+    return _pool
+
+def close_pool():
+    '''
+    Closes every connection in the pool. Only closes the pool in the process
+    that created it.
+    '''
+
+    global _pool
+
+    if embedded():
+        import embedded as embedded_backend
+        embedded_backend.close_database()
+        return
+
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+@contextmanager
+def connection():
+    '''
+    Borrows a connection from the pool and returns it when the block exits.
+    Anything left uncommitted is rolled back, so a connection never goes back
+    to the pool in the middle of a transaction.
+
+    Usage:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+    '''
+
+    if embedded():
+        yield from _embedded_connection()
+        return
+
+    pool = get_pool()
+    slots = _pool_slots
+    with span('db_connect'):
+        slots.acquire()
+        try:
+            conn = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+
+    try:
+        yield conn
+    finally:
+        try:
+            if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+            slots.release()
+
+def _embedded_connection():
+    import embedded as embedded_backend
+
+    with span('db_connect'):
+        conn = embedded_backend.connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+@contextmanager
+def transaction():
+    '''
+    Runs the block in a single transaction on a pooled connection. Commits if
+    the block finishes, rolls back if it raises.
+
+    Usage:
+        with db.transaction() as cursor:
+            cursor.execute(...)
+    '''
+
+    with connection() as conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+def execute_prepared(cursor, name, query, args=()):
+    '''
+    Executes a query as a prepared statement, preparing it the first time it
+    is used on this connection. Parameters in the query are written $1, $2...
+
+    INPUT:
+        - cursor: cursor of a pooled connection
+        - name: string, name of the prepared statement
+        - query: string, the query to prepare
+        - args: list, parameters for the query
+    '''
+
+    if embedded():
+        # DuckDB takes $1 parameters as they are and caches its own plans
+        cursor.execute_native(query, list(args))
+        return
+
+    # prepared statements live as long as the session, not the transaction
+    prepared = cursor.connection.prepared
+
+    if name not in prepared:
+        cursor.execute('PREPARE {} AS {}'.format(name, query))
+        prepared.add(name)
+
+    if args:
+        cursor.execute('EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(args))), args)
+    else:
+        cursor.execute('EXECUTE {}'.format(name))
@@ -1,111 +1,23 @@
-import requests
 import re
-import numpy as np
 import json
-import random
-import time
 import datetime
+import multiprocessing
 from bs4 import BeautifulSoup
 import psycopg2
-import os
-
-class ReflexiveDict():
-
-    def __init__(self):
-        self._dict = {}
-        self._get_cards()
-
-    def __setitem__(self, key, val):
-        self._dict[key] = val
-        self._dict[val] = key
-
-    def __getitem__(self, key):
-        return self._dict[key]
-
-    def keys(self):
-        return self._dict.keys()
-
-    def __contains__(self, key):
-        return key in self._dict
-
-    def _get_cards(self):
-        dbname_ = os.environ['CARDSTORM_DB_DBNAME']
-        host_ = os.environ['CARDSTORM_DB_HOST']
-        username_ = os.environ['CARDSTORM_DB_USERNAME']
-        password_ = os.environ['CARDSTORM_DB_PASSWORD']
-
-        conn_ = psycopg2.connect('dbname={} host={} user={} password={}'.format(dbname_, host_, username_, password_))
-        cursor_ = conn_.cursor()
-
-        query = '''SELECT name, cardstorm_id
-                   FROM cards'''
-
-        try:
-            cursor_.execute(query)
-
-            for name, cardstorm_id in cursor_.fetchall():
-                self[name] = cardstorm_id
-        except:
-            return False
-
-        return True
-
-    def __len__(self):
-        return len(self._dict)
-
-    def get_cardstorm_ids(self):
-        all_cardstorm_ids = [key for key in self.keys() if isinstance(key, int)]
-
-        return np.array(sorted(all_cardstorm_ids))
-
-
-def format_deck(raw_deck_list):
-    """
-    Takes a raw deck list and returns a nicely formatted deck list.
-
-    INPUT:
-        - raw_deck_list: String, unformatted deck list read directly from a file
-
-    OUTPUT:
-        - deck_list: list of strings, a formatted deck list ready for processing
-    """
-    if not raw_deck_list: # deck list is empty, return []
-        return []
-    deck_list = []
-    for row in raw_deck_list.split('\r\n'):
-        if row.startswith('S') or not row:
-            break
-        deck_list.append(row)
-
-    return deck_list
-
-def parse_card_string(card_string):
-    """
-    Parses a single row of a deck list.
-
-    INPUT:
-        - card_string: a string of a row of the deck list
-
-    OUTPUT:
-        - card_name: a string of the name of the card
-        - card_count: an int of the number of this card in the deck
-    """
-    if card_string:
-        count_search = re.search('(\d+)', card_string)
-        if count_search: # card_count found
-            card_count = count_search.group(1)
-        else:
-            card_count = 1
-
-        card_name = re.search('(\D+)', card_string).group(1).strip()
-
-        if ' / ' in card_name: # split cards. mtgtop8 formats these weirdly
-            card_name = card_name.replace(' / ', ' // ')
-        return True, card_name, card_count
-
-    return False, None, None
-
-def make_user_card_counts(event_id, deck_id, deck_list,verbose=False):
+import checkpoint
+import db
+import http_cache
+import job_metrics
+import migrations
+from catalog import DEFAULT_FORMAT, ReflexiveDict, format_deck, get_formats, parse_card_string
+
+# mtgtop8.com query string of each format's front page
+FORMAT_PAGES = {'modern': 'f=MO&meta=44',
+                'standard': 'f=ST',
+                'pioneer': 'f=PI',
+                'legacy': 'f=LE'}
+
+def make_user_card_counts(event_id, deck_id, deck_list, format=DEFAULT_FORMAT, verbose=False):
     """
     Takes a deck_id and deck_list and returns user-card-count tuples.
 
@@ -113,6 +25,7 @@ def make_user_card_counts(event_id, deck_id, deck_list,verbose=False):
         - event_id: the unique identifier for the event this deck came from
         - deck_id: the unique identifier for the deck
         - deck_list: the deck list read from a file, formatted
+        - format: string, the format the event was played in
         # - cursor: psycopg2 cursor object, used to get cardstorm_id from db
         - verbose: bool, if true status messages will be printed
     OUTPUT:
@@ -127,7 +40,14 @@ def make_user_card_counts(event_id, deck_id, deck_list,verbose=False):
         if not cardstorm_id: # could not find cardstorm_id, most likely not a valid card
             continue
         if parse_success:
-            user_card_count.append((int(event_id), int(deck_id), cardstorm_id, card_count))
+            user_card_count.append((int(event_id), int(deck_id), cardstorm_id, card_count, format))
+
+    # a card listed on two lines is one row, decks have one row per card
+    counts = {}
+    for row in user_card_count:
+        counts[row[2]] = counts.get(row[2], 0) + int(row[3])
+    user_card_count = [row[:3] + (counts.pop(row[2]),) + row[4:]
+                       for row in user_card_count if row[2] in counts]
 
     return user_card_count
 
@@ -146,7 +66,7 @@ def upload_user_card_counts(user_card_counts, verbose=False):
     '''
 
     template = ', '.join(['%s'] * len(user_card_counts))
-    query = 'INSERT INTO decks (event_id, deck_id, cardstorm_id, card_count) VALUES {}'.format(template)
+    query = 'INSERT INTO decks (event_id, deck_id, cardstorm_id, card_count, format) VALUES {}'.format(template)
 
     try:
         cursor.execute(query=query, vars=user_card_counts)
@@ -251,18 +171,17 @@ def deck_request(deck_id, verbose=False):
 
     OUTPUT:
         - deck_list: a list of strings representing the deck list corresponding
-                     to the deck_id."""
+                     to the deck_id. Empty if every try failed."""
 
     if verbose: print('        deck request for deck id {}'.format(deck_id))
 
     # repeat this process a max of 5 times. If status_code==200, break
+    response = None
     for i in range(5):
-        # preventing submitting too fast
-        time.sleep(0.1 + random.random())
-
+        if i: job_metrics.count('http_retries')
         try:
-            response = requests.get('http://mtgtop8.com/mtgo?d={}'.format(deck_id),
-                                headers={'User-Agent': 'Getting some deck lists'})
+            response = http_cache.get('http://mtgtop8.com/mtgo?d={}'.format(deck_id),
+                                      headers={'User-Agent': 'Getting some deck lists'})
 
             # if good status code, quit loop and return
             # otherwise, keep going for a max of 5 times
@@ -274,6 +193,11 @@ def deck_request(deck_id, verbose=False):
         except:
             if verbose: print("Error connecting to http://mtgtop8.com/mtgo?d={}".format(deck_id))
 
+    if response is None or response.status_code != 200:
+        # an empty deck list, skipped by the caller
+        job_metrics.count('http_failures')
+        return ''
+
     deck_list = response.text
 
     return deck_list
@@ -285,18 +209,17 @@ def event_request(event_id, verbose=False):
         - event_id: the unique id for the desired event from mtgtop8.com
 
     OUTPUT:
-        - response: the response from the get request"""
+        - response: the response from the get request. None if every try failed."""
 
     if verbose: print('    event request for event id {}'.format(event_id))
 
     # repeat this process a max of 5 times. If status_code==200, break
+    response = None
     for i in range(5):
-        # preventing submitting too fast
-        time.sleep(0.1 + random.random())
-
+        if i: job_metrics.count('http_retries')
         try:
-            response = requests.get('http://mtgtop8.com/event?e={}'.format(event_id),
-                                headers={'User-Agent': 'Getting some event info'})
+            response = http_cache.get('http://mtgtop8.com/event?e={}'.format(event_id),
+                                      headers={'User-Agent': 'Getting some event info'})
 
             # if good status code, quit loop and return
             # otherwise, keep going for a max of 5 times
@@ -306,26 +229,34 @@ def event_request(event_id, verbose=False):
         except:
             if verbose: print("Error connecting to http://mtgtop8.com/event?e={}".format(event_id))
 
+    if response is None or response.status_code != 200:
+        job_metrics.count('http_failures')
+        return None
+
     return response
 
-def modern_front_page_request(page_number=0, verbose=False):
+def front_page_request(format=DEFAULT_FORMAT, page_number=0, verbose=False):
     """Sends a get request to mtgtop8.com with the given page number
 
     INPUT:
+        - format: string, the format whose front page is requested
         - page_number: argument for the get request. page_number of 3 gets decks from 21-30.
                        Default value of 0 to get decks from 1-10.
 
     OUTPUT:
-        - response: the response from the get request"""
+        - response: the response from the get request. None if every try failed,
+                    i.e. a page missing from the cache when offline."""
 
     # repeat this process a max of 5 times. If status_code==200, break
-    if verbose: print('requesting front page number {}'.format(page_number))
+    if verbose: print('requesting {} front page number {}'.format(format, page_number))
+    url = 'http://mtgtop8.com/format?{}&cp={}'.format(FORMAT_PAGES[format], page_number)
 
 
+    response = None
     for i in range(5):
+        if i: job_metrics.count('http_retries')
         try:
-            response = requests.get('http://mtgtop8.com/format?f=MO&meta=44&cp={}'.format(page_number),
-                                    headers={'User-Agent': 'Modern front page request'})
+            response = http_cache.get(url, headers={'User-Agent': '{} front page request'.format(format.title())})
             # if good status code, quit loop and return
             # otherwise, keep going for a max of 5 times
             if response.status_code == 200:
@@ -334,65 +265,114 @@ def modern_front_page_request(page_number=0, verbose=False):
             if verbose: print('bad status code: {}. try {} of 5'.format(response.status_code, i+1))
 
         except:
-            if verbose: print("Error connecting to http://mtgtop8.com/format?f=MO&meta=44&cp={}".format(page_number))
+            if verbose: print("Error connecting to {}".format(url))
 
-        time.sleep(0.1 + random.random())
+    if response is None or response.status_code != 200:
+        job_metrics.count('http_failures')
+        return None
 
     return response
 
-def scrape_decklists(front_pages=[0], verbose=False):
+def scrape_decklists(front_pages=[0], format=DEFAULT_FORMAT, verbose=False):
     if verbose:
         print('#####################################################')
-        print('BEGIN SCRAPING DECKS: {}'.format(str(datetime.datetime.today())))
+        print('BEGIN SCRAPING {} DECKS: {}'.format(format.upper(), str(datetime.datetime.today())))
     global conn
     global cursor
     scraped_deck_ids = get_scraped_deck_ids()
+    # front pages and events finished by an earlier attempt of this pipeline run
+    progress = checkpoint.load('decks_{}'.format(format), {'front_page': -1, 'events': []})
     for page_number in front_pages:
-        raw_front_page = modern_front_page_request(page_number=page_number, verbose=verbose)
-        front_page = BeautifulSoup(raw_front_page.text, 'html.parser')
-
-        event_ids = get_event_ids(front_page, verbose=verbose)
+        if page_number <= progress['front_page']:
+            continue
+        raw_front_page = front_page_request(format=format, page_number=page_number, verbose=verbose)
+        if raw_front_page is None: # no events to scrape, a resumed run tries again
+            print('no {} front page {}, skipping it'.format(format, page_number))
+            continue
+        with job_metrics.timed('parse'):
+            front_page = BeautifulSoup(raw_front_page.text, 'html.parser')
+            event_ids = get_event_ids(front_page, verbose=verbose)
 
         for event_id in event_ids:
+            if event_id in progress['events']:
+                continue
             raw_event_page = event_request(event_id, verbose=verbose)
-            event_page = BeautifulSoup(raw_event_page.text, 'html.parser')
-
-            deck_ids = get_deck_ids(event_page, verbose=verbose)
+            if raw_event_page is None: # no decks to scrape, a resumed run tries again
+                print('no page for {} event {}, skipping it'.format(format, event_id))
+                continue
+            with job_metrics.timed('parse'):
+                event_page = BeautifulSoup(raw_event_page.text, 'html.parser')
+                deck_ids = get_deck_ids(event_page, verbose=verbose)
 
             for deck_id in deck_ids:
                 if int(deck_id) in scraped_deck_ids: # already scraped this deck
                     if verbose: print('        deck id {} has already been scraped'.format(deck_id))
                     continue
                 raw_deck_list = deck_request(deck_id, verbose=verbose)
-                deck_list = format_deck(raw_deck_list)
+                with job_metrics.timed('parse'):
+                    deck_list = format_deck(raw_deck_list)
                 if not deck_list: # empty deck list, skip this deck
                     if verbose: print('            empty deck list at deck id {}'.format(deck_id))
                     continue
-                user_card_counts = make_user_card_counts(event_id, deck_id, deck_list, verbose=verbose)
-                success = upload_user_card_counts(user_card_counts, verbose=verbose)
-
+                with job_metrics.timed('parse'):
+                    user_card_counts = make_user_card_counts(event_id, deck_id, deck_list, format=format,
+                                                             verbose=verbose)
+                with job_metrics.timed('db'):
+                    success = upload_user_card_counts(user_card_counts, verbose=verbose)
+
+                    if success:
+                        conn.commit()
+                    else:
+                        conn.rollback()
+                        cursor = conn.cursor()
                 if success:
-                    conn.commit()
+                    job_metrics.count('decks_inserted')
+                    job_metrics.count('rows_inserted', len(user_card_counts))
                 else:
-                    conn.rollback()
-                    cursor = conn.cursor()
+                    job_metrics.count('decks_rejected')
 
-    conn.close()
+            progress['events'].append(event_id)
+            checkpoint.save('decks_{}'.format(format), progress)
 
-def main():
-    global dbname, host, username, password, conn, cursor, card_dict
+        progress = {'front_page': page_number, 'events': []}
+        checkpoint.save('decks_{}'.format(format), progress)
 
-    dbname = os.environ['CARDSTORM_DB_DBNAME']
-    host = os.environ['CARDSTORM_DB_HOST']
-    username = os.environ['CARDSTORM_DB_USERNAME']
-    password = os.environ['CARDSTORM_DB_PASSWORD']
-
-    conn = psycopg2.connect('dbname={} host={} user={} password={}'.format(dbname, host, username, password))
-    cursor = conn.cursor()
+def scrape_format(format):
+    '''
+    Scrapes the decks of one format with its own db connection, so every
+    format can be scraped in its own process.
+    '''
+    global conn, cursor, card_dict
 
+    job_metrics.start('deck_scraping', format=format)
     card_dict = ReflexiveDict()
 
-    scrape_decklists(verbose=True, front_pages=range(10))
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        scrape_decklists(verbose=True, front_pages=range(10), format=format)
+
+    print('{} http cache: {}'.format(format, http_cache.STATS))
+    print('{} run report: {}'.format(format, job_metrics.write()))
+    db.close_pool()
+
+def main():
+    formats = get_formats()
+
+    with db.transaction() as cursor_:
+        migrations.migrate(cursor_)
+    db.close_pool()
+
+    if db.embedded():
+        # only one process at a time can write to the embedded database
+        for format in formats:
+            scrape_format(format)
+    else:
+        # the formats' pages are independent, scrape them side by side
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(len(formats)) as pool:
+            pool.map(scrape_format, formats)
+
+    print('http cache: evicted {} pages'.format(http_cache.evict()))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+'''
+Embedded storage backend. With CARDSTORM_DB_BACKEND=duckdb every module
+keeps using db.connection() and db.transaction(), and gets connections to
+the DuckDB database file CARDSTORM_DB_PATH instead of PostgreSQL. Nothing
+outside db.py needs to know which backend it talks to.
+
+The connections behave like psycopg2's for what the code uses: %s and
+%(name)s parameters, a transaction opened by the first statement and ended
+by commit() or rollback(), rowcount, and IntegrityError on a duplicate key.
+
+DuckDB lets one process write a database file, or any number of processes
+read it. Jobs writing to it run their formats one after the other, and the
+web app serves it read only with CARDSTORM_DB_READ_ONLY=1.
+'''
+import os
+import re
+import threading
+import duckdb
+import psycopg2
+
+_database = None
+_database_pid = None
+_lock = threading.Lock()
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+_RETURNING = re.compile(r'\bRETURNING\b', re.IGNORECASE)
+
+def database_path():
+    return os.environ.get('CARDSTORM_DB_PATH', 'cardstorm.duckdb')
+
+def get_database():
+    '''
+    Opens the database file once per process. Every connection handed out is
+    a cursor of this one, so they share a single buffer pool.
+    '''
+
+    global _database, _database_pid
+
+    with _lock:
+        if _database is None or _database_pid != os.getpid():
+            read_only = os.environ.get('CARDSTORM_DB_READ_ONLY', '0') == '1'
+            _database = duckdb.connect(database_path(), read_only=read_only)
+            _database_pid = os.getpid()
+
+    return _database
+
+def close_database():
+    global _database
+
+    with _lock:
+        if _database is not None and _database_pid == os.getpid():
+            _database.close()
+        _database = None
+
+def translate(query, params):
+    '''
+    Rewrites psycopg2 parameters into DuckDB's. A tuple parameter is a row,
+    as psycopg2 adapts it, i.e. the VALUES of a multi-row INSERT.
+
+    INPUT:
+        - query: string, with %s or %(name)s parameters and %% for a literal %
+        - params: list or dictionary
+
+    OUTPUT:
+        - query: string, with ? or $name parameters
+        - params: list or dictionary
+    '''
+
+    if isinstance(params, dict):
+        return _PLACEHOLDER.sub(lambda match: '%' if match.group(0) == '%%'
+                                else '$' + match.group(1), query), params
+
+    values = iter(params)
+    args = []
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        value = next(values)
+        if isinstance(value, tuple):
+            args.extend(value)
+            return '({})'.format(', '.join(['?'] * len(value)))
+        args.append(value)
+        return '?'
+
+    return _PLACEHOLDER.sub(replace, query), args
+
+class EmbeddedConnection():
+    '''
+    A DuckDB connection with psycopg2's transaction behaviour.
+    '''
+
+    def __init__(self, connection):
+        self.duckdb = connection
+        self.in_transaction = False
+        self.closed = False
+
+    def cursor(self):
+        return EmbeddedCursor(self)
+
+    def begin(self):
+        if not self.in_transaction:
+            self.duckdb.execute('BEGIN TRANSACTION')
+            self.in_transaction = True
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.duckdb.execute('COMMIT')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.duckdb.execute('ROLLBACK')
+
+    def close(self):
+        if not self.closed:
+            self.rollback()
+            self.duckdb.close()
+            self.closed = True
+
+class EmbeddedCursor():
+    '''
+    Cursor of an EmbeddedConnection. Results are read from DuckDB as they
+    are fetched, except for INSERT, UPDATE and DELETE, which are read right
+    away to set rowcount.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self._result = None
+        self._rows = None
+
+    def execute(self, query, vars=None):
+        if vars is not None:
+            query, vars = translate(query, vars)
+        self.execute_native(query, vars)
+
+    def execute_native(self, query, args=None):
+        '''
+        Executes a query written with DuckDB's own $1, $2... parameters.
+        '''
+
+        self.connection.begin()
+        try:
+            if args:
+                result = self.connection.duckdb.execute(query, args)
+            else:
+                result = self.connection.duckdb.execute(query)
+        except duckdb.IntegrityError as error:
+            raise psycopg2.IntegrityError(str(error)) from error
+
+        self._result, self._rows, self.rowcount = result, None, -1
+        if query.lstrip().split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            if _RETURNING.search(query):
+                self._rows = result.fetchall()
+                self.rowcount = len(self._rows)
+            else:
+                # DuckDB answers a modification with the number of rows it changed
+                self._rows = []
+                self.rowcount = result.fetchone()[0]
+
+    def fetchone(self):
+        if self._rows is not None:
+            return self._rows.pop(0) if self._rows else None
+        return self._result.fetchone()
+
+    def fetchall(self):
+        if self._rows is not None:
+            rows, self._rows = self._rows, []
+            return rows
+        return self._result.fetchall()
+
+    def fetchnumpy(self):
+        '''
+        OUTPUT:
+            - columns: dictionary, column name -> numpy array of the whole result
+        '''
+
+        return self._result.fetchnumpy()
+
+    def close(self):
+        self._result = self._rows = None
+
+def connect():
+    return EmbeddedConnection(get_database().cursor())
@@ -0,0 +1,259 @@
+import argparse
+import datetime
+import itertools
+import multiprocessing
+import os
+import time
+import numpy as np
+import db
+import migrations
+from catalog import DEFAULT_FORMAT, FORMATS
+
+def split_holdout(deck_ids, cardstorm_ids, card_counts, n_test_decks=500,
+                  holdout_fraction=0.2, seed=0):
+    '''
+    Hides a fraction of the cards in the most recent decks. mtgtop8 deck ids
+    increase over time, so the largest deck ids are the most recent decks.
+
+    INPUT:
+        - deck_ids, cardstorm_ids, card_counts: numpy arrays, one entry per deck-card row
+        - n_test_decks: int, number of recent decks to hold cards out of
+        - holdout_fraction: float, fraction of each test deck's distinct cards to hide.
+                            At least one card is always hidden.
+        - seed: int, seed for choosing the hidden cards
+
+    OUTPUT:
+        - train: tuple of (deck_ids, cardstorm_ids, card_counts) arrays, every
+                 row that isn't hidden
+        - test: tuple of (deck_ids, cardstorm_ids, card_counts, hidden) arrays,
+                the rows of the test decks. hidden is a boolean mask.
+    '''
+
+    unique_deck_ids = np.unique(deck_ids)
+    # filler rows for unused cards have deck_id -1 and are never test decks
+    unique_deck_ids = unique_deck_ids[unique_deck_ids >= 0]
+    test_deck_ids = unique_deck_ids[-n_test_decks:] if n_test_decks else unique_deck_ids[:0]
+    is_test = np.isin(deck_ids, test_deck_ids)
+
+    test_rows = np.flatnonzero(is_test)
+    random_state = np.random.RandomState(seed)
+    # random key per row, the lowest keys in each deck are hidden
+    keys = random_state.random_sample(len(test_rows))
+    order = np.lexsort((keys, deck_ids[test_rows]))
+    test_rows = test_rows[order]
+
+    test_deck_of_row = deck_ids[test_rows]
+    starts = np.flatnonzero(np.r_[True, test_deck_of_row[1:] != test_deck_of_row[:-1]])
+    sizes = np.diff(np.r_[starts, len(test_rows)])
+    position = np.arange(len(test_rows)) - np.repeat(starts, sizes)
+    n_hidden = np.maximum(1, np.floor(sizes * holdout_fraction)).astype(int)
+    hidden = position < np.repeat(n_hidden, sizes)
+
+    keep = np.ones(len(deck_ids), dtype=bool)
+    keep[test_rows[hidden]] = False
+
+    train = (deck_ids[keep], cardstorm_ids[keep], card_counts[keep])
+    test = (deck_ids[test_rows], cardstorm_ids[test_rows], card_counts[test_rows], hidden)
+
+    return train, test
+
+def score_holdout(feature_matrix, all_cardstorm_ids, test, k=10, batch_size=256):
+    '''
+    Scores hidden cards the way the web app makes recommendations: the visible
+    part of each test deck is folded in with least squares, d' = u*V is
+    recreated, and cards are ranked by d' - d. Cards already visible in the
+    deck are never counted as recommendations.
+
+    Decks are scored in batches, so each batch is a pair of matrix products.
+
+    INPUT:
+        - feature_matrix: numpy array (n_cards x rank), rows ordered like all_cardstorm_ids
+        - all_cardstorm_ids: sorted numpy array of cardstorm_ids
+        - test: tuple from split_holdout
+        - k: int, length of the recommendation list
+        - batch_size: int, number of decks scored per batch
+
+    OUTPUT:
+        - metrics: dictionary, recall_at_k, ndcg_at_k, n_test_decks, score_ms_per_deck
+    '''
+
+    deck_ids, cardstorm_ids, card_counts, hidden = test
+    unique_deck_ids, deck_rows = np.unique(deck_ids, return_inverse=True)
+    card_columns = np.searchsorted(all_cardstorm_ids, cardstorm_ids)
+
+    # u = pinv(V) * d is the least squares solution for every deck at once
+    pseudo_inverse = np.linalg.pinv(feature_matrix)
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+
+    recalls = []
+    ndcgs = []
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(unique_deck_ids), batch_size):
+        batch_end = min(batch_start + batch_size, len(unique_deck_ids))
+        in_batch = (deck_rows >= batch_start) & (deck_rows < batch_end)
+        rows = deck_rows[in_batch] - batch_start
+        columns = card_columns[in_batch]
+        batch_hidden = hidden[in_batch]
+
+        deck_vectors = np.zeros((batch_end - batch_start, len(all_cardstorm_ids)))
+        deck_vectors[rows[~batch_hidden], columns[~batch_hidden]] = card_counts[in_batch][~batch_hidden]
+        hidden_matrix = np.zeros(deck_vectors.shape, dtype=bool)
+        hidden_matrix[rows[batch_hidden], columns[batch_hidden]] = True
+
+        u_vectors = deck_vectors.dot(pseudo_inverse.T)
+        scores = u_vectors.dot(feature_matrix.T) - deck_vectors
+        scores[deck_vectors > 0] = -np.inf
+
+        top_k = np.argpartition(-scores, k, axis=1)[:, :k]
+        top_k_scores = np.take_along_axis(scores, top_k, axis=1)
+        top_k = np.take_along_axis(top_k, np.argsort(-top_k_scores, axis=1), axis=1)
+
+        hits = np.take_along_axis(hidden_matrix, top_k, axis=1)
+        n_hidden = hidden_matrix.sum(axis=1)
+        ideal = np.cumsum(discounts)[np.minimum(n_hidden, k) - 1]
+
+        recalls.append(hits.sum(axis=1) / n_hidden)
+        ndcgs.append(hits.dot(discounts) / ideal)
+    elapsed = time.perf_counter() - start_time
+
+    return {'recall_at_{}'.format(k): float(np.concatenate(recalls).mean()),
+            'ndcg_at_{}'.format(k): float(np.concatenate(ndcgs).mean()),
+            'n_test_decks': len(unique_deck_ids),
+            'score_ms_per_deck': elapsed * 1000 / len(unique_deck_ids)}
+
+def store_evaluation(cursor, params, metrics, run_id=None, format=DEFAULT_FORMAT):
+    '''
+    Inserts one row into model_evaluations.
+
+    INPUT:
+        - cursor: psycopg2 cursor object
+        - params: dictionary, rank, reg_param, alpha and max_iter used for training
+        - metrics: dictionary, output of score_holdout plus fit_seconds
+        - run_id: int, the product_matrices run these metrics belong to. None for sweeps.
+        - format: string, format of the decks trained and scored on
+    '''
+
+    query = '''INSERT INTO model_evaluations (run_id, date, rank, reg_param, alpha, max_iter,
+                                              n_test_decks, recall_at_10, ndcg_at_10,
+                                              fit_seconds, score_ms_per_deck, format)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'''
+
+    cursor.execute(query, vars=[run_id, datetime.date.today(), params['rank'],
+                                params['reg_param'], params['alpha'], params['max_iter'],
+                                metrics['n_test_decks'], metrics['recall_at_10'],
+                                metrics['ndcg_at_10'], metrics.get('fit_seconds'),
+                                metrics['score_ms_per_deck'], format])
+
+def pick_rank(evaluations, min_recall):
+    '''
+    Picks the cheapest parameters that meet the quality bar.
+
+    INPUT:
+        - evaluations: list of (params, metrics) tuples
+        - min_recall: float, minimum acceptable recall@10
+
+    OUTPUT:
+        - best: (params, metrics) tuple with the smallest rank (then best recall)
+                whose recall@10 is at least min_recall. None if nothing qualifies.
+    '''
+
+    qualifying = [(params, metrics) for params, metrics in evaluations
+                  if metrics['recall_at_10'] >= min_recall]
+    if not qualifying:
+        return None
+
+    return min(qualifying, key=lambda e: (e[0]['rank'], -e[1]['recall_at_10']))
+
+def _init_worker(train, test, all_cardstorm_ids, cores):
+    global _train, _test, _all_cardstorm_ids, _spark
+    # workers must start their own jvm, not attach to one inherited from spark-submit
+    for name in ('PYSPARK_GATEWAY_PORT', 'PYSPARK_GATEWAY_SECRET'):
+        os.environ.pop(name, None)
+
+    import modeling
+
+    _train = train
+    _test = test
+    _all_cardstorm_ids = all_cardstorm_ids
+    _spark = modeling.make_spark_session('cardstorm evaluation', cores=cores)
+    _spark.sparkContext.setLogLevel('WARN')
+
+def _evaluate_params(params):
+    import modeling
+
+    start_time = time.perf_counter()
+    feature_matrix = modeling.fit_feature_matrix(_spark, _train, _all_cardstorm_ids, **params)
+    fit_seconds = time.perf_counter() - start_time
+
+    metrics = score_holdout(feature_matrix, _all_cardstorm_ids, _test)
+    metrics['fit_seconds'] = fit_seconds
+
+    return params, metrics
+
+def sweep(train, test, all_cardstorm_ids, ranks, reg_params, alphas, max_iter=20, workers=2):
+    '''
+    Trains and scores one model per parameter combination in a process pool.
+    Each worker runs its own local Spark session on an equal share of the cores.
+
+    OUTPUT:
+        - evaluations: list of (params, metrics) tuples
+    '''
+
+    grid = [{'rank': rank, 'reg_param': reg_param, 'alpha': alpha, 'max_iter': max_iter}
+            for rank, reg_param, alpha in itertools.product(ranks, reg_params, alphas)]
+    cores = max(1, multiprocessing.cpu_count() // workers)
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=_init_worker,
+                      initargs=(train, test, all_cardstorm_ids, cores)) as pool:
+        evaluations = []
+        for params, metrics in pool.imap_unordered(_evaluate_params, grid):
+            print('rank={rank} reg_param={reg_param} alpha={alpha}: '.format(**params) +
+                  'recall@10={recall_at_10:.4f} ndcg@10={ndcg_at_10:.4f} '
+                  'fit={fit_seconds:.1f}s score={score_ms_per_deck:.2f}ms/deck'.format(**metrics))
+            evaluations.append((params, metrics))
+
+    return evaluations
+
+def main():
+    parser = argparse.ArgumentParser(description='hold-out evaluation sweep for the ALS model')
+    parser.add_argument('--ranks', type=int, nargs='+', default=[10, 20, 30, 40, 80, 160])
+    parser.add_argument('--reg-params', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--alphas', type=float, nargs='+', default=[1.0])
+    parser.add_argument('--max-iter', type=int, default=20)
+    parser.add_argument('--format', choices=FORMATS, default=DEFAULT_FORMAT)
+    parser.add_argument('--test-decks', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--min-recall', type=float, default=None,
+                        help='report the cheapest rank with at least this recall@10')
+    args = parser.parse_args()
+
+    from ratings import get_all_cardstorm_ids, load_ratings
+
+    print('#####################################################')
+    print('BEGIN EVALUATION SWEEP: {}'.format(datetime.datetime.today()))
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        ratings = load_ratings(cursor, format=args.format)
+        all_cardstorm_ids = get_all_cardstorm_ids(cursor)
+    train, test = split_holdout(*ratings, n_test_decks=args.test_decks)
+
+    evaluations = sweep(train, test, all_cardstorm_ids, args.ranks, args.reg_params,
+                        args.alphas, max_iter=args.max_iter, workers=args.workers)
+
+    with db.transaction() as cursor:
+        migrations.migrate(cursor)
+        for params, metrics in evaluations:
+            store_evaluation(cursor, params, metrics, format=args.format)
+    db.close_pool()
+
+    if args.min_recall is not None:
+        best = pick_rank(evaluations, args.min_recall)
+        if best is None:
+            print('no parameters reach recall@10 >= {}'.format(args.min_recall))
+        else:
+            print('cheapest qualifying parameters: {}'.format(best[0]))
+
+if __name__ == '__main__':
+    main()
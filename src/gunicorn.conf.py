@@ -0,0 +1,34 @@
+# gunicorn settings for serving cardstorm, see "Serving" in the README.
+# Every setting can be overridden with a CARDSTORM_* environment variable.
+import multiprocessing
+import os
+import tempfile
+
+# one BLAS thread per worker, the workers already use every core and
+# multithreaded BLAS inside each of them only oversubscribes the box
+for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(name, os.environ.get('CARDSTORM_BLAS_THREADS', '1'))
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.environ.get('CARDSTORM_BIND', '0.0.0.0:8000')
+
+# load the model in the master before forking, workers share it copy-on-write
+preload_app = True
+
+# scripts/reload.sh finds the master here to roll it over to new model runs
+pidfile = os.environ.get('CARDSTORM_PIDFILE', '/tmp/cardstorm_gunicorn.pid')
+
+# the workers share their metrics and profiler settings through files here,
+# kept by the new master when scripts/reload.sh replaces the old one
+os.environ.setdefault('CARDSTORM_WORKER_STATE_DIR', tempfile.mkdtemp(prefix='cardstorm_workers_'))
+
+# recommendation math holds the GIL for most of a request, so throughput
+# scales with processes. A few threads per worker cover the db and network waits.
+workers = int(os.environ.get('CARDSTORM_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('CARDSTORM_THREADS', 4))
+
+timeout = int(os.environ.get('CARDSTORM_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = os.environ.get('CARDSTORM_ACCESS_LOG', '-')
@@ -0,0 +1,228 @@
+'''
+On-disk HTTP cache for the scrapers. Every page fetched with get() is kept
+in CARDSTORM_HTTP_CACHE. A page younger than the TTL of its URL class is
+served from disk, an older one is revalidated with If-None-Match and
+If-Modified-Since and only downloaded again if it changed.
+
+Set CARDSTORM_HTTP_OFFLINE=1 to replay the cache without touching the
+network: every cached page is served whatever its age, and a page that was
+never fetched gets an empty 504 response, which the scrapers skip like any
+other failed request.
+
+evict(), run by the scrapers when they finish, keeps the cache from growing
+forever: pages unused for CARDSTORM_HTTP_CACHE_MAX_AGE_DAYS are deleted, then
+the least recently used ones until it fits in CARDSTORM_HTTP_CACHE_MAX_MB.
+'''
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import requests
+import job_metrics
+
+# (URL class, pattern, TTL in seconds). None never expires. The TTL of a class
+# can be overridden with CARDSTORM_HTTP_TTL_<CLASS>, -1 for never.
+URL_CLASSES = [('front_page', re.compile(r'mtgtop8\.com/format\?'), 3600),
+               ('event', re.compile(r'mtgtop8\.com/event\?'), 7 * 24 * 3600),
+               ('deck', re.compile(r'mtgtop8\.com/mtgo\?'), None),
+               ('scryfall_search', re.compile(r'api\.scryfall\.com/cards/search'), 20 * 3600)]
+DEFAULT_TTL = 0
+
+STATS = {'fresh': 0, 'revalidated': 0, 'downloaded': 0, 'offline_misses': 0, 'evicted': 0}
+
+def _stat(name):
+    STATS[name] += 1
+    job_metrics.count('http_cache_{}'.format(name))
+
+class CachedResponse():
+    '''
+    The parts of a requests.Response the scrapers use.
+    '''
+
+    def __init__(self, status_code, content, encoding=None, from_cache=False):
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+def cache_dir():
+    return os.environ.get('CARDSTORM_HTTP_CACHE', os.path.expanduser('~/cardstorm_http_cache'))
+
+def offline():
+    return os.environ.get('CARDSTORM_HTTP_OFFLINE', '0') == '1'
+
+def get_ttl(url):
+    '''
+    OUTPUT:
+        - ttl: int, seconds a page of the URL's class is served without revalidating.
+               None if it never expires.
+    '''
+
+    for name, pattern, ttl in URL_CLASSES:
+        if pattern.search(url):
+            override = os.environ.get('CARDSTORM_HTTP_TTL_{}'.format(name.upper()))
+            if override is not None:
+                ttl = None if int(override) < 0 else int(override)
+            return ttl
+
+    return DEFAULT_TTL
+
+def _paths(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    directory = os.path.join(cache_dir(), key[:2])
+
+    return os.path.join(directory, key + '.json'), os.path.join(directory, key + '.body')
+
+def _write(path, data):
+    # written whole and renamed, so a concurrent reader never sees half a page
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+def _load(url):
+    meta_path, body_path = _paths(url)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        with open(body_path, 'rb') as f:
+            return meta, f.read()
+    except (OSError, ValueError):
+        return None, None
+
+def _touch(url):
+    # the metadata's mtime is the page's last use, which evict() goes by
+    try:
+        os.utime(_paths(url)[0])
+    except OSError:
+        pass
+
+def _store(url, meta, content=None):
+    meta_path, body_path = _paths(url)
+    if content is not None:
+        _write(body_path, content)
+    _write(meta_path, json.dumps(meta).encode())
+
+def get(url, headers=None, polite=True):
+    '''
+    Gets a page through the cache. Only 200 responses are cached.
+
+    INPUT:
+        - url: string
+        - headers: dictionary, extra request headers
+        - polite: bool, if True waits 0.1 to 1.1 seconds before going to the network
+
+    OUTPUT:
+        - response: CachedResponse, or the requests.Response of an uncacheable answer
+    '''
+
+    meta, content = _load(url)
+
+    if offline():
+        if meta is None:
+            _stat('offline_misses')
+            return CachedResponse(504, b'')
+        _stat('fresh')
+        _touch(url)
+        return CachedResponse(200, content, meta['encoding'], from_cache=True)
+
+    ttl = get_ttl(url)
+    now = time.time()
+    if meta is not None and (ttl is None or now - meta['fetched_at'] < ttl):
+        _stat('fresh')
+        _touch(url)
+        return CachedResponse(200, content, meta['encoding'], from_cache=True)
+
+    headers = dict(headers or {})
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    if polite:
+        # preventing submitting too fast
+        with job_metrics.timed('sleep'):
+            time.sleep(0.1 + random.random())
+    with job_metrics.timed('http'):
+        response = requests.get(url, headers=headers)
+    job_metrics.count('http_requests')
+    job_metrics.count('http_bytes', len(response.content))
+
+    if response.status_code == 304 and meta is not None:
+        _stat('revalidated')
+        meta['fetched_at'] = now
+        _store(url, meta)
+        return CachedResponse(200, content, meta['encoding'], from_cache=True)
+
+    if response.status_code != 200:
+        return response
+
+    _stat('downloaded')
+    meta = {'url': url,
+            'fetched_at': now,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'encoding': response.encoding or response.apparent_encoding}
+    _store(url, meta, response.content)
+
+    return CachedResponse(200, response.content, meta['encoding'])
+
+def evict(max_age_days=None, max_mb=None):
+    '''
+    Deletes the pages unused for max_age_days, then the least recently used
+    ones until the cache holds at most max_mb.
+
+    INPUT:
+        - max_age_days: float, CARDSTORM_HTTP_CACHE_MAX_AGE_DAYS (90) if None
+        - max_mb: float, CARDSTORM_HTTP_CACHE_MAX_MB (2048) if None
+
+    OUTPUT:
+        - evicted: int, number of pages deleted
+    '''
+
+    if max_age_days is None:
+        max_age_days = float(os.environ.get('CARDSTORM_HTTP_CACHE_MAX_AGE_DAYS', 90))
+    if max_mb is None:
+        max_mb = float(os.environ.get('CARDSTORM_HTTP_CACHE_MAX_MB', 2048))
+    if not os.path.isdir(cache_dir()):
+        return 0
+
+    # (last use, bytes, metadata path, body path), the least recently used first
+    entries = []
+    for directory, _, file_names in os.walk(cache_dir()):
+        for file_name in file_names:
+            if not file_name.endswith('.json'):
+                continue
+            meta_path = os.path.join(directory, file_name)
+            body_path = meta_path[:-len('.json')] + '.body'
+            try:
+                size = os.path.getsize(meta_path) + os.path.getsize(body_path)
+                entries.append((os.path.getmtime(meta_path), size, meta_path, body_path))
+            except OSError:
+                continue
+    entries.sort()
+
+    oldest = time.time() - max_age_days * 24 * 3600
+    total = sum(entry[1] for entry in entries)
+    evicted = 0
+    for last_use, size, meta_path, body_path in entries:
+        if last_use >= oldest and total <= max_mb * 1024 * 1024:
+            break
+        for path in (meta_path, body_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+        evicted += 1
+        _stat('evicted')
+
+    return evicted
@@ -1,42 +1,65 @@
 import boto3
-import os
 import requests
-import psycopg2
+import db
+import job_metrics
 import time
 from OpenSSL.SSL import SysCallError
 
 
-def scrape_images():
+def get_uploaded_cardstorm_ids(s3):
     '''
-    Scrapes images for all cards in the cards db. saves to s3 bucket
+    OUTPUT:
+        - cardstorm_ids: set of ints, the cards whose image is already in the s3 bucket
     '''
 
-    hostname = os.environ['CARDSTORM_DB_HOST']
-    dbname = os.environ['CARDSTORM_DB_DBNAME']
-    username = os.environ['CARDSTORM_DB_USERNAME']
-    password = os.environ['CARDSTORM_DB_PASSWORD']
+    cardstorm_ids = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket='mtg-capstone', Prefix='card_images/jpg/'):
+        for item in page.get('Contents', []):
+            name = item['Key'].rsplit('/', 1)[-1]
+            if name.endswith('.jpg') and name[:-len('.jpg')].isdigit():
+                cardstorm_ids.add(int(name[:-len('.jpg')]))
+
+    return cardstorm_ids
 
-    conn = psycopg2.connect('dbname={} host={} user={} password={}'.format(dbname, hostname, username, password))
-    cursor = conn.cursor()
+def scrape_images():
+    '''
+    Scrapes images for the cards in the cards db that don't have one yet.
+    saves to s3 bucket
+    '''
 
+    job_metrics.start('image_scraping')
     s3 = boto3.client('s3')
+    # runs nightly after the card scraper, only new cards need an image
+    uploaded = get_uploaded_cardstorm_ids(s3)
 
-    cursor.execute('SELECT scryfall_id, cardstorm_id, name FROM cards')
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT scryfall_id, cardstorm_id, name FROM cards')
 
-    all_cards = cursor.fetchall()
+        all_cards = [card for card in cursor.fetchall() if card[1] not in uploaded]
+    job_metrics.count('images_already_uploaded', len(uploaded))
     length = len(all_cards)
     counter = 1
     for scryfall_id, cardstorm_id, name in all_cards:
         url = 'https://api.scryfall.com/cards/{}?format=image'.format(scryfall_id)
         try:
-            image = requests.get(url)
-            s3.put_object(Bucket='mtg-capstone', Key='card_images/jpg/{}.jpg'.format(cardstorm_id), Body=image.content)
+            with job_metrics.timed('http'):
+                image = requests.get(url)
+            job_metrics.count('http_requests')
+            job_metrics.count('http_bytes', len(image.content))
+            with job_metrics.timed('s3'):
+                s3.put_object(Bucket='mtg-capstone', Key='card_images/jpg/{}.jpg'.format(cardstorm_id), Body=image.content)
+            job_metrics.count('images_uploaded')
         except SysCallError:
+            job_metrics.count('image_failures')
             print('\tproblem getting image for {}'.format(name))
 
         print('{} done, {}/{}'.format(name.lower(), counter, length))
 
         counter += 1
 
+    print('run report: {}'.format(job_metrics.write()))
+
 if __name__ == '__main__':
     scrape_images()
@@ -0,0 +1,188 @@
+'''
+Run reports for the batch jobs. A job calls start() once, the code it runs
+adds to counters with count() and times its phases with timed(), and
+write() saves a JSON report of the run to CARDSTORM_REPORT_DIR:
+
+    {"job": "deck_scraping", "labels": {"format": "modern"}, "seconds": 812.3,
+     "counters": {"http_requests": 412, "rows_inserted": 20931, ...},
+     "rates": {"http_requests_per_second": 0.51, ...},
+     "phases": {"http": {"seconds": 301.2, "count": 412}, "sleep": ..., ...},
+     "peak_memory_bytes": 183500800, ...}
+
+Set CARDSTORM_PROMETHEUS_TEXTFILE_DIR to also write the run as a Prometheus
+textfile, i.e. for node_exporter's textfile collector.
+
+Counters and phases live in the process that records them: a job that
+forks workers starts a report in every worker.
+'''
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_job = None
+_labels = {}
+_started_at = None
+_start_time = time.perf_counter()
+_counters = {}
+# phase -> [seconds, count]
+_phases = {}
+_sections = {}
+
+def start(job, **labels):
+    '''
+    Starts the report of a run, dropping whatever was recorded before.
+
+    INPUT:
+        - job: string, i.e. 'deck_scraping'
+        - labels: strings telling runs of the job apart, i.e. format='modern'
+    '''
+
+    global _job, _labels, _started_at, _start_time
+
+    with _lock:
+        _job, _labels = job, labels
+        _started_at = datetime.datetime.now()
+        _start_time = time.perf_counter()
+        _counters.clear()
+        _phases.clear()
+        _sections.clear()
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def add_seconds(phase, seconds):
+    with _lock:
+        totals = _phases.setdefault(phase, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+@contextmanager
+def timed(phase):
+    '''
+    Adds the time spent in the enclosed block to phase.
+    '''
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_seconds(phase, time.perf_counter() - start_time)
+
+def record(name, value):
+    '''
+    Adds a JSON-serializable section to the report, i.e. the Spark stages.
+    '''
+
+    with _lock:
+        _sections[name] = value
+
+def peak_memory_bytes():
+    '''
+    OUTPUT:
+        - peak: int, highest resident memory of this process plus that of its
+                largest finished child
+    '''
+
+    # ru_maxrss is in kilobytes on Linux
+    return 1024 * (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                   + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def report():
+    '''
+    OUTPUT:
+        - report: dictionary, everything recorded since start()
+    '''
+
+    seconds = time.perf_counter() - _start_time
+
+    with _lock:
+        report = {'job': _job,
+                  'labels': dict(_labels),
+                  'started_at': _started_at.isoformat() if _started_at else None,
+                  'finished_at': datetime.datetime.now().isoformat(),
+                  'seconds': round(seconds, 3),
+                  'counters': dict(_counters),
+                  'rates': {'{}_per_second'.format(name): value / seconds if seconds else None
+                            for name, value in _counters.items()},
+                  'phases': {phase: {'seconds': round(totals[0], 3), 'count': totals[1]}
+                             for phase, totals in _phases.items()},
+                  'peak_memory_bytes': peak_memory_bytes()}
+        report.update(_sections)
+
+    return report
+
+def _name():
+    return '_'.join([_job or 'job'] + [str(value) for value in _labels.values()])
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+def _prometheus_labels(pairs):
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+def prometheus_text(report):
+    '''
+    Renders a report as gauges in the Prometheus text exposition format. Every
+    counter becomes a cardstorm_job_<counter> gauge.
+
+    OUTPUT:
+        - text: string
+    '''
+
+    job_labels = [('job', report['job'])] + sorted(report['labels'].items())
+    labels = _prometheus_labels(job_labels)
+    lines = []
+
+    def gauge(name, documentation, samples):
+        lines.append('# HELP {} {}'.format(name, documentation))
+        lines.append('# TYPE {} gauge'.format(name))
+        for sample_labels, value in samples:
+            lines.append('{}{} {}'.format(name, sample_labels, value))
+
+    gauge('cardstorm_job_duration_seconds', 'Wall time of the last run of the job.',
+          [(labels, report['seconds'])])
+    gauge('cardstorm_job_last_run_timestamp_seconds', 'When the last run of the job finished.',
+          [(labels, round(time.time(), 3))])
+    gauge('cardstorm_job_peak_memory_bytes', 'Peak resident memory of the last run of the job.',
+          [(labels, report['peak_memory_bytes'])])
+    gauge('cardstorm_job_phase_seconds', 'Time the last run of the job spent in each phase.',
+          [(_prometheus_labels(job_labels + [('phase', phase)]), totals['seconds'])
+           for phase, totals in sorted(report['phases'].items())])
+    for name, value in sorted(report['counters'].items()):
+        gauge('cardstorm_job_{}'.format(name), 'Total {} of the last run of the job.'.format(name),
+              [(labels, value)])
+
+    return '\n'.join(lines) + '\n'
+
+def write():
+    '''
+    Writes the report to CARDSTORM_REPORT_DIR/<job>_<labels>_<time>.json, and
+    to CARDSTORM_PROMETHEUS_TEXTFILE_DIR/cardstorm_<job>_<labels>.prom if set.
+
+    OUTPUT:
+        - path: string, path of the JSON report
+    '''
+
+    run_report = report()
+    directory = os.environ.get('CARDSTORM_REPORT_DIR', os.path.expanduser('~/cardstorm_reports'))
+    path = os.path.join(directory, '{}_{}.json'.format(_name(),
+                                                       datetime.datetime.now().strftime('%Y%m%dT%H%M%S')))
+    _write(path, json.dumps(run_report, indent=2))
+
+    textfile_dir = os.environ.get('CARDSTORM_PROMETHEUS_TEXTFILE_DIR')
+    if textfile_dir:
+        _write(os.path.join(textfile_dir, 'cardstorm_{}.prom'.format(_name())),
+               prometheus_text(run_report))
+
+    return path
@@ -0,0 +1,289 @@
+import os
+import threading
+import time
+import shared_state
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+# under gunicorn every worker publishes its metrics to the shared state
+# directory at most this often, and /metrics adds up every worker's
+PUBLISH_SECONDS = 1.0
+
+_local = threading.local()
+
+class Histogram():
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> [bucket counts..., +Inf count], sum
+        self._counts = {}
+        self._sums = {}
+
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+
+        with self._lock:
+            if key not in self._counts:
+                self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0.0
+            counts = self._counts[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._sums[key] += value
+
+    def dump(self):
+        '''
+        OUTPUT:
+            - series: list of [label values, bucket counts, sum], JSON-serializable
+        '''
+
+        with self._lock:
+            return [[list(key), list(counts), self._sums[key]] for key, counts in self._counts.items()]
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+            self._sums = {}
+
+    def expose(self, dumps=None):
+        '''
+        Renders the histogram in the Prometheus text exposition format.
+
+        INPUT:
+            - dumps: list of dump() outputs of every process, added up. This
+                     process's histogram if None.
+
+        OUTPUT:
+            - lines: list of strings, one per exposition line
+        '''
+
+        if dumps is None:
+            dumps = [self.dump()]
+
+        counts_by_key, sums = {}, {}
+        for series in dumps:
+            for key, counts, total in series:
+                key = tuple(key)
+                if key not in counts_by_key:
+                    counts_by_key[key] = [0] * len(counts)
+                    sums[key] = 0.0
+                counts_by_key[key] = [a + b for a, b in zip(counts_by_key[key], counts)]
+                sums[key] += total
+
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+
+        for key in sorted(counts_by_key):
+            counts = counts_by_key[key]
+            pairs = list(zip(self.labelnames, key))
+            labels = _format_labels(pairs)
+            bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                lines.append('{}_bucket{} {}'.format(self.name,
+                             _format_labels(pairs + [('le', bound)]), count))
+            lines.append('{}_sum{} {}'.format(self.name, labels, sums[key]))
+            lines.append('{}_count{} {}'.format(self.name, labels, counts[-1]))
+
+        return lines
+
+class Gauge():
+
+    def __init__(self, name, documentation, function=None):
+        '''
+        INPUT:
+            - function: callable returning the current value. If given, it is
+                        called every time the gauge is exposed.
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0.0
+
+        REGISTRY.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def dump(self):
+        return self.function() if self.function is not None else self.value
+
+    def reset(self):
+        pass
+
+    def expose(self, dumps=None):
+        '''
+        INPUT:
+            - dumps: list of dump() outputs of every running process, added up.
+                     This process's value if None.
+        '''
+
+        value = self.dump() if dumps is None else sum(dumps)
+
+        return ['# HELP {} {}'.format(self.name, self.documentation),
+                '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, value)]
+
+def _format_labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+
+    escaped = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+               for name, value in pairs]
+
+    return '{' + ','.join(escaped) + '}'
+
+_publish_lock = threading.Lock()
+_last_publish = None
+_publish_timer = None
+
+def _write_snapshot():
+    global _last_publish, _publish_timer
+
+    with _publish_lock:
+        _publish_timer = None
+        _last_publish = time.monotonic()
+    shared_state.write('metrics_{}'.format(os.getpid()),
+                       {'pid': os.getpid(),
+                        'metrics': {metric.name: metric.dump() for metric in REGISTRY}})
+
+def publish():
+    '''
+    Writes this process's metrics to the shared state directory for the
+    other workers' /metrics, at most once every PUBLISH_SECONDS: a call in
+    between schedules the write for the end of the interval.
+    '''
+
+    global _publish_timer
+
+    if shared_state.directory() is None:
+        return
+
+    with _publish_lock:
+        wait = 0 if _last_publish is None else _last_publish + PUBLISH_SECONDS - time.monotonic()
+        if wait > 0:
+            if _publish_timer is None:
+                _publish_timer = threading.Timer(wait, _write_snapshot)
+                _publish_timer.daemon = True
+                _publish_timer.start()
+            return
+
+    _write_snapshot()
+
+def reset():
+    '''
+    Drops everything recorded so far, i.e. in the gunicorn master once it has
+    published its loading spans, so the workers don't each count them again.
+    '''
+
+    global _last_publish
+
+    for metric in REGISTRY:
+        metric.reset()
+    _last_publish = None
+
+def render():
+    '''
+    Renders every registered metric in the Prometheus text exposition format.
+    Under gunicorn the histograms add up every worker that ever published,
+    and the gauges every worker still running, so the numbers don't depend on
+    which worker answers.
+
+    INPUT:
+        NONE
+
+    OUTPUT:
+        - text: string, body for a /metrics response
+    '''
+
+    lines = []
+    if shared_state.directory() is None:
+        for metric in REGISTRY:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+    _write_snapshot()
+    snapshots = shared_state.read_all('metrics_')
+    for metric in REGISTRY:
+        dumps = [snapshot['metrics'][metric.name] for snapshot in snapshots
+                 if metric.name in snapshot['metrics']
+                 and (isinstance(metric, Histogram) or shared_state.alive(snapshot['pid']))]
+        lines.extend(metric.expose(dumps))
+
+    return '\n'.join(lines) + '\n'
+
+STAGE_SECONDS = Histogram('cardstorm_stage_seconds',
+                          'Time spent in each stage of the recommendation path.',
+                          labelnames=['stage'])
+
+REQUEST_SECONDS = Histogram('cardstorm_request_seconds',
+                            'Total time spent handling a request.',
+                            labelnames=['endpoint'])
+
+def start_trace():
+    '''
+    Starts collecting spans for the request handled by the current thread.
+    '''
+    _local.spans = []
+
+def finish_trace():
+    '''
+    Stops collecting spans for the current thread.
+
+    OUTPUT:
+        - spans: list of (stage, seconds) tuples, in the order they finished
+    '''
+    spans = getattr(_local, 'spans', None) or []
+    _local.spans = None
+
+    return spans
+
+@contextmanager
+def span(stage):
+    '''
+    Times the enclosed block. The duration is recorded in the stage histogram
+    and, when a trace is active on this thread, in the per-request span list.
+
+    INPUT:
+        - stage: string, name of the stage being timed
+    '''
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+def server_timing_header(spans):
+    '''
+    Formats spans as a Server-Timing header value. Repeated stages are summed.
+
+    INPUT:
+        - spans: list of (stage, seconds) tuples
+
+    OUTPUT:
+        - header: string, i.e. 'lstsq;dur=1.234, argsort;dur=0.456'
+    '''
+
+    totals = {}
+    for stage, seconds in spans:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+    return ', '.join('{};dur={:.3f}'.format(stage, seconds * 1000)
+                     for stage, seconds in totals.items())
@@ -0,0 +1,427 @@
+'''
+Versioned schema migrations. Every table the jobs and the web app use is
+created and changed here, one numbered migration at a time, and
+schema_migrations records which ones a database has applied.
+
+    python src/migrations.py migrate
+    python src/migrations.py status
+    python src/migrations.py check
+
+Applied migrations never run again, so a schema change is always a new
+migration appended to MIGRATIONS, never an edit of an old one. The first
+migrations tolerate databases created before migrations existed. On the
+embedded backend they create the same tables, minus what DuckDB doesn't
+support or need.
+'''
+import argparse
+import json
+import sys
+import psycopg2
+import db
+
+# any constant shared by every migrator, see pg_advisory_xact_lock
+LOCK_ID = 4726
+
+def _serial(cursor, table, column):
+    '''
+    Column definition of an autoincrementing integer key.
+    '''
+
+    if not db.embedded():
+        return 'SERIAL'
+
+    sequence = '{}_{}_seq'.format(table, column)
+    cursor.execute('CREATE SEQUENCE IF NOT EXISTS {}'.format(sequence))
+
+    return "INTEGER DEFAULT nextval('{}')".format(sequence)
+
+def _base_tables(cursor):
+    '''
+    The tables the scrapers and the model have always written.
+    '''
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS cards (
+                          cardstorm_id {} PRIMARY KEY,
+                          name TEXT NOT NULL UNIQUE,
+                          cmc REAL,
+                          type_line TEXT,
+                          oracle_text TEXT,
+                          mana_cost TEXT,
+                          power TEXT,
+                          toughness TEXT,
+                          colors TEXT[],
+                          color_identity TEXT[],
+                          legalities TEXT[],
+                          set_id TEXT,
+                          set_name TEXT,
+                          collector_number TEXT,
+                          scryfall_id TEXT,
+                          layout TEXT)'''.format(_serial(cursor, 'cards', 'cardstorm_id')))
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS decks (
+                          event_id INTEGER NOT NULL,
+                          deck_id INTEGER NOT NULL,
+                          cardstorm_id INTEGER NOT NULL,
+                          card_count INTEGER NOT NULL)''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS product_matrices (
+                          cardstorm_id INTEGER NOT NULL,
+                          features DOUBLE PRECISION[] NOT NULL,
+                          date DATE NOT NULL,
+                          run_id INTEGER NOT NULL)''')
+
+def _model_registry(cursor):
+    '''
+    The model run registry. Runs already in product_matrices are registered
+    as ready and the newest one is promoted, so the web app keeps serving the
+    model it served before.
+    '''
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS model_runs (
+                          run_id {} PRIMARY KEY,
+                          status TEXT NOT NULL
+                              CHECK (status IN ('training', 'ready', 'promoted', 'retired')),
+                          rank INTEGER,
+                          created_at TIMESTAMP NOT NULL DEFAULT now(),
+                          ready_at TIMESTAMP,
+                          promoted_at TIMESTAMP,
+                          retired_at TIMESTAMP,
+                          pruned_at TIMESTAMP)'''.format(_serial(cursor, 'model_runs', 'run_id')))
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS current_model (
+                          singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+                          run_id INTEGER NOT NULL REFERENCES model_runs (run_id))''')
+
+    if db.embedded():
+        # a new embedded database has no runs from before the registry
+        cursor.execute('''CREATE TABLE IF NOT EXISTS product_matrices_archive AS
+                          SELECT * FROM product_matrices WHERE false''')
+        return
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS product_matrices_archive
+                          (LIKE product_matrices)''')
+
+    cursor.execute('''INSERT INTO model_runs (run_id, status, ready_at)
+                      SELECT DISTINCT run_id, 'ready', now()
+                      FROM product_matrices
+                      WHERE NOT EXISTS (SELECT 1 FROM model_runs)''')
+    cursor.execute('''SELECT setval(pg_get_serial_sequence('model_runs', 'run_id'),
+                                    COALESCE(MAX(run_id), 0) + 1, false)
+                      FROM model_runs''')
+
+    cursor.execute('SELECT run_id FROM current_model')
+    if cursor.fetchone() is None:
+        cursor.execute('''UPDATE model_runs
+                          SET status = 'promoted', promoted_at = now()
+                          WHERE run_id = (SELECT MAX(run_id) FROM model_runs
+                                          WHERE status = 'ready')
+                          RETURNING run_id''')
+        row = cursor.fetchone()
+        if row is not None:
+            cursor.execute('INSERT INTO current_model (run_id) VALUES (%s)', row)
+
+def _model_evaluations(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS model_evaluations (
+                          evaluation_id {} PRIMARY KEY,
+                          run_id INTEGER,
+                          date DATE NOT NULL,
+                          rank INTEGER NOT NULL,
+                          reg_param REAL NOT NULL,
+                          alpha REAL NOT NULL,
+                          max_iter INTEGER NOT NULL,
+                          n_test_decks INTEGER NOT NULL,
+                          recall_at_10 REAL NOT NULL,
+                          ndcg_at_10 REAL NOT NULL,
+                          fit_seconds REAL,
+                          score_ms_per_deck REAL)'''.format(_serial(cursor, 'model_evaluations',
+                                                                     'evaluation_id')))
+
+def _archetypes(cursor):
+    '''
+    Archetypes belong to the model run whose factors they were clustered with.
+    '''
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS archetypes (
+                          run_id INTEGER NOT NULL,
+                          archetype_id INTEGER NOT NULL,
+                          date DATE NOT NULL,
+                          n_decks INTEGER NOT NULL,
+                          centroid REAL[] NOT NULL,
+                          candidates INTEGER[] NOT NULL,
+                          PRIMARY KEY (run_id, archetype_id))''')
+
+def _formats(cursor):
+    '''
+    Decks, runs and evaluations belong to a format, and everything from
+    before formats existed is Modern. current_model goes from a single row
+    to one row per format. card_partners is rebuilt every night, so one from
+    before formats is just dropped.
+    '''
+
+    # DuckDB can't add a column with a constraint
+    not_null = '' if db.embedded() else 'NOT NULL'
+    for table in ('decks', 'model_runs', 'model_evaluations'):
+        cursor.execute('''ALTER TABLE {}
+                          ADD COLUMN IF NOT EXISTS format TEXT {} DEFAULT 'modern' '''.format(table, not_null))
+
+    if db.embedded():
+        # nor drop a key column, and a new embedded database has no current model yet
+        cursor.execute('DROP TABLE current_model')
+        cursor.execute('''CREATE TABLE current_model (
+                              format TEXT PRIMARY KEY,
+                              run_id INTEGER NOT NULL)''')
+        return
+
+    cursor.execute('''ALTER TABLE current_model
+                      ADD COLUMN IF NOT EXISTS format TEXT NOT NULL DEFAULT 'modern' ''')
+    cursor.execute('''SELECT 1 FROM information_schema.columns
+                      WHERE table_name = 'current_model' AND column_name = 'singleton' ''')
+    if cursor.fetchone() is not None:
+        cursor.execute('ALTER TABLE current_model DROP COLUMN singleton')
+        cursor.execute('ALTER TABLE current_model ADD PRIMARY KEY (format)')
+
+    cursor.execute('''SELECT 1 FROM information_schema.tables
+                      WHERE table_name = 'card_partners'
+                        AND NOT EXISTS (SELECT 1 FROM information_schema.columns
+                                        WHERE table_name = 'card_partners'
+                                          AND column_name = 'format')''')
+    if cursor.fetchone() is not None:
+        cursor.execute('DROP TABLE card_partners')
+
+def _card_partners(cursor):
+    '''
+    Every card keeps only its best partners in each format, ordered by lift.
+    '''
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS card_partners (
+                          format TEXT NOT NULL,
+                          cardstorm_id INTEGER NOT NULL,
+                          date DATE NOT NULL,
+                          n_decks INTEGER NOT NULL,
+                          partners INTEGER[] NOT NULL,
+                          lifts REAL[] NOT NULL,
+                          PRIMARY KEY (format, cardstorm_id))''')
+
+def _hot_query_indexes(cursor):
+    '''
+    Indexes for the queries in HOT_QUERIES. The unique ones are also what
+    makes re-uploading a deck or a run's features raise IntegrityError.
+    '''
+
+    # a deck scraped twice, or listing a card twice, has more than one row per
+    # card, which would fail the unique index: keep the row with the most copies
+    cursor.execute('''SELECT COUNT(*) FROM (SELECT deck_id, cardstorm_id FROM decks
+                                             GROUP BY deck_id, cardstorm_id
+                                             HAVING COUNT(*) > 1) AS duplicates''')
+    n_duplicates = cursor.fetchone()[0]
+    if n_duplicates and not db.embedded():
+        print('keeping one row of {} duplicated deck cards'.format(n_duplicates))
+        cursor.execute('''DELETE FROM decks AS a USING decks AS b
+                          WHERE a.deck_id = b.deck_id AND a.cardstorm_id = b.cardstorm_id
+                            AND (a.card_count < b.card_count
+                                 OR (a.card_count = b.card_count AND a.ctid < b.ctid))''')
+    elif n_duplicates:
+        # DuckDB still indexes the rows deleted earlier in the transaction, so
+        # the table is rebuilt from the rows kept
+        print('keeping one row of {} duplicated deck cards'.format(n_duplicates))
+        cursor.execute('''CREATE TEMPORARY TABLE decks_kept AS
+                          SELECT event_id, deck_id, cardstorm_id, card_count, format
+                          FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY deck_id, cardstorm_id
+                                                             ORDER BY card_count DESC) AS n
+                                FROM decks) AS numbered
+                          WHERE n = 1''')
+        cursor.execute('DROP TABLE decks')
+        cursor.execute('''CREATE TABLE decks (
+                              event_id INTEGER NOT NULL,
+                              deck_id INTEGER NOT NULL,
+                              cardstorm_id INTEGER NOT NULL,
+                              card_count INTEGER NOT NULL,
+                              format TEXT DEFAULT 'modern')''')
+        cursor.execute('INSERT INTO decks SELECT * FROM decks_kept')
+        cursor.execute('DROP TABLE decks_kept')
+
+    # the scraper's already-scraped deck ids, and one row per card of a deck
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS decks_deck_id_cardstorm_id
+                      ON decks (deck_id, cardstorm_id)''')
+    # serving a run reads its features in cardstorm_id order, pruning deletes by run
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS product_matrices_run_id_cardstorm_id
+                      ON product_matrices (run_id, cardstorm_id)''')
+    if db.embedded():
+        # DuckDB scans columns, its indexes only serve point lookups
+        return
+
+    # a format's ratings and its popularity, both read from the index alone
+    cursor.execute('''CREATE INDEX IF NOT EXISTS decks_format_cardstorm_id
+                      ON decks (format, cardstorm_id) INCLUDE (deck_id, card_count)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS product_matrices_archive_run_id
+                      ON product_matrices_archive (run_id)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS model_runs_format_status
+                      ON model_runs (format, status)''')
+
+def _type_line_trigrams(cursor):
+    '''
+    The land filters match type_line against '%Land%', which only a trigram
+    index can serve. Databases where pg_trgm can't be installed keep scanning.
+    '''
+
+    if db.embedded():
+        return
+
+    cursor.execute('SAVEPOINT pg_trgm')
+    try:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except psycopg2.Error as error:
+        cursor.execute('ROLLBACK TO SAVEPOINT pg_trgm')
+        print('pg_trgm is not available, cards.type_line is not indexed: {}'.format(error))
+        return
+
+    cursor.execute('''CREATE INDEX IF NOT EXISTS cards_type_line_trgm
+                      ON cards USING gin (type_line gin_trgm_ops)''')
+
+# (version, name, migration) in the order they are applied
+MIGRATIONS = [(1, 'base tables', _base_tables),
+              (2, 'model registry', _model_registry),
+              (3, 'model evaluations', _model_evaluations),
+              (4, 'archetypes', _archetypes),
+              (5, 'formats', _formats),
+              (6, 'card partners', _card_partners),
+              (7, 'hot query indexes', _hot_query_indexes),
+              (8, 'type_line trigrams', _type_line_trigrams)]
+
+# (name, query, tables the query must never sequentially scan). Literals stand
+# in for the parameters the code binds.
+HOT_QUERIES = [
+    ('scraped deck ids', 'SELECT DISTINCT deck_id FROM decks', ('decks',)),
+    ('ratings', '''SELECT deck_id, cardstorm_id, card_count FROM decks
+                   WHERE format = 'modern' ''', ('decks',)),
+    ('popularity', '''SELECT cardstorm_id, SUM(card_count) AS n_copies FROM decks
+                      WHERE format = 'modern'
+                      GROUP BY cardstorm_id ORDER BY n_copies DESC''', ('decks',)),
+    ('current run', "SELECT run_id FROM current_model WHERE format = 'modern'",
+     ('current_model',)),
+    ('feature matrix', '''SELECT cardstorm_id, features FROM product_matrices
+                          WHERE run_id = 1 ORDER BY cardstorm_id ASC''', ('product_matrices',)),
+    ('newest run', 'SELECT MAX(run_id) FROM product_matrices', ('product_matrices',)),
+    ('prune run', 'DELETE FROM product_matrices WHERE run_id = ANY(ARRAY[1, 2])',
+     ('product_matrices',)),
+    ('archetypes', '''SELECT centroid, candidates FROM archetypes
+                      WHERE run_id = 1 ORDER BY archetype_id''', ('archetypes',)),
+    ('card partners', '''SELECT cardstorm_id, partners, lifts FROM card_partners
+                         WHERE format = 'modern' ''', ('card_partners',)),
+    ('land filter', '''SELECT cardstorm_id FROM cards
+                       WHERE type_line LIKE '%Land%' AND NOT type_line LIKE '%//%Land%' ''',
+     ('cards',)),
+]
+
+def create_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                          version INTEGER PRIMARY KEY,
+                          name TEXT NOT NULL,
+                          applied_at TIMESTAMP NOT NULL DEFAULT now())''')
+
+def applied_versions(cursor):
+    cursor.execute('SELECT version FROM schema_migrations')
+
+    return {_[0] for _ in cursor.fetchall()}
+
+def migrate(cursor):
+    '''
+    Applies every migration the database doesn't have yet, in order, in the
+    caller's transaction. Concurrent callers (i.e. the per-format training
+    processes) wait on an advisory lock, so each migration runs exactly once.
+
+    INPUT:
+        - cursor: psycopg2 cursor object
+
+    OUTPUT:
+        - applied: list of ints, the versions applied by this call
+    '''
+
+    create_tables(cursor)
+    if not db.embedded():
+        # the embedded database only ever has one writer
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [LOCK_ID])
+
+    done = applied_versions(cursor)
+    applied = []
+    for version, name, migration in MIGRATIONS:
+        if version in done:
+            continue
+        print('applying migration {}: {}'.format(version, name))
+        migration(cursor)
+        cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                       [version, name])
+        applied.append(version)
+
+    return applied
+
+def _seq_scans(plan, tables):
+    '''
+    Walks an EXPLAIN (FORMAT JSON) plan for sequential scans of tables.
+    '''
+
+    scans = []
+    if plan['Node Type'] == 'Seq Scan' and plan['Relation Name'] in tables:
+        scans.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        scans.extend(_seq_scans(child, tables))
+
+    return scans
+
+def check_plans(cursor):
+    '''
+    EXPLAINs every query in HOT_QUERIES with sequential scans priced out, so
+    a Seq Scan left in a plan means no index can serve the query, however
+    small the tables are in the database checked.
+
+    OUTPUT:
+        - failures: list of (name, tables sequentially scanned) tuples
+    '''
+
+    if db.embedded():
+        print('the embedded backend scans columns, there are no plans to check')
+        return []
+
+    cursor.execute('SET LOCAL enable_seqscan = off')
+
+    failures = []
+    for name, query, tables in HOT_QUERIES:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scans = _seq_scans(plan[0]['Plan'], tables)
+        print('{:<20}{}'.format(name, 'seq scan on ' + ', '.join(scans) if scans else 'ok'))
+        if scans:
+            failures.append((name, scans))
+
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='manage the cardstorm database schema')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('migrate', help='apply the pending migrations')
+    subparsers.add_parser('status', help='list applied and pending migrations')
+    subparsers.add_parser('check', help='fail if a hot query sequentially scans a table')
+    args = parser.parse_args()
+
+    failures = []
+    with db.transaction() as cursor:
+        if args.command == 'migrate':
+            print('applied migrations: {}'.format(migrate(cursor)))
+        elif args.command == 'status':
+            create_tables(cursor)
+            done = applied_versions(cursor)
+            for version, name, _ in MIGRATIONS:
+                print('{}\t{}\t{}'.format(version, 'applied' if version in done else 'pending', name))
+        elif args.command == 'check':
+            migrate(cursor)
+            failures = check_plans(cursor)
+    db.close_pool()
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
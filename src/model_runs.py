@@ -0,0 +1,188 @@
+import argparse
+import datetime
+import db
+import migrations
+from catalog import DEFAULT_FORMAT, FORMATS
+
+# training -> ready -> promoted -> retired. Only one run per format is promoted
+# at a time, and that run is the one current_model points at for the format.
+STATUSES = ('training', 'ready', 'promoted', 'retired')
+
+def start_run(cursor, rank=None, format=DEFAULT_FORMAT):
+    '''
+    Registers a new run before any of its features are uploaded.
+
+    OUTPUT:
+        - run_id: int, the run_id to upload features under
+    '''
+
+    cursor.execute('''INSERT INTO model_runs (status, rank, format)
+                      VALUES ('training', %s, %s)
+                      RETURNING run_id''', [rank, format])
+
+    return cursor.fetchone()[0]
+
+def mark_ready(cursor, run_id):
+    '''
+    Marks a run as completely uploaded. Only ready runs can be promoted.
+    '''
+
+    cursor.execute('''UPDATE model_runs
+                      SET status = 'ready', ready_at = now()
+                      WHERE run_id = %s AND status = 'training' ''', [run_id])
+
+    return cursor.rowcount == 1
+
+def promote_run(cursor, run_id):
+    '''
+    Points current_model at run_id for the run's format and retires the run
+    previously promoted for that format. A retired run that hasn't been pruned
+    can be promoted again to roll back.
+
+    Everything happens in the caller's transaction, so the web app sees either
+    the old run or the new one once it is committed.
+
+    INPUT:
+        - cursor: psycopg2 cursor object
+        - run_id: int, run to promote
+
+    OUTPUT:
+        - success: bool, False if the run doesn't exist, is still training or was pruned
+    '''
+
+    # serializes promotions, readers of current_model are not blocked. The
+    # embedded database only ever has one writer.
+    if not db.embedded():
+        cursor.execute('LOCK TABLE current_model IN EXCLUSIVE MODE')
+
+    cursor.execute('''UPDATE model_runs
+                      SET status = 'promoted', promoted_at = now(), retired_at = NULL
+                      WHERE run_id = %s
+                        AND status IN ('ready', 'retired', 'promoted')
+                        AND pruned_at IS NULL
+                      RETURNING format''', [run_id])
+    if cursor.rowcount != 1:
+        return False
+    format = cursor.fetchone()[0]
+
+    cursor.execute('''UPDATE model_runs
+                      SET status = 'retired', retired_at = now()
+                      WHERE status = 'promoted' AND format = %s AND run_id <> %s''',
+                   [format, run_id])
+
+    cursor.execute('''INSERT INTO current_model (format, run_id)
+                      VALUES (%s, %s)
+                      ON CONFLICT (format) DO UPDATE SET run_id = EXCLUDED.run_id''',
+                   [format, run_id])
+
+    return True
+
+def get_current_run_id(cursor, format=DEFAULT_FORMAT):
+    '''
+    Gets the run_id the web app should serve for a format.
+
+    OUTPUT:
+        - run_id: int, None if no run has been promoted for the format yet
+    '''
+
+    cursor.execute('SELECT run_id FROM current_model WHERE format = %s', [format])
+    row = cursor.fetchone()
+
+    return row[0] if row else None
+
+def prune_runs(cursor, keep=7, archive=False, stale_hours=24):
+    '''
+    Deletes the features of old runs from product_matrices. The promoted runs
+    and the newest `keep` retired or ready runs of every format are kept for
+    rollbacks. Runs
+    stuck in training for longer than stale_hours are half-written and are
+    pruned too.
+
+    INPUT:
+        - cursor: psycopg2 cursor object
+        - keep: int, number of non-promoted runs to keep per format
+        - archive: bool, if True rows are copied to product_matrices_archive first
+        - stale_hours: int, age after which a training run is considered dead
+
+    OUTPUT:
+        - pruned_run_ids: list of ints
+    '''
+
+    cursor.execute('''SELECT run_id
+                      FROM model_runs
+                      WHERE pruned_at IS NULL
+                        AND (
+                          (status IN ('ready', 'retired')
+                           AND run_id NOT IN (SELECT run_id
+                                              FROM (SELECT run_id,
+                                                           row_number() OVER (PARTITION BY format
+                                                                              ORDER BY run_id DESC)
+                                                               AS row_number
+                                                    FROM model_runs
+                                                    WHERE status IN ('ready', 'retired')
+                                                      AND pruned_at IS NULL) AS newest
+                                              WHERE row_number <= %s))
+                          OR (status = 'training'
+                              AND created_at < now() - %s * INTERVAL '1 hour'))''',
+                   [keep, stale_hours])
+    pruned_run_ids = [_[0] for _ in cursor.fetchall()]
+
+    if not pruned_run_ids:
+        return pruned_run_ids
+
+    if archive:
+        cursor.execute('''INSERT INTO product_matrices_archive
+                          SELECT * FROM product_matrices
+                          WHERE run_id = ANY(%s)''', [pruned_run_ids])
+
+    cursor.execute('DELETE FROM product_matrices WHERE run_id = ANY(%s)', [pruned_run_ids])
+    cursor.execute('''UPDATE model_runs
+                      SET status = 'retired', retired_at = COALESCE(retired_at, now()),
+                          pruned_at = now()
+                      WHERE run_id = ANY(%s)''', [pruned_run_ids])
+
+    return pruned_run_ids
+
+def main():
+    parser = argparse.ArgumentParser(description='manage cardstorm model runs')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    status_parser = subparsers.add_parser('status', help='list model runs')
+    status_parser.add_argument('--format', choices=FORMATS, default=None,
+                               help='only list the runs of this format')
+
+    promote_parser = subparsers.add_parser('promote', help='serve a ready or retired run')
+    promote_parser.add_argument('run_id', type=int)
+
+    prune_parser = subparsers.add_parser('prune', help='delete features of old runs')
+    prune_parser.add_argument('--keep', type=int, default=7)
+    prune_parser.add_argument('--archive', action='store_true')
+
+    args = parser.parse_args()
+
+    with db.transaction() as cursor:
+        run_command(cursor, args)
+    db.close_pool()
+
+def run_command(cursor, args):
+    migrations.migrate(cursor)
+
+    if args.command == 'status':
+        cursor.execute('''SELECT run_id, format, status, rank, created_at, promoted_at, pruned_at
+                          FROM model_runs
+                          WHERE %(format)s IS NULL OR format = %(format)s
+                          ORDER BY run_id DESC''', {'format': args.format})
+        for row in cursor.fetchall():
+            print('\t'.join(str(_) for _ in row))
+    elif args.command == 'promote':
+        if promote_run(cursor, args.run_id):
+            print('promoted run {}'.format(args.run_id))
+        else:
+            print('run {} cannot be promoted'.format(args.run_id))
+    elif args.command == 'prune':
+        print('{}: pruned runs {}'.format(datetime.datetime.today(),
+              prune_runs(cursor, keep=args.keep, archive=args.archive)))
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,89 @@
 import pyspark as ps
 import psycopg2
 import os
+import db
 import datetime
+import itertools
 import multiprocessing
+import numpy as np
+import evaluation
+import job_metrics
+import migrations
+import model_runs
+from catalog import DEFAULT_FORMAT, get_formats
+from predictions import align_factors
+from ratings import get_all_cardstorm_ids, load_ratings
 # from pyspark.mllib.recommendation import ALS
+from pyspark.sql import functions as F
 from pyspark.sql.types import StructField, StructType, IntegerType
 from pyspark.ml.recommendation import ALS
 
-def get_deck_card_counts(schema):
+# PostgreSQL JDBC driver the executors write the factors with
+JDBC_PACKAGE = os.environ.get('CARDSTORM_JDBC_PACKAGE', 'org.postgresql:postgresql:42.7.4')
+
+RATINGS_SCHEMA = StructType([StructField('deck_id', IntegerType()),
+                             StructField('cardstorm_id', IntegerType()),
+                             StructField('card_count', IntegerType())])
+
+def make_spark_session(app_name, cores=None):
+    '''
+    Gets a local Spark session on `cores` cores, every core by default. Arrow
+    moves the ratings columns into Spark and the JDBC driver lets the
+    executors write the factors to the db.
+    '''
+
+    return (ps.sql.SparkSession.builder
+                  .master('local[{}]'.format(cores or multiprocessing.cpu_count()))
+                  .appName(app_name)
+                  .config('spark.sql.execution.arrow.pyspark.enabled', 'true')
+                  .config('spark.jars.packages', JDBC_PACKAGE)
+                  .getOrCreate())
+
+def ratings_partitions(spark, n_rows):
+    '''
+    Gets the number of partitions for n_rows ratings: at least one per core,
+    and no more than CARDSTORM_ALS_ROWS_PER_PARTITION rows in any of them.
+    '''
+
+    rows_per_partition = int(os.environ.get('CARDSTORM_ALS_ROWS_PER_PARTITION', 250000))
+
+    return max(spark.sparkContext.defaultParallelism, -(-n_rows // rows_per_partition))
+
+def get_deck_card_counts(spark, ratings, schema=RATINGS_SCHEMA):
     '''
-    Gets the deck data needed for the Spark ALS model.
+    Gets the deck data needed for the Spark ALS model. The columns go to
+    Spark as Arrow record batches, no Python object is made per row.
 
     INPUT:
+        - spark: SparkSession
+        - ratings: tuple of numpy arrays (deck_ids, cardstorm_ids, card_counts)
         - schema: StructType object, schema for spark ratings df
 
     OUTPUT:
-        - incomplete_ratings: Spark df, ratings for all deck-card combos found in real decks
+        - ratings_df: Spark df, one row per rating, partitioned to the size of the data
     '''
 
-    cursor.execute('SELECT deck_id, cardstorm_id, card_count FROM decks')
+    import pandas as pd
 
-    incomplete_ratings = spark.createDataFrame(data=cursor.fetchall(),
-                                               schema=schema)
-    incomplete_ratings_rdd = incomplete_ratings.rdd.repartition(1000)
-    incomplete_ratings = spark.createDataFrame(incomplete_ratings_rdd,
-                                               schema=schema)
-    return incomplete_ratings
+    columns = pd.DataFrame({field.name: np.asarray(column, dtype=np.int32)
+                            for field, column in zip(schema.fields, ratings)})
+    ratings_df = spark.createDataFrame(columns, schema=schema)
 
-def get_unused_cardstorm_ids():
+    return ratings_df.repartition(ratings_partitions(spark, len(columns)))
+
+def get_unused_cardstorm_ids(ratings, all_cardstorm_ids):
     '''
-    Gets a list of all the unused cardstorm_ids from the db
+    Gets all the cardstorm_ids that don't show up in any deck.
 
     INPUT:
-        NONE
+        - ratings: tuple of numpy arrays (deck_ids, cardstorm_ids, card_counts)
+        - all_cardstorm_ids: numpy array, every cardstorm_id in the cards table
 
     OUTPUT:
         - unused_ids: list of ints, all unused cardstorm_ids.
     '''
 
-    cursor.execute('''SELECT cardstorm_id
-                      FROM cards
-                      WHERE cardstorm_id
-                        NOT IN (SELECT DISTINCT cardstorm_id FROM decks)''')
-
-    unused_ids = [_[0] for _ in cursor.fetchall()]
+    unused_ids = np.setdiff1d(all_cardstorm_ids, ratings[1]).tolist()
 
     return unused_ids
 
@@ -65,45 +105,236 @@ def fill_unused_cardstorm_ids(unused_ids):
 
     return filler_data
 
-def upload_product_rdd(product_rdd):
+def get_als_params():
+    '''
+    Gets the ALS parameters for the nightly model. Each can be overridden with
+    an environment variable, i.e. CARDSTORM_ALS_RANK=40, once a sweep in
+    evaluation.py has picked a cheaper rank.
+
+    OUTPUT:
+        - params: dictionary, rank, reg_param, alpha and max_iter
     '''
-    Adds the product features rdd from the spark ALS model to the db.
+
+    return {'rank': int(os.environ.get('CARDSTORM_ALS_RANK', 30)),
+            'reg_param': float(os.environ.get('CARDSTORM_ALS_REG_PARAM', 0.1)),
+            'alpha': float(os.environ.get('CARDSTORM_ALS_ALPHA', 1.0)),
+            'max_iter': int(os.environ.get('CARDSTORM_ALS_MAX_ITER', 20))}
+
+def fit_model(spark, ratings, all_cardstorm_ids, rank, reg_param, alpha, max_iter):
+    '''
+    Trains an ALS implicit model on the ratings. Cards that show up in no deck
+    get filler ratings so that every card has item factors.
 
     INPUT:
-        - product_rdd: Spark rdd, features pulled from fitted Spark ALS model
+        - spark: SparkSession
+        - ratings: tuple of numpy arrays (deck_ids, cardstorm_ids, card_counts)
+        - all_cardstorm_ids: numpy array, every cardstorm_id in the cards table
+        - rank, reg_param, alpha, max_iter: ALS parameters
+
+    OUTPUT:
+        - fitted_model: fitted Spark ALSModel
+    '''
+
+    unused_ids = get_unused_cardstorm_ids(ratings, all_cardstorm_ids)
+
+    filler_data = np.array(fill_unused_cardstorm_ids(unused_ids), dtype=np.int32).reshape(-1, 3)
+    ratings = tuple(np.concatenate([column, filler_column])
+                    for column, filler_column in zip(ratings, filler_data.T))
+
+    # ALS reads the ratings once per block layout it builds, keep them in memory
+    ratings_df = get_deck_card_counts(spark, ratings).cache()
+    n_blocks = spark.sparkContext.defaultParallelism
+
+    # model = ALS.trainImplicit(ratings=ratings_df, rank=30)
+    model = ALS(rank=rank, implicitPrefs=True, userCol='deck_id', maxIter=max_iter,
+                regParam=reg_param, alpha=alpha, numUserBlocks=n_blocks, numItemBlocks=n_blocks,
+                itemCol='cardstorm_id', ratingCol='card_count')
+
+    fitted_model = model.fit(ratings_df)
+    ratings_df.unpersist()
+
+    return fitted_model
+
+def get_feature_matrix(product_df, all_cardstorm_ids):
+    '''
+    Collects item factors into a matrix ordered like all_cardstorm_ids, the same
+    layout the web app reads from product_matrices.
+
+    OUTPUT:
+        - feature_matrix: numpy array (n_cards x rank)
+    '''
+
+    factors = dict(product_df.collect())
+    rank = len(next(iter(factors.values())))
+
+    feature_matrix = np.zeros((len(all_cardstorm_ids), rank))
+    for i, cardstorm_id in enumerate(all_cardstorm_ids.tolist()):
+        if cardstorm_id in factors:
+            feature_matrix[i] = factors[cardstorm_id]
+
+    return feature_matrix
+
+def read_feature_matrix(cursor, run_id, all_cardstorm_ids):
+    '''
+    Reads the item factors of a run back from product_matrices, ordered like
+    all_cardstorm_ids. The executors wrote them there, so the factors never
+    go through the Spark driver.
+
+    OUTPUT:
+        - feature_matrix: numpy array (n_cards x rank)
+    '''
+
+    cursor.execute('''SELECT cardstorm_id, features
+                      FROM product_matrices
+                      WHERE run_id = %s
+                      ORDER BY cardstorm_id''', [run_id])
+    rows = cursor.fetchall()
+    factor_ids = np.array([cardstorm_id for cardstorm_id, _ in rows], dtype=np.int64)
+    factors = np.array([features for _, features in rows], dtype=np.float64)
+
+    return align_factors(factor_ids, factors, all_cardstorm_ids)
+
+def fit_feature_matrix(spark, ratings, all_cardstorm_ids, rank, reg_param, alpha, max_iter):
+    '''
+    Trains an ALS implicit model and returns its item factor matrix.
+    '''
+
+    fitted_model = fit_model(spark, ratings, all_cardstorm_ids, rank=rank, reg_param=reg_param,
+                             alpha=alpha, max_iter=max_iter)
+
+    return get_feature_matrix(fitted_model.itemFactors, all_cardstorm_ids)
+
+def upload_product_rdd(product_df, run_id, batch_size=500):
+    '''
+    Adds the product features from the spark ALS model to the db. Every
+    partition is written by its own executor over JDBC, nothing goes through
+    the driver. A failed upload can leave some partitions written, the run
+    stays in training and prune_runs deletes them.
+
+    INPUT:
+        - product_df: Spark df, itemFactors of the fitted Spark ALS model
+        - run_id: int, run registered with model_runs.start_run
+        - batch_size: int, rows per INSERT
 
     OUTPUT:
         - success: bool, True if no problems were encountered.
     '''
-    current_date = str(datetime.date.today())
+    current_date = datetime.date.today()
+
+    if db.embedded():
+        # only one process can write to the embedded database, stream through the driver
+        return upload_factor_rows(product_df.toLocalIterator(), run_id, current_date, batch_size)
+
+    writers = int(os.environ.get('CARDSTORM_UPLOAD_WRITERS', 4))
+    rows = product_df.select(F.col('id').alias('cardstorm_id'),
+                             F.col('features').cast('array<double>').alias('features'),
+                             F.lit(current_date).alias('date'),
+                             F.lit(run_id).alias('run_id'))
+    try:
+        (rows.repartition(writers)
+             .write
+             .option('batchsize', batch_size)
+             .jdbc(db.jdbc_url(), 'product_matrices', mode='append',
+                   properties=db.jdbc_properties()))
+    except Exception as error:
+        # a duplicate key on any executor fails the whole write
+        print('run {} upload failed: {}'.format(run_id, error))
+        return False
 
-    cursor.execute('SELECT MAX(run_id) FROM product_matrices')
-    run_id = cursor.fetchone()[0]
-    if run_id is None:
-        run_id = 0
-    run_id += 1
+    return True
+
+def upload_factor_rows(rows, run_id, current_date, batch_size=500):
+    '''
+    Inserts (cardstorm_id, features) rows batch_size rows per INSERT.
 
-    for cardstorm_id, features in product_rdd.collect():
-        query = '''INSERT INTO product_matrices (cardstorm_id, features, date, run_id)
-                   VALUES (%s, %s, %s, %s)'''
+    OUTPUT:
+        - success: bool, False if any of the rows was already uploaded
+    '''
 
-        try:
-            cursor.execute(query, vars=[cardstorm_id, features, current_date, run_id])
-        except psycopg2.IntegrityError:
-            return False
-            continue
+    rows = iter(rows)
+    try:
+        with db.transaction() as cursor_:
+            while True:
+                batch = [(cardstorm_id, list(features), current_date, run_id)
+                         for cardstorm_id, features in itertools.islice(rows, batch_size)]
+                if not batch:
+                    break
+                cursor_.execute('''INSERT INTO product_matrices (cardstorm_id, features, date, run_id)
+                                   VALUES {}'''.format(', '.join(['%s'] * len(batch))), batch)
+    except psycopg2.IntegrityError:
+        return False
 
     return True
 
-def make_recommender():
+def spark_metrics(spark):
+    '''
+    Gets the timings of the Spark stages run so far and the executors' peak
+    memory from the REST API of the Spark UI.
+
+    OUTPUT:
+        - metrics: dictionary with 'spark_stages', a list with the duration, task
+                   time and bytes read and shuffled of every completed stage, and
+                   'spark_peak_memory_bytes', the peak JVM memory over the executors.
+                   Empty if the UI is off.
+    '''
+
+    import requests
+
+    ui_url = spark.sparkContext.uiWebUrl
+    if not ui_url:
+        return {}
+
+    api_url = '{}/api/v1/applications/{}'.format(ui_url, spark.sparkContext.applicationId)
+    try:
+        stages = requests.get(api_url + '/stages', params={'status': 'complete'}, timeout=10).json()
+        executors = requests.get(api_url + '/executors', timeout=10).json()
+    except (requests.RequestException, ValueError) as error:
+        print('could not read spark metrics: {}'.format(error))
+        return {}
+
+    def timestamp(value):
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%Z')
+
+    spark_stages = [{'stage_id': stage['stageId'],
+                     'name': stage['name'],
+                     'tasks': stage['numTasks'],
+                     'seconds': (timestamp(stage['completionTime'])
+                                 - timestamp(stage['submissionTime'])).total_seconds(),
+                     'executor_run_seconds': stage['executorRunTime'] / 1000,
+                     'input_bytes': stage['inputBytes'],
+                     'shuffle_read_bytes': stage['shuffleReadBytes'],
+                     'shuffle_write_bytes': stage['shuffleWriteBytes']}
+                    for stage in sorted(stages, key=lambda stage: stage['stageId'])
+                    if 'submissionTime' in stage and 'completionTime' in stage]
+
+    peak_memory = [executor['peakMemoryMetrics'].get('JVMHeapMemory', 0)
+                   + executor['peakMemoryMetrics'].get('JVMOffHeapMemory', 0)
+                   for executor in executors if 'peakMemoryMetrics' in executor]
+
+    return {'spark_stages': spark_stages,
+            'spark_peak_memory_bytes': max(peak_memory) if peak_memory else None}
+
+def make_recommender(format=DEFAULT_FORMAT):
     '''
-    Makes the recommender model! Gets deck data from the database, makes filler
+    Makes the recommender model for a format! Gets the format's deck data from
+    the database, makes filler
     data for unused cards, uses Spark ALS to train a model of implicit ratings.
     Pulls out the product features matrix (often referred to as V) and
     uploads it to the database with the current data attached.
 
+    A few cards from the most recent decks are held out of training, and the
+    model's recall@10/NDCG@10 on them is stored in model_evaluations next to
+    the run_id. The run's factors are then replaced by a model with the same
+    parameters refit on every deck, so the served model knows the held-out
+    cards and the newest decks. Set CARDSTORM_REFIT=0 to serve the evaluated
+    model itself, or CARDSTORM_EVAL_DECKS=0 to train once on everything.
+
+    The run is registered in model_runs and only promoted to the served model
+    once it is fully uploaded, and, if CARDSTORM_MIN_RECALL is set, scores at
+    least that recall@10. Old runs are then pruned, keeping CARDSTORM_KEEP_RUNS.
+
     INPUT:
-        NONE
+        - format: string, format whose decks are trained on
 
     OUTPUT:
         NONE
@@ -111,7 +342,7 @@ def make_recommender():
     Does everything
 
         Get deck data from db
-        create schema for spark DF
+        hold out cards from recent decks
         get unused cardstorm_ids
         create fake data for all unused cards
         make new spark df from unused cards
@@ -119,55 +350,130 @@ def make_recommender():
         create and train ALS implicit model
         get the product matrix
         upload df to db
+        score the held out cards
+        refit on every deck and replace the uploaded df
+        promote the run
+        prune old runs
     '''
 
-    ratings_schema = StructType([StructField('deck_id', IntegerType()),
-                                 StructField('cardstorm_id', IntegerType()),
-                                 StructField('card_count', IntegerType())])
-
-    incomplete_ratings = get_deck_card_counts(schema=ratings_schema)
+    params = get_als_params()
+    n_test_decks = int(os.environ.get('CARDSTORM_EVAL_DECKS', 500))
 
-    unused_ids = get_unused_cardstorm_ids()
+    with job_metrics.timed('load_ratings'):
+        ratings = load_ratings(cursor, format=format)
+        all_cardstorm_ids = get_all_cardstorm_ids(cursor)
+    job_metrics.count('ratings', len(ratings[0]))
 
-    filler_data = fill_unused_cardstorm_ids(unused_ids)
+    train, test = evaluation.split_holdout(*ratings, n_test_decks=n_test_decks)
 
-    filler_ratings = spark.createDataFrame(data=filler_data,
-                                           schema=ratings_schema)
-    ratings_df = incomplete_ratings.union(filler_ratings)
-
-    # model = ALS.trainImplicit(ratings=ratings_df, rank=30)
-    model = ALS(rank=30, implicitPrefs=True, userCol='deck_id', maxIter=20,
-                itemCol='cardstorm_id', ratingCol='card_count')
-    fitted_model = model.fit(ratings_df)
+    start_time = datetime.datetime.now()
+    with job_metrics.timed('fit'):
+        fitted_model = fit_model(spark, train, all_cardstorm_ids, **params)
+    fit_seconds = (datetime.datetime.now() - start_time).total_seconds()
 
     product_df = fitted_model.itemFactors
 
-    upload_status = upload_product_rdd(product_df)
+    migrations.migrate(cursor)
+    run_id = model_runs.start_run(cursor, rank=params['rank'], format=format)
+    conn.commit()
+
+    with job_metrics.timed('upload'):
+        upload_status = upload_product_rdd(product_df, run_id)
+
+    if not upload_status:
+        # the run stays in training and is cleaned up by prune_runs
+        conn.rollback()
+        return
+
+    promote = True
+    if n_test_decks:
+        with job_metrics.timed('evaluate'):
+            feature_matrix = read_feature_matrix(cursor, run_id, all_cardstorm_ids)
+            metrics = evaluation.score_holdout(feature_matrix, all_cardstorm_ids, test)
+        metrics['fit_seconds'] = fit_seconds
+        print('{} run {}: recall@10={:.4f} ndcg@10={:.4f}'.format(format, run_id,
+                                                                 metrics['recall_at_10'],
+                                                                 metrics['ndcg_at_10']))
+        evaluation.store_evaluation(cursor, params, metrics, run_id=run_id, format=format)
+        conn.commit()
+
+        min_recall = os.environ.get('CARDSTORM_MIN_RECALL')
+        if min_recall is not None and metrics['recall_at_10'] < float(min_recall):
+            print('{} run {} is below the recall bar, not promoting'.format(format, run_id))
+            promote = False
+
+        if os.environ.get('CARDSTORM_REFIT', '1') == '1':
+            # the evaluated model never saw the held-out cards, serve one trained on every deck
+            with job_metrics.timed('refit'):
+                fitted_model = fit_model(spark, ratings, all_cardstorm_ids, **params)
+            cursor.execute('DELETE FROM product_matrices WHERE run_id = %s', [run_id])
+            conn.commit()
+            with job_metrics.timed('upload'):
+                upload_status = upload_product_rdd(fitted_model.itemFactors, run_id)
+            if not upload_status:
+                conn.rollback()
+                return
+
+    model_runs.mark_ready(cursor, run_id)
+    conn.commit()
+    job_metrics.count('rows_inserted', len(all_cardstorm_ids))
+
+    if promote:
+        model_runs.promote_run(cursor, run_id)
+    conn.commit()
+
+    pruned_run_ids = model_runs.prune_runs(cursor, keep=int(os.environ.get('CARDSTORM_KEEP_RUNS', 7)),
+                                           archive=os.environ.get('CARDSTORM_ARCHIVE_RUNS', '0') == '1')
+    print('pruned runs: {}'.format(pruned_run_ids))
+    conn.commit()
+
+def train_format(format, cores=None):
+    '''
+    Trains, uploads and promotes the model of one format with its own Spark
+    session and db connection, so every format can train in its own process.
+    '''
+    global conn, cursor, spark
 
-    if upload_status: conn.commit()
+    print('BEGIN MODELING {}: {}'.format(format.upper(), datetime.datetime.today()))
+    job_metrics.start('modeling', format=format)
 
-def main():
-    print('#####################################################')
-    print('BEGIN MODELING: {}'.format(datetime.datetime.today()))
-    global dbname, host, username, password, conn, cursor, spark
-    dbname = os.environ['CARDSTORM_DB_DBNAME']
-    host = os.environ['CARDSTORM_DB_HOST']
-    username = os.environ['CARDSTORM_DB_USERNAME']
-    password = os.environ['CARDSTORM_DB_PASSWORD']
+    if cores is not None:
+        # workers must start their own jvm, not attach to one inherited from spark-submit
+        for name in ('PYSPARK_GATEWAY_PORT', 'PYSPARK_GATEWAY_SECRET'):
+            os.environ.pop(name, None)
+
+    spark = make_spark_session('cardstorm modeling {}'.format(format), cores=cores)
 
+    spark.sparkContext.setLogLevel('WARN')
 
-    conn = psycopg2.connect('dbname={} host={} user={} password={}'.format(dbname, host, username, password))
-    cursor = conn.cursor()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        make_recommender(format=format)
 
-    spark = (ps.sql.SparkSession.builder
-                   .master('local[{}]'.format(multiprocessing.cpu_count()))
-                   .appName('cardstorm modeling')
-                   .getOrCreate())
+    for name, value in spark_metrics(spark).items():
+        job_metrics.record(name, value)
+    print('{} run report: {}'.format(format, job_metrics.write()))
+    db.close_pool()
 
-    spark.sparkContext.setLogLevel('WARN')
-    make_recommender()
+def main():
+    print('#####################################################')
+    print('BEGIN MODELING: {}'.format(datetime.datetime.today()))
 
-    conn.close()
+    formats = get_formats()
+    if len(formats) == 1:
+        train_format(formats[0])
+        return
+
+    # one process per format, each with its own local spark on a share of the cores
+    workers = min(len(formats), int(os.environ.get('CARDSTORM_TRAIN_WORKERS', len(formats))))
+    if db.embedded():
+        # only one process at a time can write to the embedded database
+        workers = 1
+    cores = max(1, multiprocessing.cpu_count() // workers)
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, maxtasksperchild=1) as pool:
+        pool.starmap(train_format, [(format, cores) for format in formats])
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,301 @@
+'''
+Nightly pipeline runner. Runs every job as its own process as soon as the
+jobs it depends on have finished, so independent jobs (i.e. training the
+model and finding card partners) run side by side.
+
+    python src/pipeline.py run
+    python src/pipeline.py run --resume
+    python src/pipeline.py status
+
+Every run gets a directory in CARDSTORM_PIPELINE_DIR with its state: the
+status and duration of every stage, and the counters of its run reports or
+the rows it added to its tables. `run --resume` reruns the
+stages of the last run that didn't finish, and the long jobs pick up from
+the checkpoints they saved there (see checkpoint.py).
+'''
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import db
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(os.path.dirname(SRC_DIR), 'scripts')
+
+class Stage():
+    '''
+    A job of the pipeline.
+
+    INPUT:
+        - name: string
+        - command: list of strings, the job's command line
+        - after: list of strings, stages that have to finish first
+        - tables: list of strings, small tables whose row counts are recorded
+        - report: string, job name of the run reports the stage writes (see
+                  job_metrics.py), whose counters are recorded. Big tables are
+                  only followed this way, counting their rows scans them whole.
+        - log: string, name of the job's log files in CARDSTORM_LOG_DIR.
+               None if the job writes its own logs.
+    '''
+
+    def __init__(self, name, command, after=(), tables=(), report=None, log=None):
+        self.name = name
+        self.command = command
+        self.after = list(after)
+        self.tables = list(tables)
+        self.report = report
+        self.log = log
+
+def _python(script, *args):
+    return [sys.executable, os.path.join(SRC_DIR, script)] + list(args)
+
+STAGES = [Stage('migrations', _python('migrations.py', 'migrate'), log='migrations'),
+          Stage('cards', _python('card_scraping.py'), after=['migrations'], report='card_scraping',
+                log='card'),
+          Stage('images', _python('image_scraping.py'), after=['cards'], report='image_scraping',
+                log='image'),
+          Stage('decks', _python('deck_scraping.py'), after=['cards'], report='deck_scraping',
+                log='deck'),
+          Stage('modeling', ['bash', os.path.join(SCRIPTS_DIR, 'modeling.sh')], after=['decks'],
+                report='modeling'),
+          Stage('archetypes', _python('archetypes.py'), after=['modeling'], tables=['archetypes'],
+                log='archetypes'),
+          Stage('cooccurrence', _python('cooccurrence.py'), after=['decks'],
+                tables=['card_partners'], log='cooccurrence'),
+          # the server loads the promoted runs once, it has to restart to serve new ones
+          Stage('reload', ['bash', os.path.join(SCRIPTS_DIR, 'reload.sh')],
+                after=['modeling', 'archetypes', 'cooccurrence'], log='reload')]
+
+def pipeline_dir():
+    return os.environ.get('CARDSTORM_PIPELINE_DIR', os.path.expanduser('~/cardstorm_pipeline'))
+
+def log_dir():
+    return os.environ.get('CARDSTORM_LOG_DIR', os.path.expanduser('~/cardstorm_logs'))
+
+def save_state(state):
+    path = os.path.join(state['directory'], 'state.json')
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(temporary, path)
+
+def load_last_state():
+    '''
+    OUTPUT:
+        - state: dictionary, the state of the newest run. None if there is none.
+    '''
+
+    if not os.path.isdir(pipeline_dir()):
+        return None
+    runs = sorted(run for run in os.listdir(pipeline_dir())
+                  if os.path.exists(os.path.join(pipeline_dir(), run, 'state.json')))
+    if not runs:
+        return None
+
+    with open(os.path.join(pipeline_dir(), runs[-1], 'state.json')) as f:
+        return json.load(f)
+
+def new_state(stages):
+    run_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    directory = os.path.join(pipeline_dir(), run_id)
+    os.makedirs(directory)
+
+    return {'run_id': run_id,
+            'directory': directory,
+            'stages': {stage.name: {'status': 'pending'} for stage in stages}}
+
+def count_rows(tables):
+    '''
+    OUTPUT:
+        - counts: dictionary, table -> number of rows. None for a table that
+                  doesn't exist yet.
+    '''
+
+    counts = {}
+    if not tables:
+        return counts
+
+    for table in tables:
+        try:
+            with db.transaction() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM {}'.format(table))
+                counts[table] = cursor.fetchone()[0]
+        except Exception:
+            counts[table] = None
+    # stages can't write to an embedded database this process keeps open
+    db.close_pool()
+
+    return counts
+
+def report_dir(state):
+    # the jobs' run reports go next to the state of the run
+    return os.environ.get('CARDSTORM_REPORT_DIR', state['directory'])
+
+def read_report_counters(directory, job, since):
+    '''
+    OUTPUT:
+        - counters: dictionary, the counters of the job's run reports in
+                    directory written since the since timestamp, added up over
+                    the reports of every format. None if there are none.
+    '''
+
+    counters = None
+    if not os.path.isdir(directory):
+        return counters
+
+    for file_name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file_name)
+        if not (file_name.startswith(job + '_') and file_name.endswith('.json')
+                and os.path.getmtime(path) >= since):
+            continue
+        with open(path) as f:
+            report = json.load(f)
+        if report.get('job') != job:
+            continue
+        counters = counters or {}
+        for name, value in report['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+
+    return counters
+
+def start_stage(stage, state):
+    env = dict(os.environ, CARDSTORM_CHECKPOINT_DIR=state['directory'],
+               CARDSTORM_REPORT_DIR=report_dir(state))
+
+    if stage.log is None:
+        stdout = stderr = subprocess.DEVNULL
+    else:
+        os.makedirs(log_dir(), exist_ok=True)
+        stdout = open(os.path.join(log_dir(), '{}_stdout.log'.format(stage.log)), 'a')
+        stderr = open(os.path.join(log_dir(), '{}_stderr.log'.format(stage.log)), 'a')
+
+    record = state['stages'][stage.name]
+    record.update(status='running', started_at=datetime.datetime.now().isoformat(),
+                  started_at_timestamp=time.time(), rows_before=count_rows(stage.tables))
+    record['attempts'] = record.get('attempts', 0) + 1
+    save_state(state)
+    print('{}: starting {}'.format(datetime.datetime.now(), stage.name))
+
+    process = subprocess.Popen(stage.command, stdout=stdout, stderr=stderr, env=env)
+
+    return process, time.perf_counter(), (stdout, stderr)
+
+def finish_stage(stage, state, returncode, seconds):
+    record = state['stages'][stage.name]
+    rows_after = count_rows(stage.tables)
+    record.update(status='done' if returncode == 0 else 'failed', returncode=returncode,
+                  seconds=round(seconds, 1), rows_after=rows_after,
+                  rows_added={table: (rows_after[table] - record['rows_before'][table]
+                                      if None not in (rows_after[table], record['rows_before'][table])
+                                      else None)
+                              for table in stage.tables})
+    if stage.report is not None:
+        record['counters'] = read_report_counters(report_dir(state), stage.report,
+                                                  record['started_at_timestamp'])
+    save_state(state)
+    print('{}: {} {} in {:.1f}s, rows added {}, counters {}'.format(datetime.datetime.now(),
+          stage.name, record['status'], seconds, record['rows_added'], record.get('counters')))
+
+def run_pipeline(stages, state, jobs=3, poll_seconds=1.0):
+    '''
+    Runs every stage of state that isn't done, each once all the stages it
+    runs after are done. Stages after a failed stage are skipped.
+
+    INPUT:
+        - stages: list of Stage
+        - state: dictionary, from new_state or load_last_state
+        - jobs: int, most stages running at once
+
+    OUTPUT:
+        - success: bool, True if every stage is done
+    '''
+
+    records = state['stages']
+    for stage in stages:
+        record = records.setdefault(stage.name, {'status': 'pending'})
+        if record['status'] != 'done':
+            record['status'] = 'pending'
+
+    running = {}
+    while True:
+        for stage in stages:
+            record = records[stage.name]
+            if record['status'] != 'pending':
+                continue
+            after = [records[name]['status'] for name in stage.after]
+            if any(status in ('failed', 'skipped') for status in after):
+                record['status'] = 'skipped'
+                save_state(state)
+                print('{}: skipping {}'.format(datetime.datetime.now(), stage.name))
+            elif all(status == 'done' for status in after) and len(running) < jobs:
+                running[stage.name] = (stage,) + start_stage(stage, state)
+
+        if not running:
+            break
+
+        time.sleep(poll_seconds)
+        for name, (stage, process, start_time, logs) in list(running.items()):
+            returncode = process.poll()
+            if returncode is None:
+                continue
+            for log in logs:
+                if log is not subprocess.DEVNULL:
+                    log.close()
+            del running[name]
+            finish_stage(stage, state, returncode, time.perf_counter() - start_time)
+
+    return all(records[stage.name]['status'] == 'done' for stage in stages)
+
+def main():
+    parser = argparse.ArgumentParser(description='run the nightly cardstorm pipeline')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run every stage')
+    run_parser.add_argument('--resume', action='store_true',
+                            help='rerun the unfinished stages of the last run')
+    run_parser.add_argument('--jobs', type=int, default=int(os.environ.get('CARDSTORM_PIPELINE_JOBS', 3)),
+                            help='most stages running at once')
+    run_parser.add_argument('--only', nargs='+', default=None, choices=[stage.name for stage in STAGES],
+                            help='run only these stages, i.e. to retrain without scraping')
+
+    subparsers.add_parser('status', help='print the stages of the last run')
+    args = parser.parse_args()
+
+    state = load_last_state()
+
+    if args.command == 'status':
+        if state is None:
+            print('no pipeline runs yet')
+            return
+        print('run {}'.format(state['run_id']))
+        for name, record in state['stages'].items():
+            print('\t'.join(str(_) for _ in (name, record['status'], record.get('seconds'),
+                                            record.get('rows_added'), record.get('counters'))))
+        return
+
+    stages = STAGES
+    if args.only:
+        stages = [stage for stage in STAGES if stage.name in args.only]
+        for stage in stages:
+            stage.after = [name for name in stage.after if name in args.only]
+
+    if not (args.resume and state is not None
+            and any(record['status'] != 'done' for record in state['stages'].values())):
+        state = new_state(stages)
+    print('#####################################################')
+    print('BEGIN PIPELINE RUN {}: {}'.format(state['run_id'], datetime.datetime.today()))
+
+    jobs = args.jobs
+    if db.embedded():
+        # only one process at a time can write to the embedded database
+        jobs = 1
+
+    if not run_pipeline(stages, state, jobs=jobs):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,237 @@
-import psycopg2
-import os
-from deck_scraping import ReflexiveDict, parse_card_string
+import db
+from archetypes import load_archetypes
+from catalog import DEFAULT_FORMAT, CardColumns, ReflexiveDict, parse_card_string
+from cooccurrence import explain, load_partners
+from metrics import span
+from model_runs import get_current_run_id
 import numpy as np
 
-class CardRecommender:
+QUANTIZED_DTYPES = {'float16': np.float16, 'int8': np.int8}
+
+def quantize_rows(matrix, dtype):
+    '''
+    Quantizes every row of a matrix with its own scale, so a row's largest
+    absolute value maps to the largest value of the quantized type.
+
+    INPUT:
+        - matrix: numpy array (n x k)
+        - dtype: string, 'float16' or 'int8'
+
+    OUTPUT:
+        - quantized: numpy array (n x k) of dtype
+        - scales: numpy array (n,) float32, matrix ~= quantized * scales[:, None]
+    '''
+
+    scales = np.abs(matrix).max(axis=1).astype(np.float32)
+    # all zero rows (cards never played) keep a scale of 1 and quantize to 0
+    scales[scales == 0] = 1
+
+    if dtype == 'int8':
+        scales /= 127
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+    elif dtype == 'float16':
+        quantized = (matrix / scales[:, None]).astype(np.float16)
+    else:
+        raise ValueError('unknown quantized dtype {}, expected one of {}'.format(
+                         dtype, sorted(QUANTIZED_DTYPES)))
+
+    return quantized, scales
+
+def align_factors(factor_ids, factors, all_cardstorm_ids):
+    '''
+    Places the factor rows of a model run at their cards' positions in the
+    catalog. The served run can be older than the catalog, cards added since
+    it was trained get all zero rows and cards removed since are dropped.
+
+    INPUT:
+        - factor_ids: numpy array, cardstorm_id of every factor row
+        - factors: numpy array (len(factor_ids) x rank)
+        - all_cardstorm_ids: sorted numpy array, every cardstorm_id in the catalog
+
+    OUTPUT:
+        - feature_matrix: numpy array (len(all_cardstorm_ids) x rank), same dtype
+                          as factors
+    '''
+
+    feature_matrix = np.zeros((len(all_cardstorm_ids), factors.shape[1]), dtype=factors.dtype)
+    if not len(all_cardstorm_ids):
+        return feature_matrix
 
-    def __init__(self):
-        self._connect_to_db()
-        self.feature_matrix = self._get_feature_matrix()
-        self.card_dict = ReflexiveDict()
-        self.all_cardstorm_ids = self.card_dict.get_cardstorm_ids()
+    rows = np.minimum(np.searchsorted(all_cardstorm_ids, factor_ids), len(all_cardstorm_ids) - 1)
+    found = all_cardstorm_ids[rows] == factor_ids
+    feature_matrix[rows[found]] = factors[found]
 
-    def _connect_to_db(self):
-        db_name = os.environ['CARDSTORM_DB_DBNAME']
-        db_host = os.environ['CARDSTORM_DB_HOST']
-        db_username = os.environ['CARDSTORM_DB_USERNAME']
-        db_password = os.environ['CARDSTORM_DB_PASSWORD']
+    return feature_matrix
 
-        self.conn = psycopg2.connect('dbname={} host={} user={} password={}'.format(db_name, db_host, db_username, db_password))
-        self.cursor = self.conn.cursor()
+class CardRecommender:
+
+    def __init__(self, feature_matrix=None, card_dict=None, quantize=None, rerank=300,
+                 archetypes=False, min_similarity=0.5, partners=False, card_columns=None,
+                 format=DEFAULT_FORMAT):
+        '''
+        INPUT:
+            - feature_matrix: numpy array, item factors ordered by cardstorm_id.
+                              If None, the most recent matrix is read from the db.
+            - card_dict: ReflexiveDict, card names <-> cardstorm_ids. If None,
+                         it is read from the db.
+            - quantize: string, None, 'float16' or 'int8'. If given, all cards are
+                        scored with quantized item factors and the best rerank
+                        candidates are re-scored with the exact float32 factors.
+            - rerank: int, number of candidates re-scored exactly when quantized
+            - archetypes: bool, if True the archetypes clustered for the served
+                          run are read from the db and decks similar enough to
+                          an archetype only re-score its candidate cards
+            - min_similarity: float, cosine similarity a deck needs with its
+                              nearest archetype, below it every card is scored
+            - partners: bool, if True the card partners are read from the db so
+                        recommendations can be explained
+            - card_columns: CardColumns, card attributes for deck statistics. If
+                            None and card_dict is None, it is read from the db.
+            - format: string, the format whose promoted model, archetypes and
+                      partners are read, only cards legal in it are recommended
+
+        Recommenders for different formats can share one card_dict and one
+        card_columns, only the feature matrices are per format.
+
+        When both are given the database is only used for recommendations for
+        empty deck lists and for the filters.
+        '''
+        self.run_id = None
+        self.format = format
+        # set to a batching.RequestCoalescer to solve concurrent requests together
+        self.coalescer = None
+        self.quantize = quantize
+        self.rerank = rerank
+        self.min_similarity = min_similarity
+        self.archetype_centroids = None
+        # archetype the last deck was scored against, None if every card was scored
+        self.archetype = None
+        self.partners = {}
+        if quantize is not None and quantize not in QUANTIZED_DTYPES:
+            raise ValueError('unknown quantized dtype {}, expected one of {}'.format(
+                             quantize, sorted(QUANTIZED_DTYPES)))
+        # cardstorm_ids of the factor rows read from the db
+        factor_ids = None
+        if feature_matrix is None:
+            with span('feature_matrix'):
+                with db.connection() as conn:
+                    self.cursor = conn.cursor()
+                    factor_ids, feature_matrix = self._get_feature_matrix()
+        self.feature_matrix = feature_matrix
+        with span('card_dict'):
+            if card_dict is None:
+                card_dict = ReflexiveDict()
+                if card_columns is None:
+                    card_columns = CardColumns()
+            self.card_dict = card_dict
+            self.card_columns = card_columns
+        with span('cardstorm_ids'):
+            self.all_cardstorm_ids = self.card_dict.get_cardstorm_ids()
+            # cards legal in the format, None recommends every card
+            self.legal = None
+            if card_columns is not None:
+                self.legal = card_columns.legal_mask(format, self.all_cardstorm_ids)
+        if factor_ids is not None:
+            with span('align_factors'):
+                self.feature_matrix = align_factors(factor_ids, self.feature_matrix,
+                                                    self.all_cardstorm_ids)
+        if quantize is not None:
+            with span('quantize'):
+                self._quantize_factors()
+        if archetypes:
+            with span('archetypes'):
+                with db.connection() as conn:
+                    centroids, candidates = load_archetypes(conn.cursor(), self.run_id,
+                                                            self.all_cardstorm_ids)
+            if centroids is None:
+                print('no archetypes for {} run {}, scoring every card'.format(format, self.run_id))
+            else:
+                self.use_archetypes(centroids, candidates)
+        if partners:
+            with span('card_partners'):
+                with db.connection() as conn:
+                    self.partners = load_partners(conn.cursor(), format=format)
 
     def _get_feature_matrix(self):
         '''
-        Gets the most recent feature matrix from the database and expands it.
+        Gets the promoted feature matrix from the database.
+
+        OUTPUT:
+            - factor_ids: numpy array, cardstorm_id of every row, ascending
+            - feature_matrix: numpy array, one row of item factors per card the
+                              run was trained on
         '''
 
+        self.run_id = get_current_run_id(self.cursor, format=self.format)
+        if self.run_id is None:
+            raise ValueError('no promoted {} model run'.format(self.format))
+
         query = '''SELECT cardstorm_id, features
                    FROM product_matrices
-                   WHERE run_id = (SELECT MAX(run_id) FROM product_matrices)
+                   WHERE run_id = $1
                    ORDER BY cardstorm_id ASC'''
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'feature_matrix', query, [self.run_id])
 
+        factor_ids = []
         feature_matrix = []
 
         for cardstorm_id, features in self.cursor.fetchall():
+            factor_ids.append(cardstorm_id)
             feature_matrix.append(features)
 
-        feature_matrix = np.array(feature_matrix)
+        # the quantized path only ever needs float32 exact factors
+        dtype = np.float64 if self.quantize is None else np.float32
+        feature_matrix = np.array(feature_matrix, dtype=dtype)
 
-        return feature_matrix
+        return np.array(factor_ids, dtype=np.int64), feature_matrix
+
+    def _quantize_factors(self):
+        '''
+        Prepares the quantized scoring path: float32 exact factors for the
+        re-ranking, quantized factors with per-row scales for scoring every
+        card, and the (k x k) Gram matrix V'V. With the Gram matrix, u solves
+        the normal equations V'V u = V'd, and since d is zero outside the
+        deck, V'd only needs the rows of the cards in the deck.
+        '''
+
+        self.feature_matrix = np.ascontiguousarray(self.feature_matrix, dtype=np.float32)
+        self.quantized_factors, self.factor_scales = quantize_rows(self.feature_matrix,
+                                                                   self.quantize)
+        self._prepare_gram()
+
+    def _prepare_gram(self):
+        factors = self.feature_matrix.astype(np.float64)
+        gram = np.dot(factors.T, factors)
+        # a tiny ridge keeps the solve stable if some factor is (nearly) unused
+        gram[np.diag_indices_from(gram)] += 1e-10 * np.trace(gram) / len(gram)
+        self.gram = gram
+
+    def _solve(self, deck_vector):
+        '''
+        Solves V'V u = V'd, using only the factor rows of the cards in the deck.
+        '''
+
+        in_deck = np.flatnonzero(deck_vector)
+        rhs = np.dot(self.feature_matrix[in_deck].T.astype(np.float64), deck_vector[in_deck])
+
+        return np.linalg.solve(self.gram, rhs).astype(self.feature_matrix.dtype)
+
+    def use_archetypes(self, centroids, candidates):
+        '''
+        Scores decks against archetype candidate pools from now on.
+
+        INPUT:
+            - centroids: numpy array (n_archetypes x rank), unit length rows
+            - candidates: list of numpy arrays, ranked card columns per archetype
+        '''
+
+        if not hasattr(self, 'gram'):
+            self._prepare_gram()
+
+        self.archetype_centroids = np.asarray(centroids, dtype=np.float64)
+        self.archetype_candidates = list(candidates)
+        # how each archetype scores every card, orders the cards outside the pool
+        self.archetype_scores = np.dot(self.feature_matrix, self.archetype_centroids.T).T
 
     def _fit(self, raw_deck_list):
         '''
@@ -50,17 +243,133 @@ class CardRecommender:
 
         '''
 
-        deck_dict = self._deck_to_dict(raw_deck_list)
-        self.deck_vector = self._vectorize_deck(deck_dict)
+        with span('deck_to_dict'):
+            self.deck_dict = self._deck_to_dict(raw_deck_list)
+        with span('vectorize'):
+            self.deck_vector = self._vectorize_deck(self.deck_dict)
+
+        self.archetype = None
+        if self.archetype_centroids is not None:
+            with span('archetype_scores'):
+                self.d_vector = self._archetype_scores(self.deck_vector)
+            if self.d_vector is not None:
+                return
 
+        if self.quantize is not None:
+            self.d_vector = self._quantized_scores(self.deck_vector)
+            return
+
+        if self.coalescer is not None:
+            # the exact solve, together with other concurrent requests
+            with span('coalesced_solve'):
+                self.d_vector = self.coalescer.submit(self.deck_vector)
+            return
 
         # u vector from the equation d = u*V
-        # print('feature_matrix: {}'.format(self.feature_matrix.shape))
-        # print('deck_vector: {}'.format(self.deck_vector.shape))
-        u_vector = np.linalg.lstsq(self.feature_matrix, self.deck_vector)[0]
+        with span('lstsq'):
+            u_vector = np.linalg.lstsq(self.feature_matrix, self.deck_vector)[0]
 
         # recreated user deck list
-        self.d_vector = np.dot(u_vector, self.feature_matrix.T)
+        with span('reconstruct'):
+            self.d_vector = np.dot(u_vector, self.feature_matrix.T)
+
+    def _quantized_scores(self, deck_vector):
+        '''
+        Scores every card with the quantized factors, then re-scores the best
+        candidates (ranked as in recommend, without the cards already in the
+        deck) with the exact factors.
+
+        INPUT:
+            - deck_vector: numpy array (n,), card counts
+
+        OUTPUT:
+            - d_vector: numpy array (n,), the recreated deck vector. Exact for
+                        the re-ranked candidates, approximate everywhere else.
+        '''
+
+        with span('gram_solve'):
+            u_vector = self._solve(deck_vector)
+
+        with span('quantized_scores'):
+            if self.quantize == 'int8':
+                u_scale = max(np.abs(u_vector).max() / 127, np.finfo(np.float32).tiny)
+                u_quantized = np.round(u_vector / u_scale).astype(np.int8)
+                # int8 products accumulated in int32, no float copy of the matrix
+                d_vector = np.einsum('ij,j->i', self.quantized_factors, u_quantized,
+                                     dtype=np.int32).astype(np.float32)
+                d_vector *= self.factor_scales * u_scale
+            else:
+                d_vector = np.empty(len(self.quantized_factors), dtype=np.float32)
+                # upcast a block at a time, numpy has no float16 matrix products
+                for start in range(0, len(d_vector), 4096):
+                    block = self.quantized_factors[start:start + 4096].astype(np.float32)
+                    d_vector[start:start + 4096] = np.dot(block, u_vector)
+                d_vector *= self.factor_scales
+
+        with span('rerank'):
+            n_candidates = min(self.rerank, len(d_vector))
+            candidates = np.argpartition(deck_vector - d_vector, n_candidates - 1)[:n_candidates]
+            d_vector[candidates] = np.dot(self.feature_matrix[candidates], u_vector)
+
+        return d_vector
+
+    def _archetype_scores(self, deck_vector):
+        '''
+        Assigns the deck to its most similar archetypes and scores only their
+        candidate cards exactly. The rest of the cards are ordered after them by
+        the nearest archetype's scores.
+
+        INPUT:
+            - deck_vector: numpy array (n,), card counts
+
+        OUTPUT:
+            - d_vector: numpy array (n,), None if the deck isn't similar enough to
+                        any archetype and every card has to be scored
+        '''
+
+        u_vector = self._solve(deck_vector)
+        norm = np.linalg.norm(u_vector)
+        if norm == 0:
+            return None
+
+        similarities = np.dot(self.archetype_centroids, u_vector / norm)
+        nearest = np.argsort(similarities)[::-1][:2]
+        if similarities[nearest[0]] < self.min_similarity:
+            return None
+
+        # decks between two archetypes get both candidate pools
+        pool = np.unique(np.concatenate([self.archetype_candidates[archetype]
+                                         for archetype in nearest
+                                         if similarities[archetype] >= self.min_similarity]))
+        pool_scores = np.dot(self.feature_matrix[pool], u_vector)
+
+        d_vector = self.archetype_scores[nearest[0]] * norm
+        # everything outside the pool ranks below the pool
+        d_vector = d_vector - d_vector.max() + (pool_scores - deck_vector[pool]).min() - 1
+        d_vector[pool] = pool_scores
+        self.archetype = int(nearest[0])
+
+        return d_vector
+
+    def score_batch(self, deck_vectors):
+        '''
+        Solves d = u*V for many decks at once and recreates their deck vectors.
+        Both steps are single matrix-matrix products over the whole batch.
+
+        INPUT:
+            - deck_vectors: numpy array (b x n), one deck vector per row
+
+        OUTPUT:
+            - d_vectors: numpy array (b x n), the recreated deck vectors
+        '''
+
+        with span('batch_lstsq'):
+            u_vectors = np.linalg.lstsq(self.feature_matrix, deck_vectors.T)[0]
+
+        with span('batch_reconstruct'):
+            d_vectors = np.dot(self.feature_matrix, u_vectors).T
+
+        return d_vectors
 
     def recommend(self, raw_deck_list, land_filter=False, white_filter=False,
                   blue_filter=False, black_filter=False, red_filter=False,
@@ -69,38 +378,92 @@ class CardRecommender:
         Takes the dot product of u and V to get new ratings for the 'd' vector.
         '''
         self._fit(raw_deck_list)
-        # print('raw: {}'.format(raw_deck_list))
+
+        filters = [(land_filter, 'filter_lands', self._filter_lands),
+                   (white_filter, 'filter_white', self._filter_white),
+                   (blue_filter, 'filter_blue', self._filter_blue),
+                   (black_filter, 'filter_black', self._filter_black),
+                   (red_filter, 'filter_red', self._filter_red),
+                   (green_filter, 'filter_green', self._filter_green),
+                   (colorless_filter, 'filter_colorless', self._filter_colorless)]
 
         if raw_deck_list == '':
-            self.cursor.execute('''SELECT cardstorm_id, SUM(card_count)
-                                   FROM decks
-                                   GROUP BY cardstorm_id
-                                   ORDER BY sum DESC''')
-            recommendations = [_[0] for _ in self.cursor.fetchall()]
+            with span('popularity_query'):
+                with db.connection() as conn:
+                    self.cursor = conn.cursor()
+                    db.execute_prepared(self.cursor, 'popularity',
+                                        '''SELECT cardstorm_id, SUM(card_count) AS n_copies
+                                           FROM decks
+                                           WHERE format = $1
+                                           GROUP BY cardstorm_id
+                                           ORDER BY n_copies DESC''', [self.format])
+                    recommendations = np.array([_[0] for _ in self.cursor.fetchall()],
+                                               dtype=self.all_cardstorm_ids.dtype)
+            if self.legal is not None and len(self.all_cardstorm_ids):
+                # popular cards that aren't in the catalog or aren't legal in the format
+                rows = np.minimum(np.searchsorted(self.all_cardstorm_ids, recommendations),
+                                  len(self.all_cardstorm_ids) - 1)
+                recommendations = recommendations[(self.all_cardstorm_ids[rows] == recommendations)
+                                                  & self.legal[rows]]
         else:
-            recommendations = self.all_cardstorm_ids[np.argsort(self.d_vector - self.deck_vector)[::-1]]
-
-        # print('pre filter: {}'.format(len(recommendations)))
-        if land_filter:
-            recommendations = self._filter_lands(recommendations)
-        if white_filter:
-            recommendations = self._filter_white(recommendations)
-        if blue_filter:
-            recommendations = self._filter_blue(recommendations)
-        if black_filter:
-            recommendations = self._filter_black(recommendations)
-        if red_filter:
-            recommendations = self._filter_red(recommendations)
-        if green_filter:
-            recommendations = self._filter_green(recommendations)
-        if colorless_filter:
-            recommendations = self._filter_colorless(recommendations)
-
-        # close connection when done
-        self.conn.close()
+            with span('argsort'):
+                order = np.argsort(self.d_vector - self.deck_vector)[::-1]
+                if self.legal is not None:
+                    order = order[self.legal[order]]
+                recommendations = self.all_cardstorm_ids[order]
+
+        if any(enabled for enabled, _, _ in filters):
+            # the filters read from the db, borrow a connection for just them
+            with db.connection() as conn:
+                self.cursor = conn.cursor()
+                for enabled, stage, filter_function in filters:
+                    if enabled:
+                        with span(stage):
+                            recommendations = filter_function(recommendations)
 
         return recommendations
 
+    def explain(self, recommendations, n_reasons=3):
+        '''
+        Names the cards in the last deck each recommendation is most often
+        played with.
+
+        INPUT:
+            - recommendations: iterable of cardstorm_ids, i.e. from recommend
+            - n_reasons: int, most card names per recommendation
+
+        OUTPUT:
+            - reasons: list of lists of card names, empty when there are no
+                       partners loaded or none of them are in the deck
+        '''
+
+        with span('explain'):
+            reasons = explain(self.partners, recommendations, self.deck_dict, n_reasons=n_reasons)
+
+        return [[self.card_dict[cardstorm_id] for cardstorm_id in card_reasons]
+                for card_reasons in reasons]
+
+    def deck_stats(self, raw_deck_list=None):
+        '''
+        Mana curve, colors, land count and card types of a deck.
+
+        INPUT:
+            - raw_deck_list: string, plaintext deck list. If None, the deck of
+                             the last recommend call is used.
+
+        OUTPUT:
+            - stats: dictionary, see CardColumns.deck_stats
+        '''
+
+        if self.card_columns is None:
+            raise ValueError('no card columns loaded, deck statistics are unavailable')
+
+        with span('deck_stats'):
+            deck_dict = self.deck_dict if raw_deck_list is None else self._deck_to_dict(raw_deck_list)
+            stats = self.card_columns.deck_stats(deck_dict)
+
+        return stats
+
     def _filter_lands(self, recommendations):
         '''
         Takes the recommendations and remove all land cards.
@@ -108,7 +471,7 @@ class CardRecommender:
 
         query = "SELECT cardstorm_id FROM cards WHERE type_line LIKE '%Land%' AND NOT type_line LIKE '%//%Land%'"
 
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'filter_lands', query)
 
         land_ids = {_[0] for _ in self.cursor.fetchall()}
         # print('land_ids: {}'.format(len(land_ids)))
@@ -123,7 +486,7 @@ class CardRecommender:
 
         query = "SELECT cardstorm_id FROM cards WHERE 'W'=ANY(colors) AND type_line NOT LIKE '%Land%//%'"
 
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'filter_white', query)
 
         white_ids = {_[0] for _ in self.cursor.fetchall()}
         # print('white: {}'.format(len(white_ids)))
@@ -140,7 +503,7 @@ class CardRecommender:
 
         query = "SELECT cardstorm_id FROM cards WHERE 'U'=ANY(colors) AND type_line NOT LIKE '%Land%//%'"
 
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'filter_blue', query)
 
         blue_ids = {_[0] for _ in self.cursor.fetchall()}
         # print('blue: {}'.format(len(blue_ids)))
@@ -158,7 +521,7 @@ class CardRecommender:
 
         query = "SELECT cardstorm_id FROM cards WHERE 'B'=ANY(colors) AND type_line NOT LIKE '%Land%//%'"
 
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'filter_black', query)
 
         black_ids = {_[0] for _ in self.cursor.fetchall()}
         # print('black: {}'.format(len(black_ids)))
@@ -176,7 +539,7 @@ class CardRecommender:
 
         query = "SELECT cardstorm_id FROM cards WHERE 'R'=ANY(colors) AND type_line NOT LIKE '%Land%//%'"
 
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'filter_red', query)
 
         red_ids = {_[0] for _ in self.cursor.fetchall()}
 
@@ -195,7 +558,7 @@ class CardRecommender:
 
         query = "SELECT cardstorm_id FROM cards WHERE 'G'=ANY(colors) AND type_line NOT LIKE '%Land%//%'"
 
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'filter_green', query)
 
         green_ids = {_[0] for _ in self.cursor.fetchall()}
 
@@ -212,9 +575,9 @@ class CardRecommender:
         Takes the recommendations and remove all colorless cards.
         '''
 
-        query = "SELECT cardstorm_id FROM cards WHERE array_length(colors, 1) IS NULL AND type_line NOT LIKE '%Land%//%' AND type_line NOT LIKE '%Land%'"
+        query = "SELECT cardstorm_id FROM cards WHERE COALESCE(array_length(colors, 1), 0) = 0 AND type_line NOT LIKE '%Land%//%' AND type_line NOT LIKE '%Land%'"
 
-        self.cursor.execute(query)
+        db.execute_prepared(self.cursor, 'filter_colorless', query)
 
         colorless_ids = {_[0] for _ in self.cursor.fetchall()}
         # print('colorless: {}'.format(len(colorless_ids)))
@@ -277,6 +640,7 @@ class CardRecommender:
                 cardstorm_id = self.card_dict[card_name.lower()]
             except KeyError:
                 print('\tcard "{}" not found'.format(card_name))
+                continue
             deck_dict[cardstorm_id] = int(card_count)
 
         return deck_dict
@@ -0,0 +1,244 @@
+'''
+Sampling profiler for live traffic. A fraction of the requests are marked
+as profiled, and while any of them is running a background thread reads
+their stacks every few milliseconds and counts them in folded form, the
+input of flamegraph.pl and speedscope:
+
+    Thread.run;...;CardRecommender.recommend;CardRecommender._filter_land 42
+
+Nothing traces the profiled code, so it runs at full speed, and while the
+profiler is off no thread runs and a request only checks a flag.
+
+Under gunicorn the workers share the profiler through the shared state
+directory (see shared_state.py): turning it on, off or resetting it in the
+worker that answers writes profile_control.json, which every worker checks
+at most once a second when a request starts, and each worker writes the
+stacks it counted to profile_stacks_<pid>.json, which folded() and status()
+add up.
+'''
+import os
+import random
+import sys
+import threading
+import time
+import shared_state
+
+# seconds between two checks of the shared settings, and two writes of the stacks
+SYNC_SECONDS = 1.0
+
+class SamplingProfiler():
+
+    def __init__(self, rate=0.01, interval=0.005, max_stacks=10000):
+        '''
+        INPUT:
+            - rate: float, fraction of the requests profiled
+            - interval: float, seconds between two samples
+            - max_stacks: int, most distinct stacks kept, the rest are counted
+                          under a single '[truncated]' stack
+        '''
+        self.enabled = False
+        self.rate = rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.sampled_requests = 0
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._threads = set()
+        self._counts = {}
+        self._thread = None
+        self._thread_pid = None
+        # set by every reset, stacks counted before it are dropped
+        self._generation = 0.0
+        self._control_mtime = None
+        self._next_sync = 0.0
+
+    def enable(self, rate=None, interval=None):
+        if rate is not None:
+            self.rate = rate
+        if interval is not None:
+            self.interval = interval
+        self.enabled = True
+        self._write_control()
+
+    def disable(self):
+        # the sampling thread stops by itself on its next tick
+        self.enabled = False
+        self._write_control()
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self._write_control()
+
+    def reset(self):
+        self._generation = time.time()
+        self._clear()
+        self._write_control()
+        self._write_stacks()
+
+    def _clear(self):
+        with self._lock:
+            self._counts = {}
+            self.sampled_requests = 0
+            self.samples = 0
+
+    def _write_control(self):
+        shared_state.write('profile_control', {'enabled': self.enabled, 'rate': self.rate,
+                                               'interval': self.interval,
+                                               'generation': self._generation})
+
+    def _write_stacks(self):
+        with self._lock:
+            stacks = {'pid': os.getpid(), 'generation': self._generation,
+                      'sampled_requests': self.sampled_requests, 'samples': self.samples,
+                      'counts': dict(self._counts)}
+        shared_state.write('profile_stacks_{}'.format(os.getpid()), stacks)
+
+    def sync(self, force=False):
+        '''
+        Takes on the settings another worker wrote, at most once every
+        SYNC_SECONDS unless force. Does nothing outside gunicorn.
+        '''
+
+        now = time.monotonic()
+        if (now < self._next_sync and not force) or shared_state.directory() is None:
+            return
+        self._next_sync = now + SYNC_SECONDS
+
+        path = os.path.join(shared_state.directory(), 'profile_control.json')
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+
+        control = shared_state.read('profile_control')
+        if control is None:
+            return
+        if control['generation'] != self._generation:
+            self._generation = control['generation']
+            self._clear()
+        self.rate, self.interval, self.enabled = control['rate'], control['interval'], control['enabled']
+
+    def start_request(self):
+        '''
+        Decides whether the request handled by the current thread is profiled.
+
+        OUTPUT:
+            - profiled: bool, if True finish_request must be called when it ends
+        '''
+
+        self.sync()
+        if not self.enabled or random.random() >= self.rate:
+            return False
+
+        with self._lock:
+            self._threads.add(threading.get_ident())
+            self.sampled_requests += 1
+            # a thread started before the server forked doesn't run in the worker
+            if self._thread is None or not self._thread.is_alive() or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='cardstorm-profiler', daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+        return True
+
+    def finish_request(self):
+        with self._lock:
+            self._threads.discard(threading.get_ident())
+
+    def _run(self):
+        event = threading.Event()
+        own_ident = threading.get_ident()
+        next_write = time.monotonic() + SYNC_SECONDS
+
+        while self.enabled:
+            event.wait(self.interval)
+            if time.monotonic() >= next_write:
+                self._write_stacks()
+                next_write = time.monotonic() + SYNC_SECONDS
+            with self._lock:
+                threads = set(self._threads)
+            if not threads:
+                continue
+
+            frames = sys._current_frames()
+            stacks = [fold(frames[ident]) for ident in threads
+                      if ident in frames and ident != own_ident]
+            del frames
+
+            with self._lock:
+                for stack in stacks:
+                    if stack not in self._counts and len(self._counts) >= self.max_stacks:
+                        stack = '[truncated]'
+                    self._counts[stack] = self._counts.get(stack, 0) + 1
+                self.samples += len(stacks)
+
+        self._write_stacks()
+
+    def _all_stacks(self):
+        '''
+        OUTPUT:
+            - stacks: list of dictionaries, the stacks of every worker since the
+                      last reset, this process's only outside gunicorn
+        '''
+
+        if shared_state.directory() is None:
+            with self._lock:
+                return [{'pid': os.getpid(), 'sampled_requests': self.sampled_requests,
+                         'samples': self.samples, 'counts': dict(self._counts)}]
+
+        self._write_stacks()
+        return [stacks for stacks in shared_state.read_all('profile_stacks_')
+                if stacks['generation'] == self._generation]
+
+    def folded(self):
+        '''
+        OUTPUT:
+            - text: string, one 'frame;frame;... count' line per distinct stack
+                    of every worker, the most sampled first
+        '''
+
+        totals = {}
+        for stacks in self._all_stacks():
+            for stack, count in stacks['counts'].items():
+                totals[stack] = totals.get(stack, 0) + count
+        counts = sorted(totals.items(), key=lambda item: -item[1])
+
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in counts)
+
+    def status(self):
+        all_stacks = self._all_stacks()
+        stacks = set()
+        for worker in all_stacks:
+            stacks.update(worker['counts'])
+
+        return {'enabled': self.enabled,
+                'rate': self.rate,
+                'interval_ms': self.interval * 1000,
+                'sampled_requests': sum(worker['sampled_requests'] for worker in all_stacks),
+                'samples': sum(worker['samples'] for worker in all_stacks),
+                'stacks': len(stacks),
+                'workers': sorted(worker['pid'] for worker in all_stacks)}
+
+def fold(frame):
+    '''
+    OUTPUT:
+        - stack: string, the frames from the outermost in, joined with ';'
+    '''
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({})'.format(getattr(code, 'co_qualname', code.co_name),
+                                      os.path.basename(code.co_filename)))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+PROFILER = SamplingProfiler(rate=float(os.environ.get('CARDSTORM_PROFILE_RATE', 0.01)),
+                            interval=float(os.environ.get('CARDSTORM_PROFILE_INTERVAL_MS', 5)) / 1000)
+
+if os.environ.get('CARDSTORM_PROFILE', '0') == '1':
+    PROFILER.enable()
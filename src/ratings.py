@@ -0,0 +1,152 @@
+'''
+The deck ratings every batch job learns from, read straight into numpy
+columns. Kept apart from modeling.py so the jobs that only need numpy, i.e.
+archetypes and card partners, run without Spark.
+'''
+import numpy as np
+import db
+
+# a row of COPY ... (FORMAT binary) with three non-null int4 columns:
+# field count, then a length and a value per field, all big-endian
+COPY_ROW_DTYPE = np.dtype([('n_fields', '>i2'),
+                           ('deck_id_length', '>i4'), ('deck_id', '>i4'),
+                           ('cardstorm_id_length', '>i4'), ('cardstorm_id', '>i4'),
+                           ('card_count_length', '>i4'), ('card_count', '>i4')])
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_TRAILER = b'\xff\xff'
+
+class RatingsCopySink():
+    '''
+    File-like target for cursor.copy_expert. Parses binary COPY rows as they
+    arrive straight into growing int32 columns, so no Python object is made
+    per row and only one chunk of raw bytes is held at a time.
+    '''
+
+    def __init__(self, expected_rows=0):
+        capacity = max(int(expected_rows), 1024)
+        self.deck_ids = np.empty(capacity, dtype=np.int32)
+        self.cardstorm_ids = np.empty(capacity, dtype=np.int32)
+        self.card_counts = np.empty(capacity, dtype=np.int32)
+        self.n_rows = 0
+        self._pending = b''
+        self._header_read = False
+
+    def write(self, data):
+        self._pending += bytes(data)
+
+        if not self._header_read:
+            # signature, flags and header extension length, then the extension
+            if len(self._pending) < 19:
+                return
+            if not self._pending.startswith(COPY_SIGNATURE):
+                raise ValueError('not a binary COPY stream')
+            extension_length = int.from_bytes(self._pending[15:19], 'big')
+            if len(self._pending) < 19 + extension_length:
+                return
+            self._pending = self._pending[19 + extension_length:]
+            self._header_read = True
+
+        n_complete = len(self._pending) // COPY_ROW_DTYPE.itemsize
+        if n_complete:
+            self._append(np.frombuffer(self._pending, dtype=COPY_ROW_DTYPE, count=n_complete))
+            self._pending = self._pending[n_complete * COPY_ROW_DTYPE.itemsize:]
+
+    def _append(self, rows):
+        if not ((rows['n_fields'] == 3).all() and (rows['deck_id_length'] == 4).all()
+                and (rows['cardstorm_id_length'] == 4).all()
+                and (rows['card_count_length'] == 4).all()):
+            raise ValueError('unexpected NULL or non-int4 column in decks')
+
+        end = self.n_rows + len(rows)
+        if end > len(self.deck_ids):
+            capacity = max(end, 2 * len(self.deck_ids))
+            for name in ('deck_ids', 'cardstorm_ids', 'card_counts'):
+                column = np.empty(capacity, dtype=np.int32)
+                column[:self.n_rows] = getattr(self, name)[:self.n_rows]
+                setattr(self, name, column)
+
+        self.deck_ids[self.n_rows:end] = rows['deck_id']
+        self.cardstorm_ids[self.n_rows:end] = rows['cardstorm_id']
+        self.card_counts[self.n_rows:end] = rows['card_count']
+        self.n_rows = end
+
+    def columns(self):
+        if self._pending != COPY_TRAILER:
+            raise ValueError('binary COPY stream ended unexpectedly')
+
+        return (self.deck_ids[:self.n_rows], self.cardstorm_ids[:self.n_rows],
+                self.card_counts[:self.n_rows])
+
+def load_ratings(cursor, format=None):
+    '''
+    Streams every deck-card row from the db with a binary COPY. Rows are
+    decoded in chunks straight into numpy columns, so memory scales with the
+    size of the decks table rather than with Python tuple overhead.
+
+    INPUT:
+        - cursor: psycopg2 cursor object
+        - format: string, only the decks of this format. None for every deck.
+
+    OUTPUT:
+        - ratings: tuple of numpy int32 arrays (deck_ids, cardstorm_ids, card_counts)
+    '''
+
+    query = 'SELECT deck_id, cardstorm_id, card_count FROM decks'
+
+    if db.embedded():
+        # the embedded backend hands back whole columns as numpy arrays
+        if format is not None:
+            cursor.execute(query + ' WHERE format = %s', [format])
+        else:
+            cursor.execute(query)
+        columns = cursor.fetchnumpy()
+        return tuple(np.asarray(columns[name], dtype=np.int32)
+                     for name in ('deck_id', 'cardstorm_id', 'card_count'))
+
+    # the planner's row estimate is free and close enough to preallocate with
+    cursor.execute("SELECT reltuples FROM pg_class WHERE relname = 'decks'")
+    row = cursor.fetchone()
+    sink = RatingsCopySink(expected_rows=row[0] if row else 0)
+
+    if format is not None:
+        # COPY takes no parameters, mogrify quotes the format
+        query = cursor.mogrify(query + ' WHERE format = %s', [format]).decode()
+    cursor.copy_expert('COPY ({}) TO STDOUT (FORMAT binary)'.format(query), sink)
+
+    return sink.columns()
+
+def ratings_matrix(ratings, all_cardstorm_ids):
+    '''
+    Builds the sparse deck x card ratings matrix from the ratings columns.
+
+    INPUT:
+        - ratings: tuple of numpy arrays (deck_ids, cardstorm_ids, card_counts)
+        - all_cardstorm_ids: sorted numpy array, the column order
+
+    OUTPUT:
+        - matrix: scipy.sparse csr_matrix (n_decks x n_cards) of card counts
+        - deck_ids: numpy array, the deck_id of each row
+    '''
+
+    from scipy import sparse
+
+    deck_ids, cardstorm_ids, card_counts = ratings
+    unique_deck_ids, rows = np.unique(deck_ids, return_inverse=True)
+    columns = np.searchsorted(all_cardstorm_ids, cardstorm_ids)
+
+    matrix = sparse.csr_matrix((card_counts.astype(np.float32), (rows, columns)),
+                               shape=(len(unique_deck_ids), len(all_cardstorm_ids)))
+
+    return matrix, unique_deck_ids
+
+def get_all_cardstorm_ids(cursor):
+    '''
+    Gets every cardstorm_id in the cards table.
+
+    OUTPUT:
+        - all_cardstorm_ids: sorted numpy array of ints
+    '''
+
+    cursor.execute('SELECT cardstorm_id FROM cards ORDER BY cardstorm_id')
+
+    return np.array([_[0] for _ in cursor.fetchall()], dtype=np.int32)
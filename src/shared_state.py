@@ -0,0 +1,81 @@
+'''
+State the gunicorn workers share through files. gunicorn.conf.py makes a
+directory for every server and passes it down in CARDSTORM_WORKER_STATE_DIR:
+each worker writes its own files there, i.e. metrics_<pid>.json, and the
+worker answering a request reads everyone's.
+
+Without the directory (i.e. the Flask development server, one process)
+nothing is written and every read comes back empty.
+'''
+import json
+import os
+import threading
+
+def directory():
+    return os.environ.get('CARDSTORM_WORKER_STATE_DIR') or None
+
+def write(name, value):
+    '''
+    Replaces name.json with value, atomically so readers never see half of it.
+
+    INPUT:
+        - name: string, file name without the extension
+        - value: JSON-serializable value
+    '''
+
+    if directory() is None:
+        return
+
+    path = os.path.join(directory(), '{}.json'.format(name))
+    temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(temporary, 'w') as f:
+        json.dump(value, f)
+    os.replace(temporary, path)
+
+def read(name):
+    '''
+    OUTPUT:
+        - value: the content of name.json, None if there is none
+    '''
+
+    if directory() is None:
+        return None
+
+    try:
+        with open(os.path.join(directory(), '{}.json'.format(name))) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def read_all(prefix):
+    '''
+    OUTPUT:
+        - values: list, the content of every <prefix>*.json
+    '''
+
+    if directory() is None:
+        return []
+
+    values = []
+    for file_name in sorted(os.listdir(directory())):
+        if file_name.startswith(prefix) and file_name.endswith('.json'):
+            value = read(file_name[:-len('.json')])
+            if value is not None:
+                values.append(value)
+
+    return values
+
+def alive(pid):
+    '''
+    OUTPUT:
+        - alive: bool, True if process pid is still running
+    '''
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
@@ -0,0 +1,28 @@
+'''
+Production entry point. Loads the promoted model and the card catalog once,
+before the server forks its workers, so every worker shares the matrices
+copy-on-write instead of loading its own copy.
+
+    gunicorn --config src/gunicorn.conf.py wsgi:application
+
+or scripts/serve.sh
+'''
+import gc
+import db
+import metrics
+from cardstorm_webapp import create_app
+
+application = create_app(preload=True)
+
+# connections opened while loading must not be shared with forked workers,
+# each worker opens its own pool on first use
+db.close_pool()
+
+# /metrics adds up the workers' metrics, so the spans of loading are
+# published once by the master instead of being inherited by every worker
+metrics.publish()
+metrics.reset()
+
+# keep the garbage collector from touching (and so copying) the preloaded
+# objects in every worker
+gc.freeze()
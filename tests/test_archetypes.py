@@ -0,0 +1,27 @@
+import contextlib
+import io
+from benchmark import (make_archetype_recommender, make_catalog, make_deck_lists,
+                       make_feature_matrix, top10_overlap)
+from catalog import ReflexiveDict
+from predictions import CardRecommender
+
+# the default floor of `python src/benchmark.py archetypes`, at the served
+# CARDSTORM_ARCHETYPE_MIN_SIMILARITY
+MIN_OVERLAP = 0.9
+MIN_SIMILARITY = 0.5
+
+def test_archetype_top10_matches_exact():
+    cards = make_catalog(3000)
+    card_dict = ReflexiveDict(cards=cards)
+    exact = CardRecommender(feature_matrix=make_feature_matrix(len(cards), 30), card_dict=card_dict)
+    # one worker and fixed seeds keep the clustering, and so the overlap, the same every run
+    train_decks = make_deck_lists(cards, 2000, seed=1, n_archetypes=10)
+    test_decks = make_deck_lists(cards, 100, seed=0, n_archetypes=10)
+    recommender = make_archetype_recommender(exact, train_decks, n_clusters=10, n_candidates=500,
+                                             min_similarity=MIN_SIMILARITY, workers=1, seed=0)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = [exact.recommend(deck_list)[:10] for deck_list in test_decks]
+        found = [recommender.recommend(deck_list)[:10] for deck_list in test_decks]
+
+    assert top10_overlap(expected, found) >= MIN_OVERLAP
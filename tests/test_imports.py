@@ -0,0 +1,18 @@
+import pytest
+from benchmark import SERVING_FORBIDDEN_MODULES, SERVING_MODULES, measure_import
+
+# the default budget of `python src/benchmark.py imports`
+IMPORT_BUDGET_MS = 500
+
+@pytest.mark.parametrize('module_name', SERVING_MODULES)
+def test_serving_import_budget(module_name):
+    import_ms, _ = measure_import(module_name)
+
+    assert import_ms <= IMPORT_BUDGET_MS
+
+@pytest.mark.parametrize('module_name', SERVING_MODULES)
+def test_serving_imports_no_batch_job_dependencies(module_name):
+    _, modules = measure_import(module_name)
+    forbidden = sorted(name for name in modules if name.split('.')[0] in SERVING_FORBIDDEN_MODULES)
+
+    assert forbidden == []
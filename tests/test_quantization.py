@@ -0,0 +1,26 @@
+import contextlib
+import io
+import pytest
+from benchmark import make_catalog, make_deck_lists, make_feature_matrix, top10_overlap
+from catalog import ReflexiveDict
+from predictions import CardRecommender
+
+# the default floor of `python src/benchmark.py quantization`
+MIN_OVERLAP = 0.95
+
+@pytest.mark.parametrize('rank', [30, 160])
+@pytest.mark.parametrize('quantize', ['float16', 'int8'])
+def test_quantized_top10_matches_exact(quantize, rank):
+    cards = make_catalog(3000)
+    card_dict = ReflexiveDict(cards=cards)
+    feature_matrix = make_feature_matrix(len(cards), rank)
+    deck_lists = make_deck_lists(cards, 50)
+
+    exact = CardRecommender(feature_matrix=feature_matrix, card_dict=card_dict)
+    quantized = CardRecommender(feature_matrix=feature_matrix, card_dict=card_dict,
+                                quantize=quantize, rerank=300)
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = [exact.recommend(deck_list)[:10] for deck_list in deck_lists]
+        found = [quantized.recommend(deck_list)[:10] for deck_list in deck_lists]
+
+    assert top10_overlap(expected, found) >= MIN_OVERLAP